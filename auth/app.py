@@ -1,26 +1,90 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 import jwt
 import datetime
 import os
 import logging
+import uuid
+import time
 from models import AuthDB
+from revocation import RevocationList
+from token_store import create_token_store
+from passwords import HasherBusy, LoginRateLimiter
+from metrics import (REGISTRY, REQUEST_ID_HEADER, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+                     WSGIMetrics, RequestIdFilter, current_request_id, request_id_from)
 
 # Configure logging first
+log_handler = logging.StreamHandler()
+log_handler.addFilter(RequestIdFilter())
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+    handlers=[log_handler]
 )
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
+app.wsgi_app = WSGIMetrics(app.wsgi_app)
 
 # Get logger
 logger = logging.getLogger('auth_service')
 
+# Capability tokens embed the user's compiled grants so that the storage
+# service can authorize without calling /authorize
+CAPABILITY_TOKENS = os.environ.get('CAPABILITY_TOKENS', 'false').lower() in ('1', 'true', 'yes')
+TOKEN_GRANTS_MAX = int(os.environ.get('TOKEN_GRANTS_MAX', 64))
+AUTHORIZE_BATCH_MAX = int(os.environ.get('AUTHORIZE_BATCH_MAX', 1000))
+
 # Initialize database
 db = None
-tokens = {}  # In-memory token storage
+token_store = None  # Verified tokens -> (user_id, jti); see token_store.py
+login_limiter = LoginRateLimiter.from_env()
+revocations = RevocationList(refresh_interval=float(os.environ.get('REVOCATION_REFRESH', 1)))
+POOL_CONNECTIONS = REGISTRY.gauge('db_pool_connections', 'Pooled database connections by state', ('state',))
+
+@app.before_request
+def begin_request():
+    """Name the route for the metrics middleware and adopt the caller's request ID"""
+    request.environ['metrics.route'] = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.request_id = request_id_from(request.headers.get(REQUEST_ID_HEADER))
+    g.request_id_token = current_request_id.set(g.request_id)
+
+@app.after_request
+def add_request_id_header(response):
+    if g.get('request_id'):
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        current_request_id.reset(token)
+
+def issue_token(user_id, username):
+    """Sign a token for the user, embedding grants in capability mode"""
+    jti = uuid.uuid4().hex
+    exp = int(time.time()) + 24 * 3600
+    token_payload = {
+        'user_id': user_id,
+        'username': username,
+        'jti': jti,
+        'exp': exp
+    }
+    if CAPABILITY_TOKENS:
+        version, grants = db.compile_grants(user_id, TOKEN_GRANTS_MAX)
+        if grants is not None:
+            token_payload['pv'] = version
+            token_payload['grants'] = grants
+        else:
+            logger.info(f"Grant list for user {user_id} too large or unavailable, issuing plain token")
+    token = jwt.encode(token_payload, app.config['SECRET_KEY'], algorithm='HS256')
+    
+    token_store.put(token, user_id, jti, exp)
+    return token
+
+def is_revoked(jti):
+    revocations.refresh_if_due(db.revoked_tokens_since)
+    return revocations.is_revoked(jti)
 
 @app.route('/authenticate', methods=['POST'])
 def authenticate():
@@ -35,18 +99,22 @@ def authenticate():
         password = data['password']
         
         logger.info(f"Authentication attempt for user: {username}")
-        user = db.authenticate_user(username, password)
+        retry_after = login_limiter.acquire(username)
+        if retry_after:
+            logger.warning(f"Login rate limit exceeded for user: {username}")
+            response = jsonify({'error': 'Too many login attempts'})
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response, 429
+        
+        try:
+            user = db.authenticate_user(username, password)
+        except HasherBusy as e:
+            logger.warning(f"Login for user {username} shed: {str(e)}")
+            response = jsonify({'error': 'Authentication service busy'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
         if user:
-            # Generate token
-            token_payload = {
-                'user_id': user['id'],
-                'username': user['username'],
-                'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-            }
-            token = jwt.encode(token_payload, app.config['SECRET_KEY'], algorithm='HS256')
-            
-            # Store token in memory
-            tokens[token] = user['id']
+            token = issue_token(user['id'], user['username'])
             
             logger.info(f"User {username} authenticated successfully")
             return jsonify({'token': token})
@@ -58,6 +126,31 @@ def authenticate():
         logger.error(f"Authentication error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def verify_token(token):
+    """Resolve a token to (user_id, None), or (None, error response)"""
+    entry = token_store.get(token)
+    if entry is None:
+        try:
+            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            user_id = payload['user_id']
+            jti = payload.get('jti')
+            token_store.put(token, user_id, jti, payload.get('exp', 0))
+            logger.info(f"Token validated for user {user_id}")
+        except jwt.ExpiredSignatureError:
+            logger.warning("Expired token used for authorization")
+            return None, (jsonify({'error': 'Token expired'}), 401)
+        except jwt.InvalidTokenError:
+            logger.warning("Invalid token used for authorization")
+            return None, (jsonify({'error': 'Invalid token'}), 401)
+    else:
+        user_id, jti = entry
+    
+    if is_revoked(jti):
+        token_store.discard(token)
+        logger.warning(f"Revoked token used for authorization by user {user_id}")
+        return None, (jsonify({'error': 'Token revoked'}), 401)
+    return user_id, None
+
 @app.route('/authorize', methods=['POST'])
 def authorize():
     """Authorize user for file operation"""
@@ -77,49 +170,205 @@ def authorize():
             logger.warning(f"Invalid operation attempted: {operation}")
             return jsonify({'error': 'Operation must be read or write'}), 400
         
-        # Verify token
-        if token not in tokens:
-            try:
-                payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-                user_id = payload['user_id']
-                # Refresh token in storage
-                tokens[token] = user_id
-                logger.info(f"Token validated for user {user_id}")
-            except jwt.ExpiredSignatureError:
-                logger.warning("Expired token used for authorization")
-                return jsonify({'error': 'Token expired'}), 401
-            except jwt.InvalidTokenError:
-                logger.warning("Invalid token used for authorization")
-                return jsonify({'error': 'Invalid token'}), 401
-        else:
-            user_id = tokens[token]
+        user_id, error = verify_token(token)
+        if error is not None:
+            return error
         
         # Check permission
         authorized = db.check_permission(user_id, path, operation)
         logger.info(f"Final permission check result for user {user_id} on path {path}: {authorized}")
         
+        # Lets callers that cache decisions notice permission changes
+        version = db.permissions_version(user_id)
+        
         if authorized:
             logger.info(f"Authorization granted for user {user_id} on {path} for {operation}")
-            return jsonify({'authorized': True}), 200
+            return jsonify({'authorized': True, 'user_id': user_id, 'permissions_version': version}), 200
         else:
             logger.warning(f"Authorization denied for user {user_id} on {path} for {operation}")
-            return jsonify({'authorized': False}), 403
+            return jsonify({'authorized': False, 'user_id': user_id, 'permissions_version': version}), 403
             
     except Exception as e:
         logger.error(f"Authorization error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/authorize/batch', methods=['POST'])
+def authorize_batch():
+    """Authorize many (path, operation) checks for one token in a single call"""
+    try:
+        data = request.get_json()
+        if not data or 'token' not in data or not isinstance(data.get('checks'), list):
+            logger.warning("Batch authorization attempt missing required fields")
+            return jsonify({'error': 'Token and checks required'}), 400
+        
+        checks = data['checks']
+        if len(checks) > AUTHORIZE_BATCH_MAX:
+            return jsonify({'error': f'At most {AUTHORIZE_BATCH_MAX} checks per request'}), 400
+        for check in checks:
+            if not isinstance(check, dict) or 'path' not in check or check.get('operation') not in ('read', 'write'):
+                return jsonify({'error': 'Each check needs a path and a read or write operation'}), 400
+        
+        user_id, error = verify_token(data['token'])
+        if error is not None:
+            return error
+        
+        results = [
+            {
+                'path': check['path'],
+                'operation': check['operation'],
+                'authorized': db.check_permission(user_id, check['path'], check['operation'])
+            }
+            for check in checks
+        ]
+        granted = sum(1 for result in results if result['authorized'])
+        logger.info(f"Batch authorization for user {user_id}: {granted}/{len(results)} granted")
+        return jsonify({
+            'user_id': user_id,
+            'permissions_version': db.permissions_version(user_id),
+            'results': results
+        }), 200
+    except Exception as e:
+        logger.error(f"Batch authorization error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/refresh', methods=['POST'])
+def refresh():
+    """Exchange a valid token for a new one carrying current grants"""
+    try:
+        data = request.get_json()
+        if not data or 'token' not in data:
+            return jsonify({'error': 'Token required'}), 400
+        try:
+            payload = jwt.decode(data['token'], app.config['SECRET_KEY'], algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return jsonify({'error': 'Token expired'}), 401
+        except jwt.InvalidTokenError:
+            return jsonify({'error': 'Invalid token'}), 401
+        if is_revoked(payload.get('jti')):
+            return jsonify({'error': 'Token revoked'}), 401
+        
+        token = issue_token(payload['user_id'], payload.get('username'))
+        logger.info(f"Token refreshed for user {payload['user_id']}")
+        return jsonify({'token': token})
+    except Exception as e:
+        logger.error(f"Token refresh error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    """Revoke a token until its expiry"""
+    try:
+        data = request.get_json()
+        if not data or 'token' not in data:
+            return jsonify({'error': 'Token required'}), 400
+        token = data['token']
+        try:
+            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return jsonify({'message': 'Token already expired'}), 200
+        except jwt.InvalidTokenError:
+            return jsonify({'error': 'Invalid token'}), 401
+        
+        jti = payload.get('jti')
+        token_store.discard(token)
+        if jti is None:
+            return jsonify({'error': 'Token cannot be revoked'}), 400
+        if not db.revoke_token(jti, datetime.datetime.utcfromtimestamp(payload['exp'])):
+            return jsonify({'error': 'Internal server error'}), 500
+        revocations.add(jti, payload['exp'])
+        logger.info(f"Token revoked for user {payload['user_id']}")
+        return jsonify({'message': 'Token revoked'}), 200
+    except Exception as e:
+        logger.error(f"Logout error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/tokens/revoked', methods=['GET'])
+def revoked_tokens():
+    """Revocations since poll cursor `since`, polled by services validating tokens locally"""
+    since = request.args.get('since', 0, type=int)
+    cursor, entries = db.revoked_tokens_since(since)
+    return jsonify({
+        'cursor': cursor,
+        'revoked': [{'jti': jti, 'exp': exp} for jti, exp in entries]
+    }), 200
+
+@app.route('/permissions/version', methods=['GET'])
+def permissions_version():
+    """Global permissions version stamp, plus per-user versions changed since poll cursor `since`"""
+    version = db.permissions_version()
+    if version is None:
+        return jsonify({'error': 'Internal server error'}), 500
+    result = {'version': version}
+    since = request.args.get('since', type=int)
+    if since is not None:
+        cursor, users = db.permission_versions_since(since)
+        if users is None:
+            return jsonify({'error': 'Internal server error'}), 500
+        result['cursor'] = cursor
+        result['users'] = {str(user_id): v for user_id, v in users.items()}
+    return jsonify(result), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for testing"""
     return jsonify({'status': 'healthy'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, merged across worker processes"""
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/stats/tokens', methods=['GET'])
+def token_stats():
+    """Token store size and evictions"""
+    if token_store is None:
+        return jsonify({'error': 'Database not initialized'}), 503
+    return jsonify(token_store.stats()), 200
+
+@app.route('/stats/pool', methods=['GET'])
+def pool_stats():
+    """Database connection pool usage, for sizing DB_POOL_MIN/DB_POOL_MAX"""
+    if db is None:
+        return jsonify({'error': 'Database not initialized'}), 503
+    return jsonify(db.pool_stats()), 200
+
+def create_app(dsn=None):
+    """App factory (gunicorn: 'app:create_app()').
+    
+    Safe to call before forking: pooled connections are opened lazily, and
+    init_worker() opens each process's own after the fork.
+    """
+    global db, token_store
+    if db is None:
+        db = AuthDB(dsn or os.environ.get('DATABASE_DSN', 'postgresql://postgres:password@db:5432/file_storage'))
+        token_store = create_token_store(db)
+        REGISTRY.on_collect(export_pool_stats)
+    return app
+
+def export_pool_stats():
+    stats = db.pool_stats()
+    for state in ('in_use', 'idle', 'waiting'):
+        POOL_CONNECTIONS.labels(state).set(stats[state])
+
+def init_worker():
+    """Per-process setup, run in each server worker after fork"""
+    if db is not None:
+        try:
+            db.pool.fill()
+        except Exception as e:
+            logger.warning(f"Could not pre-open database connections: {str(e)}")
+
+def shutdown():
+    """Close pooled connections when a worker exits"""
+    if db is not None:
+        db.close()
+    REGISTRY.flush(final=True)
+
 if __name__ == '__main__':
-    dsn = os.environ.get('DATABASE_DSN', 'postgresql://postgres:password@db:5432/file_storage')
-    db = AuthDB(dsn)
+    create_app()
     
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5001))
     
     logger.info(f"Starting auth service on {host}:{port}")
-    app.run(host=host, port=port, debug=False)
\ No newline at end of file
+    app.run(host=host, port=port, debug=False)
@@ -0,0 +1,67 @@
+"""Gunicorn settings for production serving (see entrypoint.sh).
+
+    gunicorn -c gunicorn.conf.py 'app:create_app()'
+
+The app is preloaded in the master and forked into workers. Database pools
+and other per-process state are fork-aware and are (re)created in each
+worker by post_fork, and closed again in worker_exit.
+"""
+import os
+import glob
+import tempfile
+import importlib
+import multiprocessing
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 5001)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# sync, gthread or gevent (gevent needs the gevent and psycogreen packages)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+# gevent patches threading after the fork, so locks created by a preloaded app
+# would not be cooperative: gevent workers import the app themselves
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes') \
+    and worker_class != 'gevent'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+# Workers write metric snapshots here so that /metrics on any worker covers
+# them all (see metrics.py). Set before the app is imported.
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"metrics-{os.getpid()}"))
+
+
+def _call_app_hook(worker, name):
+    """Call init_worker/shutdown in the module named by the app URI, if it has one"""
+    module = importlib.import_module(worker.app.app_uri.split(':')[0])
+    hook = getattr(module, name, None)
+    if hook is not None:
+        hook()
+
+
+def on_starting(server):
+    # Snapshots left by an earlier run must not be merged into this one
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.unlink(path)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if preload_app:
+        _call_app_hook(worker, 'init_worker')
+
+
+def post_worker_init(worker):
+    # Without preload the app is only imported once the worker has started
+    if not preload_app:
+        _call_app_hook(worker, 'init_worker')
+
+
+def worker_exit(server, worker):
+    _call_app_hook(worker, 'shutdown')
@@ -1,17 +1,41 @@
-import psycopg2
 from psycopg2.extras import RealDictCursor
 import logging
+import time
+from db_pool import ConnectionPool
+from permissions import PermissionResolver
+from passwords import PasswordHasher
+from metrics import instrument_methods
 
 class AuthDB:
-    def __init__(self, dsn):
+    REVOCATION_PURGE_INTERVAL = 60.0
+    
+    def __init__(self, dsn, pool=None):
         self.dsn = dsn
+        self._revocations_purged_at = float('-inf')
         self.logger = logging.getLogger('auth_service')
+        self.pool = pool or ConnectionPool.from_env(dsn, logger_name='auth_service')
+        self.permissions = PermissionResolver.from_env(self)
+        self.hasher = PasswordHasher.from_env()
     
     def get_connection(self):
-        return psycopg2.connect(self.dsn)
+        """Borrow a pooled connection (commits on success, returned to the pool on exit)"""
+        return self.pool.connection()
+    
+    def pool_stats(self):
+        """Connection pool usage: in use, idle, wait time"""
+        return self.pool.stats()
+    
+    def close(self):
+        self.hasher.close()
+        self.pool.close()
     
     def authenticate_user(self, username, password):
-        """Authenticate user and return user info if successful"""
+        """Authenticate user and return user info if successful.
+        
+        The hash is checked on the hashing pool after the connection is
+        returned, and upgraded in place if its iteration count is outdated.
+        Raises HasherBusy when the pool is saturated.
+        """
         try:
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -20,90 +44,210 @@ class AuthDB:
                         (username,)
                     )
                     user = cur.fetchone()
-                    
-                    if user and self.verify_password(password, user['password_hash']):
-                        return {
-                            'id': user['id'],
-                            'username': user['username']
-                        }
-                    return None
         except Exception as e:
             self.logger.error(f"Authentication error: {str(e)}")
             return None
+        
+        # Unknown users are checked against a dummy hash so timing reveals nothing
+        valid, new_hash = self.hasher.verify(password, user['password_hash'] if user else None)
+        if not valid:
+            return None
+        if new_hash is not None:
+            self.update_password_hash(user['id'], user['password_hash'], new_hash)
+        return {
+            'id': user['id'],
+            'username': user['username']
+        }
     
     def verify_password(self, password, password_hash):
-        """Simple password verification for demo purposes"""
-        expected_hashes = {
-            'admin123': 'pbkdf2:sha256:260000$TestHash$testhash123',
-            'user123': 'pbkdf2:sha256:260000$TestHash$testhash456'
-        }
-        return expected_hashes.get(password) == password_hash
+        """Check password against a stored pbkdf2:sha256:<iterations>$salt$hash (on the hashing pool)"""
+        return self.hasher.verify(password, password_hash)[0]
+    
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        """Replace a user's hash unless it changed since it was read"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                        (new_hash, user_id, old_hash)
+                    )
+                    if cur.rowcount:
+                        self.logger.info(f"Rehashed password for user {user_id}")
+                    return cur.rowcount > 0
+        except Exception as e:
+            self.logger.error(f"Password rehash error: {str(e)}")
+            return False
     
     def check_permission(self, user_id, path, operation):
-        """Check if user has permission for operation on path"""
+        """Check if user has permission for operation on path (longest-prefix match)"""
+        try:
+            authorized = self.permissions.check(user_id, path, operation)
+            self.logger.info(f"Permission resolution for user {user_id} on path {path} ({operation}): {authorized}")
+            return authorized
+        except Exception as e:
+            self.logger.error(f"Permission check error: {str(e)}")
+            return False
+    
+    def permissions_version(self, user_id=None):
+        """Permission version stamp for one user, or a global stamp across all users"""
         try:
+            if user_id is not None:
+                return self.permissions.version(user_id)
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    if operation == 'read':
-                        permission_field = 'can_read'
-                    elif operation == 'write':
-                        permission_field = 'can_write'
-                    else:
-                        return False
-                    
-                    # First, check if user has explicit permission for the exact path
-                    cur.execute(f"""
-                        SELECT {permission_field} 
-                        FROM permissions 
-                        WHERE user_id = %s AND path = %s
-                    """, (user_id, path))
-                    
-                    exact_match = cur.fetchone()
-                    if exact_match:
-                        self.logger.info(f"Exact permission match for user {user_id} on path {path}: {exact_match[permission_field]}")
-                        return exact_match[permission_field]
-                    
-                    # If no exact match, check if user has permission for parent paths
-                    # Build parent paths (e.g., for "/docs/file" check "/docs" and "/")
-                    path_parts = path.rstrip('/').split('/')
-                    parent_paths = []
-                    
-                    # Start from the most specific parent to the root
-                    current_path = ""
-                    for part in path_parts:
-                        if part:  # Skip empty parts for root
-                            current_path += '/' + part
-                            parent_paths.append(current_path)
-                    
-                    # Check each parent path from most specific to least specific
-                    for parent_path in reversed(parent_paths):
-                        cur.execute(f"""
-                            SELECT {permission_field} 
-                            FROM permissions 
-                            WHERE user_id = %s AND path = %s
-                        """, (user_id, parent_path))
-                        
-                        parent_match = cur.fetchone()
-                        if parent_match:
-                            self.logger.info(f"Parent permission match for user {user_id} on parent path {parent_path}: {parent_match[permission_field]}")
-                            return parent_match[permission_field]
-                    
-                    # Check root permission as last resort
-                    cur.execute(f"""
-                        SELECT {permission_field} 
-                        FROM permissions 
-                        WHERE user_id = %s AND path = '/'
-                    """, (user_id,))
-                    
-                    root_match = cur.fetchone()
-                    if root_match:
-                        self.logger.info(f"Root permission match for user {user_id}: {root_match[permission_field]}")
-                        return root_match[permission_field]
-                    
-                    # No permissions found
-                    self.logger.info(f"No permissions found for user {user_id} on path {path}")
-                    return False
-                    
+                    cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM permission_versions")
+                    return int(cur.fetchone()['version'])
         except Exception as e:
-            self.logger.error(f"Permission check error: {str(e)}")
-            return False
\ No newline at end of file
+            self.logger.error(f"Permission version error: {str(e)}")
+            return None
+    
+    def permission_versions_since(self, since):
+        """Users whose permissions changed in transactions at or after txid `since`.
+        
+        Returns (cursor, {user_id: version}), or (since, None) on error. The
+        cursor is the oldest transaction still running when polled, so a
+        change that commits after a later one is not skipped; it may be
+        returned again by the next poll, which is harmless.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon")
+                    horizon = int(cur.fetchone()['horizon'])
+                    cur.execute(
+                        "SELECT user_id, version FROM permission_versions WHERE txid >= %s",
+                        (since,)
+                    )
+                    return horizon, {row['user_id']: row['version'] for row in cur.fetchall()}
+        except Exception as e:
+            self.logger.error(f"Permission versions error: {str(e)}")
+            return since, None
+    
+    def compile_grants(self, user_id, limit):
+        """Return (version, [[path, can_read, can_write], ...]) or (version, None) if over limit"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(
+                        "SELECT version FROM permission_versions WHERE user_id = %s",
+                        (user_id,)
+                    )
+                    row = cur.fetchone()
+                    version = row['version'] if row else 0
+                    cur.execute("""
+                        SELECT path, can_read, can_write
+                        FROM permissions
+                        WHERE user_id = %s
+                        ORDER BY id
+                        LIMIT %s
+                    """, (user_id, limit + 1))
+                    rows = cur.fetchall()
+                    if len(rows) > limit:
+                        return version, None
+                    return version, [[r['path'], bool(r['can_read']), bool(r['can_write'])] for r in rows]
+        except Exception as e:
+            self.logger.error(f"Compile grants error: {str(e)}")
+            return None, None
+    
+    def revoke_token(self, jti, expires_at):
+        """Record a revoked token id until its natural expiry"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO revoked_tokens (jti, expires_at)
+                        VALUES (%s, %s)
+                        ON CONFLICT (jti) DO NOTHING
+                    """, (jti, expires_at))
+                    return True
+        except Exception as e:
+            self.logger.error(f"Revoke token error: {str(e)}")
+            return False
+    
+    def store_token(self, token_hash, user_id, jti, expires_at):
+        """Record a verified token in the shared (UNLOGGED) issued_tokens table"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO issued_tokens (token_hash, user_id, jti, expires_at)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (token_hash) DO NOTHING
+                    """, (token_hash, user_id, jti, expires_at))
+                    return True
+        except Exception as e:
+            self.logger.error(f"Store token error: {str(e)}")
+            return False
+    
+    def lookup_token(self, token_hash):
+        """(user_id, jti, exp_epoch) for a stored token, or None"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT user_id, jti, EXTRACT(EPOCH FROM expires_at)
+                        FROM issued_tokens
+                        WHERE token_hash = %s
+                    """, (token_hash,))
+                    row = cur.fetchone()
+                    return (row[0], row[1], float(row[2])) if row else None
+        except Exception as e:
+            self.logger.error(f"Lookup token error: {str(e)}")
+            return None
+    
+    def discard_token(self, token_hash):
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM issued_tokens WHERE token_hash = %s", (token_hash,))
+                    return True
+        except Exception as e:
+            self.logger.error(f"Discard token error: {str(e)}")
+            return False
+    
+    def purge_expired_tokens(self, now):
+        """Delete issued_tokens rows that expired before now (naive UTC); returns count"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM issued_tokens WHERE expires_at <= %s", (now,))
+                    return cur.rowcount
+        except Exception as e:
+            self.logger.error(f"Purge tokens error: {str(e)}")
+            return 0
+    
+    def revoked_tokens_since(self, cursor):
+        """Unexpired revocations from transactions at or after txid cursor.
+        
+        Returns (new_cursor, [(jti, exp_epoch), ...]); the cursor works as in
+        permission_versions_since. Expired rows are purged at most every
+        REVOCATION_PURGE_INTERVAL seconds along the way.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    if time.monotonic() - self._revocations_purged_at >= self.REVOCATION_PURGE_INTERVAL:
+                        cur.execute("DELETE FROM revoked_tokens WHERE expires_at <= now() AT TIME ZONE 'UTC'")
+                        self._revocations_purged_at = time.monotonic()
+                    cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon")
+                    horizon = int(cur.fetchone()['horizon'])
+                    cur.execute("""
+                        SELECT jti, EXTRACT(EPOCH FROM expires_at) AS exp
+                        FROM revoked_tokens
+                        WHERE txid >= %s
+                    """, (cursor,))
+                    rows = cur.fetchall()
+                    now = time.time()
+                    return horizon, [(row['jti'], float(row['exp'])) for row in rows if float(row['exp']) > now]
+        except Exception as e:
+            self.logger.error(f"Revoked tokens error: {str(e)}")
+            return cursor, []
+    
+    def invalidate_permissions(self, user_id=None):
+        """Drop cached permission tries (all users when user_id is None)"""
+        self.permissions.invalidate(user_id)
+
+
+# Every public AuthDB method is timed into db_operation_seconds
+instrument_methods(AuthDB)
@@ -0,0 +1,181 @@
+import os
+import hmac
+import time
+import secrets
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+SALT_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+class HasherBusy(Exception):
+    """The password hashing pool is saturated; the caller should retry later"""
+
+
+def parse_hash(password_hash):
+    """(digest, iterations, salt, hex hash) from 'pbkdf2:<digest>:<iterations>$<salt>$<hash>', or None"""
+    try:
+        method, salt, hashval = password_hash.split('$', 2)
+        scheme, digest, iterations = method.split(':')
+        if scheme != 'pbkdf2' or digest not in hashlib.algorithms_available:
+            return None
+        return digest, int(iterations), salt, hashval
+    except (AttributeError, ValueError):
+        return None
+
+
+def hash_password(password, iterations, salt=None, digest='sha256'):
+    """Hash in the werkzeug-compatible 'pbkdf2:sha256:<iterations>$<salt>$<hex>' format"""
+    if salt is None:
+        salt = ''.join(secrets.choice(SALT_CHARS) for _ in range(16))
+    hashval = hashlib.pbkdf2_hmac(digest, password.encode('utf-8'), salt.encode('utf-8'), iterations).hex()
+    return f"pbkdf2:{digest}:{iterations}${salt}${hashval}"
+
+
+def verify_password(password, password_hash):
+    """Constant-time check of password against a stored pbkdf2 hash"""
+    parsed = parse_hash(password_hash)
+    if parsed is None:
+        return False
+    digest, iterations, salt, hashval = parsed
+    candidate = hashlib.pbkdf2_hmac(digest, password.encode('utf-8'), salt.encode('utf-8'), iterations).hex()
+    return hmac.compare_digest(candidate, hashval)
+
+
+def _verify_and_rehash(password, password_hash, iterations):
+    """Worker-side: (valid, replacement hash or None if the stored one is current)"""
+    if not verify_password(password, password_hash):
+        return False, None
+    parsed = parse_hash(password_hash)
+    if parsed[1] == iterations and parsed[0] == 'sha256':
+        return True, None
+    return True, hash_password(password, iterations)
+
+
+class PasswordHasher:
+    """Verifies passwords on a bounded process pool, off the request threads.
+
+    At most max_pending verifications are queued or running per process;
+    beyond that verify() raises HasherBusy instead of letting a login flood
+    build an unbounded backlog. The pool is created lazily in each process,
+    using spawn so that a threaded, forked server never forks it mid-lock.
+    """
+
+    def __init__(self, workers=None, max_pending=None, iterations=260000, timeout=10.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.iterations = iterations
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._dummy_hash = None
+
+    @classmethod
+    def from_env(cls):
+        workers = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))
+        return cls(
+            workers=workers if workers > 0 else None,
+            max_pending=int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 0)) or None,
+            iterations=int(os.environ.get('PASSWORD_HASH_ITERATIONS', 260000)),
+            timeout=float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10)),
+        )
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # An inherited pool belongs to the parent: never touch it
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def _dummy(self):
+        """Checked when the user does not exist, so timing does not reveal usernames.
+
+        Computed on first use rather than in the constructor, which runs at
+        import time in every process.
+        """
+        with self._lock:
+            if self._dummy_hash is None:
+                self._dummy_hash = hash_password(secrets.token_hex(8), self.iterations)
+            return self._dummy_hash
+
+    def verify(self, password, password_hash):
+        """(valid, replacement hash or None). Raises HasherBusy when saturated."""
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("Password hashing pool saturated")
+        try:
+            future = self._executor().submit(
+                _verify_and_rehash, password, password_hash or self._dummy(), self.iterations)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job actually finishes: a timed-out job
+        # that is already running cannot be cancelled and still occupies a
+        # worker, so it must keep counting against max_pending
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            valid, new_hash = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HasherBusy("Password verification timed out")
+        return (valid and password_hash is not None), new_hash
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+class LoginRateLimiter:
+    """Per-username token bucket: burst attempts at once, refilled at rate per second.
+
+    Tracks at most max_users usernames (least recently seen dropped first),
+    so a flood of distinct names cannot grow it without bound.
+    """
+
+    def __init__(self, rate=0.2, burst=5, max_users=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # username -> (tokens, updated_at)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rate=float(os.environ.get('LOGIN_RATE', 0.2)),
+            burst=int(os.environ.get('LOGIN_BURST', 5)),
+            max_users=int(os.environ.get('LOGIN_RATE_USERS', 100000)),
+        )
+
+    @property
+    def enabled(self):
+        return self.burst > 0
+
+    def acquire(self, username):
+        """0 if an attempt is allowed now, else seconds until the next one is"""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(username, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate if self.rate > 0 else 60
+            self._buckets[username] = (tokens, now)
+            self._buckets.move_to_end(username)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+            return wait
@@ -0,0 +1,210 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from psycopg2.extras import RealDictCursor
+
+
+def path_components(path):
+    """Split a path into its non-empty components ("/a//b/" -> ["a", "b"])"""
+    return [part for part in path.split('/') if part]
+
+
+def candidate_paths(path):
+    """Permission rows that can decide access to path, most specific first.
+
+    Mirrors the lookup order of the original resolver: the exact path string,
+    then each ancestor from deepest to shallowest, then "/".
+    """
+    candidates = [path]
+    parts = path_components(path)
+    for depth in range(len(parts), 0, -1):
+        ancestor = '/' + '/'.join(parts[:depth])
+        if ancestor not in candidates:
+            candidates.append(ancestor)
+    if '/' not in candidates:
+        candidates.append('/')
+    return candidates
+
+
+def is_canonical(path):
+    return path == '/' + '/'.join(path_components(path))
+
+
+class _TrieNode:
+    __slots__ = ('children', 'grant')
+
+    def __init__(self):
+        self.children = {}
+        self.grant = None
+
+
+class PermissionTrie:
+    """Per-user path trie answering longest-prefix permission lookups"""
+
+    def __init__(self, rows=()):
+        self.root = _TrieNode()
+        # Rows whose path is not in canonical "/a/b" form can only ever match
+        # as an exact string, never as an ancestor.
+        self.exact = {}
+        self.size = 0
+        for row in rows:
+            self.insert(row['path'], row['can_read'], row['can_write'])
+
+    def insert(self, path, can_read, can_write):
+        grant = (bool(can_read), bool(can_write))
+        self.size += 1
+        if not is_canonical(path):
+            self.exact.setdefault(path, grant)
+            return
+        node = self.root
+        for part in path_components(path):
+            node = node.children.setdefault(part, _TrieNode())
+        if node.grant is None:
+            node.grant = grant
+
+    def lookup(self, path):
+        """Return the (can_read, can_write) grant deciding path, or None"""
+        grant = self.exact.get(path)
+        if grant is not None:
+            return grant
+        node = self.root
+        best = node.grant
+        for part in path_components(path):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.grant is not None:
+                best = node.grant
+        return best
+
+
+class PermissionResolver:
+    """Resolves hierarchical permissions from cached per-user tries.
+
+    A user's permission rows are loaded once into a PermissionTrie and reused
+    until their entry in permission_versions changes. The version is re-read
+    at most every revalidate_interval seconds. Users with more than max_rows
+    permissions are resolved with a single SQL query instead of being cached.
+    """
+
+    def __init__(self, db, max_users=1024, max_rows=5000, revalidate_interval=1.0):
+        self.db = db
+        self.max_users = max_users
+        self.max_rows = max_rows
+        self.revalidate_interval = revalidate_interval
+        self.logger = logging.getLogger('auth_service')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> [version, trie_or_None, checked_at]
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            max_users=int(os.environ.get('PERMISSION_CACHE_USERS', 1024)),
+            max_rows=int(os.environ.get('PERMISSION_TRIE_MAX_ROWS', 5000)),
+            revalidate_interval=float(os.environ.get('PERMISSION_CACHE_REVALIDATE', 1.0)),
+        )
+
+    def invalidate(self, user_id=None):
+        """Drop cached permissions for one user, or for everyone"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def version(self, user_id):
+        """Current permission version for user_id (from cache when possible)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                return entry[0]
+        with self.db.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT version FROM permission_versions WHERE user_id = %s",
+                    (user_id,)
+                )
+                row = cur.fetchone()
+        return row['version'] if row else 0
+
+    def check(self, user_id, path, operation):
+        if operation == 'read':
+            index = 0
+        elif operation == 'write':
+            index = 1
+        else:
+            return False
+
+        if self.max_users <= 0:
+            return self.check_sql(user_id, path, operation)
+
+        trie = self._get_trie(user_id)
+        if trie is None:
+            return self.check_sql(user_id, path, operation)
+        grant = trie.lookup(path)
+        return grant[index] if grant is not None else False
+
+    def _get_trie(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                if now - entry[2] < self.revalidate_interval:
+                    return entry[1]
+
+        with self.db.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Read the version before the rows: a concurrent change then
+                # leaves us holding an older version, forcing a reload later.
+                cur.execute(
+                    "SELECT version FROM permission_versions WHERE user_id = %s",
+                    (user_id,)
+                )
+                row = cur.fetchone()
+                version = row['version'] if row else 0
+
+                if entry is not None and entry[0] == version:
+                    trie = entry[1]
+                else:
+                    cur.execute("""
+                        SELECT path, can_read, can_write
+                        FROM permissions
+                        WHERE user_id = %s
+                        ORDER BY id
+                        LIMIT %s
+                    """, (user_id, self.max_rows + 1))
+                    rows = cur.fetchall()
+                    if len(rows) > self.max_rows:
+                        self.logger.info(f"User {user_id} has more than {self.max_rows} permissions, using SQL resolution")
+                        trie = None
+                    else:
+                        trie = PermissionTrie(rows)
+
+        with self._lock:
+            self._entries[user_id] = [version, trie, now]
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return trie
+
+    def check_sql(self, user_id, path, operation):
+        """Resolve with one query over the exact path and all its ancestors"""
+        permission_field = 'can_read' if operation == 'read' else 'can_write'
+        candidates = candidate_paths(path)
+        with self.db.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT path, {permission_field}
+                    FROM permissions
+                    WHERE user_id = %s AND path = ANY(%s)
+                    ORDER BY array_position(%s::text[], path::text), id
+                    LIMIT 1
+                """, (user_id, candidates, candidates))
+                match = cur.fetchone()
+        if match is None:
+            return False
+        return bool(match[permission_field])
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Service modules import each other by bare name, as they do when run from
+# the service directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,120 @@
+import pytest
+from psycopg2 import extensions
+
+import db_pool
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.commits = 0
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.commits += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(dsn):
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(db_pool.psycopg2, 'connect', connect)
+    return opened
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault('check_idle', None)
+    return ConnectionPool('dbname=test', **kwargs)
+
+
+def test_returned_connection_is_reused(connections):
+    pool = make_pool(max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(connections) == 1
+    assert first.commits == 2
+    assert pool.stats()['checkouts'] == 2
+
+
+def test_checkout_times_out_when_exhausted(connections):
+    pool = make_pool(max_size=1, timeout=0.05)
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_error_rolls_back_and_keeps_connection(connections):
+    pool = make_pool()
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            conn.status = extensions.TRANSACTION_STATUS_INTRANS
+            raise RuntimeError("boom")
+    assert conn.rollbacks == 1 and conn.commits == 0
+    assert pool.stats()['idle'] == 1
+
+
+def test_closed_or_expired_connections_are_replaced(connections):
+    pool = make_pool(max_lifetime=1800)
+    with pool.connection() as conn:
+        pass
+    conn.closed = 1
+    with pool.connection() as replacement:
+        pass
+    assert replacement is not conn
+    assert pool.stats()['connections_discarded'] == 1
+
+    pool.max_lifetime = -1
+    with pool.connection() as third:
+        pass
+    assert third is not replacement
+
+
+def test_fork_discards_inherited_connections_without_closing(connections):
+    pool = make_pool()
+    with pool.connection() as inherited:
+        pass
+    pool._pid = -1  # as seen from a forked child
+    with pool.connection() as conn:
+        pass
+    assert conn is not inherited
+    assert not inherited.closed
+    assert inherited in pool._orphans
+
+
+def test_fill_and_close(connections):
+    pool = make_pool(min_size=3, max_size=5)
+    pool.fill()
+    assert pool.stats()['idle'] == 3
+    pool.close()
+    assert all(conn.closed for conn in connections)
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        ConnectionPool('dbname=test', min_size=5, max_size=2)
@@ -0,0 +1,104 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import passwords
+from passwords import HasherBusy, LoginRateLimiter, PasswordHasher, hash_password, parse_hash, verify_password
+
+
+def test_hash_round_trip():
+    password_hash = hash_password('secret', 1000)
+    assert parse_hash(password_hash)[:2] == ('sha256', 1000)
+    assert verify_password('secret', password_hash)
+    assert not verify_password('wrong', password_hash)
+    assert not verify_password('secret', 'not-a-hash')
+
+
+def test_werkzeug_hashes_verify():
+    from werkzeug.security import generate_password_hash
+    assert verify_password('secret', generate_password_hash('secret', method='pbkdf2:sha256:1000'))
+
+
+def test_outdated_hashes_are_replaced():
+    assert passwords._verify_and_rehash('secret', hash_password('secret', 1000), 1000) == (True, None)
+    valid, new_hash = passwords._verify_and_rehash('secret', hash_password('secret', 500), 1000)
+    assert valid and parse_hash(new_hash)[1] == 1000
+    assert passwords._verify_and_rehash('wrong', hash_password('secret', 500), 1000) == (False, None)
+
+
+@pytest.fixture
+def threaded(monkeypatch):
+    """Runs hasher jobs on a thread pool, so tests can control the job function"""
+    executor = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(PasswordHasher, '_executor', lambda self: executor)
+    yield monkeypatch
+    executor.shutdown(wait=True)
+
+
+def test_dummy_hash_is_computed_on_first_use(threaded):
+    hasher = PasswordHasher(workers=1, iterations=1000)
+    assert hasher._dummy_hash is None
+    assert hasher.verify('secret', None) == (False, None)
+    assert parse_hash(hasher._dummy_hash)[1] == 1000
+
+
+def test_timed_out_jobs_keep_their_slot_until_they_finish(threaded):
+    release = threading.Event()
+
+    def slow(password, password_hash, iterations):
+        release.wait(5)
+        return True, None
+
+    threaded.setattr(passwords, '_verify_and_rehash', slow)
+    hasher = PasswordHasher(workers=1, max_pending=1, iterations=1000, timeout=0.05)
+    with pytest.raises(HasherBusy, match='timed out'):
+        hasher.verify('secret', 'hash')
+    # Still running, so the pool is still full
+    with pytest.raises(HasherBusy, match='saturated'):
+        hasher.verify('secret', 'hash')
+    release.set()
+    hasher.timeout = 5
+    for _ in range(100):
+        try:
+            assert hasher.verify('secret', 'hash') == (True, None)
+            break
+        except HasherBusy:
+            time.sleep(0.01)
+    else:
+        pytest.fail("slot was never released")
+
+
+def test_failed_submit_releases_the_slot(monkeypatch):
+    def broken(self):
+        raise RuntimeError("pool broken")
+
+    monkeypatch.setattr(PasswordHasher, '_executor', broken)
+    hasher = PasswordHasher(workers=1, max_pending=1, iterations=1000)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            hasher.verify('secret', 'hash')
+
+
+def test_process_pool_verifies():
+    hasher = PasswordHasher(workers=1, iterations=1000)
+    try:
+        assert hasher.verify('secret', hash_password('secret', 1000)) == (True, None)
+        assert hasher.verify('wrong', hash_password('secret', 1000)) == (False, None)
+    finally:
+        hasher.close()
+
+
+def test_rate_limiter_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(passwords.time, 'monotonic', lambda: now[0])
+    limiter = LoginRateLimiter(rate=0.5, burst=2, max_users=1)
+    assert limiter.acquire('alice') == 0
+    assert limiter.acquire('alice') == 0
+    assert limiter.acquire('alice') == pytest.approx(2.0)
+    now[0] += 2
+    assert limiter.acquire('alice') == 0
+    # Only one user is tracked: bob pushes alice out, and she starts afresh
+    assert limiter.acquire('bob') == 0
+    assert limiter.acquire('alice') == 0
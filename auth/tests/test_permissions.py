@@ -0,0 +1,141 @@
+import os
+import random
+from contextlib import contextmanager
+
+import pytest
+
+from permissions import PermissionTrie, candidate_paths, path_components
+
+
+def resolve_reference(rows, path, operation):
+    """What check_sql computes: the first row, in candidate order then id order"""
+    field = 'can_read' if operation == 'read' else 'can_write'
+    candidates = candidate_paths(path)
+    matches = [row for row in rows if row['path'] in candidates]
+    if not matches:
+        return False
+    matches.sort(key=lambda row: (candidates.index(row['path']), row['id']))
+    return bool(matches[0][field])
+
+
+def resolve_trie(rows, path, operation):
+    grant = PermissionTrie(rows).lookup(path)
+    if grant is None:
+        return False
+    return grant[0 if operation == 'read' else 1]
+
+
+SEGMENTS = ['a', 'b', 'docs', 'x']
+
+
+def random_path(rng):
+    parts = [rng.choice(SEGMENTS) for _ in range(rng.randint(0, 3))]
+    path = '/' + '/'.join(parts)
+    # Sprinkle in the non-canonical spellings users actually send
+    roll = rng.random()
+    if roll < 0.1 and parts:
+        path += '/'
+    elif roll < 0.2 and len(parts) > 1:
+        path = path.replace('/', '//', 1)
+    elif roll < 0.25:
+        path = path.lstrip('/') or '/'
+    return path
+
+
+def random_rows(rng):
+    return [
+        {'id': i + 1, 'path': random_path(rng),
+         'can_read': rng.random() < 0.6, 'can_write': rng.random() < 0.4}
+        for i in range(rng.randint(0, 8))
+    ]
+
+
+def test_path_components():
+    assert path_components('/a//b/') == ['a', 'b']
+    assert path_components('/') == []
+
+
+def test_candidate_paths_order():
+    assert candidate_paths('/a/b/c') == ['/a/b/c', '/a/b', '/a', '/']
+    assert candidate_paths('/') == ['/']
+    assert candidate_paths('/a//b/') == ['/a//b/', '/a/b', '/a', '/']
+    assert candidate_paths('a/b') == ['a/b', '/a/b', '/a', '/']
+
+
+def test_longest_prefix_wins():
+    rows = [
+        {'id': 1, 'path': '/', 'can_read': True, 'can_write': False},
+        {'id': 2, 'path': '/a/b', 'can_read': False, 'can_write': True},
+    ]
+    trie = PermissionTrie(rows)
+    assert trie.lookup('/a/b/c') == (False, True)
+    assert trie.lookup('/a/bc') == (True, False)
+    assert trie.lookup('/z') == (True, False)
+
+
+def test_first_row_wins_for_duplicate_paths():
+    rows = [
+        {'id': 1, 'path': '/a', 'can_read': True, 'can_write': False},
+        {'id': 2, 'path': '/a', 'can_read': False, 'can_write': True},
+    ]
+    assert PermissionTrie(rows).lookup('/a/x') == (True, False)
+
+
+def test_non_canonical_rows_match_only_exactly():
+    rows = [{'id': 1, 'path': '/a/', 'can_read': True, 'can_write': True}]
+    trie = PermissionTrie(rows)
+    assert trie.lookup('/a/') == (True, True)
+    assert trie.lookup('/a') is None
+    assert trie.lookup('/a/b') is None
+
+
+def test_trie_matches_reference_resolution():
+    rng = random.Random(1234)
+    for _ in range(2000):
+        rows = random_rows(rng)
+        path = random_path(rng)
+        for operation in ('read', 'write'):
+            assert resolve_trie(rows, path, operation) == resolve_reference(rows, path, operation), (rows, path)
+
+
+class TempTableDB:
+    """Just enough of AuthDB for PermissionResolver.check_sql, on one connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @contextmanager
+    def get_connection(self):
+        yield self.conn
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_DATABASE_DSN'), reason='TEST_DATABASE_DSN not set')
+def test_trie_matches_check_sql():
+    import psycopg2
+    from permissions import PermissionResolver
+
+    conn = psycopg2.connect(os.environ['TEST_DATABASE_DSN'])
+    try:
+        with conn.cursor() as cur:
+            # Shadows any real permissions table for this session only
+            cur.execute("""
+                CREATE TEMP TABLE permissions (
+                    id SERIAL PRIMARY KEY, user_id INTEGER, path VARCHAR(512),
+                    can_read BOOLEAN, can_write BOOLEAN)
+            """)
+        resolver = PermissionResolver(TempTableDB(conn), max_users=0)
+        rng = random.Random(99)
+        for user_id in range(1, 201):
+            rows = random_rows(rng)
+            with conn.cursor() as cur:
+                for row in rows:
+                    cur.execute(
+                        "INSERT INTO permissions (user_id, path, can_read, can_write) VALUES (%s, %s, %s, %s) RETURNING id",
+                        (user_id, row['path'], row['can_read'], row['can_write']))
+                    row['id'] = cur.fetchone()[0]
+            for _ in range(10):
+                path = random_path(rng)
+                for operation in ('read', 'write'):
+                    assert resolve_trie(rows, path, operation) == resolver.check_sql(user_id, path, operation), (rows, path)
+    finally:
+        conn.close()
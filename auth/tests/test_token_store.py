@@ -0,0 +1,81 @@
+import pytest
+
+import token_store
+from token_store import MemoryTokenStore, create_token_store
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(token_store.time, 'time', clock)
+    return clock
+
+
+def make_store(**kwargs):
+    kwargs.setdefault('sweep_interval', 0)
+    return MemoryTokenStore(**kwargs)
+
+
+def test_entries_expire_with_the_token(clock):
+    store = make_store()
+    store.put('t1', 1, 'j1', clock.now + 10)
+    assert store.get('t1') == (1, 'j1')
+    clock.now += 10
+    assert store.get('t1') is None
+    assert store.stats()['entries'] == 0
+
+
+def test_expired_tokens_are_not_stored(clock):
+    store = make_store()
+    store.put('t1', 1, 'j1', clock.now)
+    assert store.get('t1') is None
+    assert store.stats()['entries'] == 0
+
+
+def test_least_recently_used_token_is_evicted(clock):
+    store = make_store(max_entries=2)
+    store.put('t1', 1, 'j1', clock.now + 60)
+    store.put('t2', 2, 'j2', clock.now + 60)
+    assert store.get('t1') == (1, 'j1')
+    store.put('t3', 3, 'j3', clock.now + 60)
+    assert store.get('t2') is None
+    assert store.get('t1') == (1, 'j1')
+    assert store.stats()['evictions'] == 1
+
+
+def test_disabled_store_keeps_nothing(clock):
+    store = make_store(max_entries=0)
+    store.put('t1', 1, 'j1', clock.now + 60)
+    assert store.get('t1') is None
+
+
+def test_discard_and_sweep(clock):
+    store = make_store()
+    store.put('t1', 1, 'j1', clock.now + 5)
+    store.put('t2', 2, 'j2', clock.now + 60)
+    store.put('t3', 3, 'j3', clock.now + 60)
+    store.discard('t3')
+    assert store.get('t3') is None
+    clock.now += 30
+    assert store.sweep() == 1
+    assert store.stats()['entries'] == 1
+    assert store.get('t2') == (2, 'j2')
+
+
+def test_create_token_store_from_env(monkeypatch):
+    monkeypatch.setenv('TOKEN_STORE', 'memory')
+    monkeypatch.setenv('TOKEN_STORE_SIZE', '7')
+    store = create_token_store(db=None)
+    assert isinstance(store, MemoryTokenStore)
+    assert store.max_entries == 7
+    monkeypatch.setenv('TOKEN_STORE', 'redis')
+    with pytest.raises(ValueError):
+        create_token_store(db=None)
@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
+
+class TokenStore:
+    """Verified tokens -> (user_id, jti), so repeat /authorize calls skip JWT decoding.
+
+    Entries never outlive the token's exp. Subclasses implement _get, _put,
+    discard and sweep; expired entries are swept by a daemon thread started
+    once per process.
+    """
+
+    def __init__(self, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self.logger = logging.getLogger('auth_service')
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+    def get(self, token):
+        """(user_id, jti) for a stored, unexpired token, or None"""
+        self._ensure_sweeper()
+        entry = self._get(token)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def put(self, token, user_id, jti, exp):
+        self._ensure_sweeper()
+        if exp > time.time():
+            self._put(token, user_id, jti, exp)
+
+    def _ensure_sweeper(self):
+        if self.sweep_interval <= 0 or self._sweeper_pid == os.getpid():
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            thread = threading.Thread(target=self._sweep_loop, name='token-sweep', daemon=True)
+            thread.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    self.logger.info(f"Swept {removed} expired tokens")
+            except Exception as e:
+                self.logger.warning(f"Token sweep failed: {str(e)}")
+
+
+class MemoryTokenStore(TokenStore):
+    """Per-process LRU bounded by max_entries, with exp-based expiry"""
+
+    def __init__(self, max_entries=100000, sweep_interval=60.0):
+        super().__init__(sweep_interval)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token -> (user_id, jti, exp)
+        self._evictions = 0
+
+    def _get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry
+
+    def _put(self, token, user_id, jti, exp):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (user_id, jti, exp)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def discard(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [token for token, entry in self._entries.items() if entry[2] <= now]
+            for token in expired:
+                del self._entries[token]
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'evictions': self._evictions,
+            }
+
+
+class PostgresTokenStore(TokenStore):
+    """Shared store in the UNLOGGED issued_tokens table, keyed by the token's SHA-256"""
+
+    def __init__(self, db, sweep_interval=60.0):
+        super().__init__(sweep_interval)
+        self.db = db
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _get(self, token):
+        return self.db.lookup_token(self._key(token))
+
+    def _put(self, token, user_id, jti, exp):
+        self.db.store_token(self._key(token), user_id, jti, datetime.datetime.utcfromtimestamp(exp))
+
+    def discard(self, token):
+        self.db.discard_token(self._key(token))
+
+    def sweep(self):
+        return self.db.purge_expired_tokens(datetime.datetime.utcnow())
+
+    def stats(self):
+        return {'backend': 'postgres'}
+
+
+def create_token_store(db):
+    """Token store selected by TOKEN_STORE (memory or postgres)"""
+    backend = os.environ.get('TOKEN_STORE', 'memory')
+    sweep_interval = float(os.environ.get('TOKEN_STORE_SWEEP', 60))
+    if backend == 'memory':
+        return MemoryTokenStore(int(os.environ.get('TOKEN_STORE_SIZE', 100000)), sweep_interval)
+    if backend == 'postgres':
+        return PostgresTokenStore(db, sweep_interval)
+    raise ValueError(f"Unknown TOKEN_STORE: {backend}")
@@ -0,0 +1,74 @@
+"""Compare two benchmark result files and flag regressions.
+
+Matches results by name and reports the change in p50/p95/p99 latency and
+throughput. Exits with status 1 if any metric regressed by more than
+--threshold percent, so it can gate CI.
+
+    python benchmarks/compare.py baseline.json candidate.json --threshold 10
+"""
+import json
+import argparse
+
+LATENCY_METRICS = ('p50', 'p95', 'p99')
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data.get('run', {}), {result['name']: result for result in data['results']}
+
+
+def change(old, new):
+    """Percent change from old to new, or None if either is missing"""
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) * 100.0 / old
+
+
+def compare(baseline, candidate, threshold):
+    """Rows of (name, metric, old, new, percent, regressed)"""
+    rows = []
+    for name in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[name], candidate[name]
+        for metric in LATENCY_METRICS:
+            a, b = old['latency_ms'].get(metric), new['latency_ms'].get(metric)
+            percent = change(a, b)
+            rows.append((name, f"{metric} ms", a, b, percent, percent is not None and percent > threshold))
+        a, b = old.get('throughput_rps'), new.get('throughput_rps')
+        percent = change(a, b)
+        rows.append((name, 'rps', a, b, percent, percent is not None and -percent > threshold))
+        if new.get('errors', 0) > old.get('errors', 0):
+            rows.append((name, 'errors', old.get('errors', 0), new['errors'], None, True))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent change that counts as a regression')
+    parser.add_argument('--all', action='store_true', help='Show every metric, not only regressions')
+    args = parser.parse_args()
+
+    baseline_run, baseline = load(args.baseline)
+    candidate_run, candidate = load(args.candidate)
+    print(f"baseline:  {baseline_run.get('git_revision')} {baseline_run.get('started_at')}")
+    print(f"candidate: {candidate_run.get('git_revision')} {candidate_run.get('started_at')}")
+    for name in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"only in {'baseline' if name in baseline else 'candidate'}: {name}")
+
+    rows = compare(baseline, candidate, args.threshold)
+    regressions = [row for row in rows if row[5]]
+    print(f"{'benchmark':<44} {'metric':<8} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name, metric, old, new, percent, regressed in rows:
+        if not (args.all or regressed):
+            continue
+        shown = f"{percent:+7.1f}%" if percent is not None else f"{'-':>8}"
+        print(f"{name:<44} {metric:<8} {old if old is not None else '-':>10} {new if new is not None else '-':>10} "
+              f"{shown}{'  REGRESSION' if regressed else ''}")
+    print(f"{len(regressions)} regressions over {args.threshold:g}% in {len(rows)} compared metrics")
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Load test: a weighted mix of /login, /list, /get and /put against the running services.
+
+Seeds a directory tree under --prefix (files of each --file-sizes for /get,
+directories of each --dir-sizes for /list), then for every --concurrency
+level runs the mix for --duration seconds and reports throughput and
+p50/p95/p99 latency per operation and variant. Results are saved as JSON
+for compare.py.
+
+    docker compose up -d        # Postgres, auth and storage on localhost
+    python benchmarks/loadtest.py --mix login=1,list=3,get=5,put=1 \\
+        --file-sizes 1KiB,64KiB,1MiB --dir-sizes 10,1000 --concurrency 1,8,32 \\
+        --duration 20 --output baseline.json
+
+The auth service rate-limits logins per username (LOGIN_BURST); run it with
+LOGIN_BURST=0 when the mix includes login, or 429s are counted as errors.
+"""
+import io
+import os
+import re
+import time
+import random
+import tarfile
+import argparse
+import threading
+from collections import Counter, defaultdict
+
+import requests
+
+from results import summarize, run_metadata, save, print_table
+
+OPERATIONS = ('login', 'list', 'get', 'put')
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'kib': 1024,
+              'm': 1024 ** 2, 'mb': 1024 ** 2, 'mib': 1024 ** 2, 'g': 1024 ** 3, 'gb': 1024 ** 3, 'gib': 1024 ** 3}
+
+
+def parse_size(text):
+    match = re.fullmatch(r'\s*(\d+)\s*([a-zA-Z]*)\s*', text)
+    if not match or match.group(2).lower() not in SIZE_UNITS:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def size_label(size):
+    for unit, factor in (('MiB', 1024 ** 2), ('KiB', 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def parse_list(text, convert=int):
+    return [convert(item) for item in text.split(',') if item.strip()]
+
+
+def parse_mix(text):
+    """'login=1,get=5' -> {'login': 1.0, 'get': 5.0}"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("Mix has no operation with a positive weight")
+    return mix
+
+
+class Client:
+    """One keep-alive session against the storage service"""
+
+    def __init__(self, base_url, token=None, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, method, endpoint, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        return self.session.request(method, f"{self.base_url}{endpoint}",
+                                    headers=headers, timeout=self.timeout, **kwargs)
+
+    def login(self, username, password):
+        response = self.request('POST', '/login', json={'username': username, 'password': password})
+        if response.status_code == 200:
+            self.token = response.json()['token']
+        return response
+
+    def put(self, path, filename, content):
+        return self.request('PUT', '/put', params={'path': path, 'filename': filename}, data=content)
+
+    def get(self, path, filename):
+        return self.request('GET', '/get', params={'path': path, 'filename': filename})
+
+    def list(self, path, limit):
+        return self.request('GET', '/list', params={'path': path, 'limit': limit})
+
+    def batch_put(self, path, files):
+        """Store {filename: content} under path with one /batch/put"""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            for filename, content in files.items():
+                info = tarfile.TarInfo(f"{path.strip('/')}/{filename}")
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return self.request('POST', '/batch/put', data=buffer.getvalue(),
+                            headers={'Content-Type': 'application/x-tar'})
+
+
+def get_dir(prefix, size):
+    return f"{prefix}/get/{size_label(size)}"
+
+
+def list_dir(prefix, entries):
+    return f"{prefix}/list/{entries}"
+
+
+def seed(client, args):
+    """Create the files /get and /list read; existing directories are reused"""
+    for size in args.file_sizes:
+        for i in range(args.files_per_size):
+            response = client.put(get_dir(args.prefix, size), f"f{i}.bin", os.urandom(size))
+            response.raise_for_status()
+        print(f"Seeded {args.files_per_size} x {size_label(size)} files in {get_dir(args.prefix, size)}")
+
+    for entries in args.dir_sizes:
+        path = list_dir(args.prefix, entries)
+        response = client.list(path, entries)
+        response.raise_for_status()
+        if len(response.json()['files']) >= entries:
+            print(f"Reusing {path} ({entries} files)")
+            continue
+        for first in range(0, entries, args.batch_size):
+            files = {f"e{i:06d}.txt": f"entry {i}\n".encode() for i in range(first, min(first + args.batch_size, entries))}
+            response = client.batch_put(path, files)
+            response.raise_for_status()
+        print(f"Seeded {path} ({entries} files)")
+
+
+class Worker(threading.Thread):
+    def __init__(self, number, args, token, deadline, start_barrier):
+        super().__init__(name=f"bench-{number}", daemon=True)
+        self.number = number
+        self.args = args
+        self.deadline = deadline
+        self.start_barrier = start_barrier
+        self.client = Client(args.storage_url, token, timeout=args.timeout)
+        self.rng = random.Random(args.seed * 1000 + number)
+        self.samples = []  # (op, variant, seconds, status)
+        names = list(args.mix)
+        self.operations = names
+        self.weights = [args.mix[name] for name in names]
+        # Per-size payloads; the first bytes are rewritten per request so /put never deduplicates
+        self.payloads = {size: bytearray(os.urandom(size)) for size in args.file_sizes} if 'put' in args.mix else {}
+        self.puts = 0
+
+    def run(self):
+        self.start_barrier.wait()
+        while time.monotonic() < self.deadline[0]:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            variant, call = getattr(self, f"op_{operation}")()
+            started = time.perf_counter()
+            try:
+                response = call()
+                # Reading the whole body is part of the measured request
+                _ = response.content
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            self.samples.append((operation, variant, time.perf_counter() - started, status))
+
+    def op_login(self):
+        # Same keep-alive session, but the worker keeps its original token
+        credentials = {'username': self.args.username, 'password': self.args.password}
+        return '', lambda: self.client.session.post(
+            f"{self.client.base_url}/login", json=credentials, timeout=self.args.timeout)
+
+    def op_list(self):
+        entries = self.rng.choice(self.args.dir_sizes)
+        return f"{entries} files", lambda: self.client.list(list_dir(self.args.prefix, entries), entries)
+
+    def op_get(self):
+        size = self.rng.choice(self.args.file_sizes)
+        filename = f"f{self.rng.randrange(self.args.files_per_size)}.bin"
+        return size_label(size), lambda: self.client.get(get_dir(self.args.prefix, size), filename)
+
+    def op_put(self):
+        size = self.rng.choice(self.args.file_sizes)
+        self.puts += 1
+        payload = self.payloads[size]
+        stamp = f"{self.number}:{self.puts}:".encode()[:size]
+        payload[:len(stamp)] = stamp
+        filename = f"w{self.number}-{self.puts % self.args.put_files}.bin"
+        return size_label(size), lambda: self.client.put(f"{self.args.prefix}/put", filename, bytes(payload))
+
+
+def run_level(args, token, concurrency):
+    deadline = [float('inf')]
+    barrier = threading.Barrier(concurrency + 1)
+    workers = [Worker(number, args, token, deadline, barrier) for number in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    # Warm-up samples are discarded: connections, caches and pools fill first
+    deadline[0] = time.monotonic() + args.warmup + args.duration
+    barrier.wait()
+    time.sleep(args.warmup)
+    measured_from = [len(worker.samples) for worker in workers]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    groups = defaultdict(lambda: ([], Counter()))
+    for worker, skip in zip(workers, measured_from):
+        for operation, variant, seconds, status in worker.samples[skip:]:
+            for key in {('all', ''), (operation, ''), (operation, variant)}:
+                latencies, statuses = groups[key]
+                statuses[status] += 1
+                if status is not None and status < 400:
+                    latencies.append(seconds)
+
+    results = []
+    for (operation, variant), (latencies, statuses) in sorted(groups.items(), key=lambda item: (item[0][0] != 'all', item[0])):
+        errors = sum(count for status, count in statuses.items() if status is None or status >= 400)
+        name = ' '.join(part for part in (f"c{concurrency}", operation, variant) if part)
+        result = {'name': name, 'concurrency': concurrency, 'operation': operation, 'variant': variant}
+        result.update(summarize(latencies, elapsed, errors))
+        result['statuses'] = {str(status): count for status, count in statuses.items()}
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--storage-url', default=os.environ.get('STORAGE_URL', 'http://localhost:5000'))
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('login=1,list=3,get=5,put=1'),
+                        help='Operation weights, e.g. login=1,list=3,get=5,put=1')
+    parser.add_argument('--file-sizes', type=lambda text: parse_list(text, parse_size), default=[1024, 64 * 1024, 1024 ** 2],
+                        help='Sizes for /get and /put, e.g. 1KiB,64KiB,1MiB')
+    parser.add_argument('--dir-sizes', type=parse_list, default=[10, 1000], help='Entries per listed directory')
+    parser.add_argument('--concurrency', type=parse_list, default=[1, 8, 32], help='Concurrent clients per run')
+    parser.add_argument('--duration', type=float, default=20.0, help='Measured seconds per concurrency level')
+    parser.add_argument('--warmup', type=float, default=3.0, help='Unmeasured seconds before each level')
+    parser.add_argument('--files-per-size', type=int, default=10)
+    parser.add_argument('--put-files', type=int, default=50, help='Distinct filenames each client overwrites')
+    parser.add_argument('--batch-size', type=int, default=500, help='Files per /batch/put while seeding')
+    parser.add_argument('--prefix', default='/bench')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--output', default=None, help='JSON results file (default loadtest-<time>.json)')
+    args = parser.parse_args()
+
+    client = Client(args.storage_url, timeout=args.timeout)
+    response = client.login(args.username, args.password)
+    if response.status_code != 200:
+        raise SystemExit(f"Login failed ({response.status_code}): {response.text}")
+    run = run_metadata('loadtest', args)
+    if not args.skip_seed:
+        seed(client, args)
+
+    results = []
+    for concurrency in args.concurrency:
+        print(f"Running {concurrency} clients for {args.duration:g}s (+{args.warmup:g}s warm-up)")
+        level = run_level(args, client.token, concurrency)
+        print_table(level)
+        results.extend(level)
+
+    save(args.output or time.strftime('loadtest-%Y%m%d-%H%M%S.json'), run, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Latency summaries and the JSON result format shared by the benchmarks."""
+import os
+import sys
+import json
+import math
+import socket
+import platform
+import datetime
+import subprocess
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """Throughput and latency percentiles (ms) for a list of latencies in seconds"""
+    values = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'latency_ms': {
+            'mean': ms(sum(values) / len(values)) if values else None,
+            'p50': ms(percentile(values, 0.50)),
+            'p95': ms(percentile(values, 0.95)),
+            'p99': ms(percentile(values, 0.99)),
+            'max': ms(values[-1]) if values else None,
+        },
+    }
+    if elapsed is not None:
+        summary['elapsed_s'] = round(elapsed, 3)
+        summary['throughput_rps'] = round(len(values) / elapsed, 2) if elapsed > 0 else None
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_metadata(kind, args):
+    return {
+        'kind': kind,
+        'started_at': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'git_revision': git_revision(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'argv': sys.argv[1:],
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+    }
+
+
+def save(path, run, results):
+    """Write {"run": ..., "results": [...]}; every result has a unique "name" for compare.py"""
+    with open(path, 'w') as f:
+        json.dump({'run': run, 'results': results}, f, indent=2, default=str)
+        f.write('\n')
+    print(f"Results written to {path}")
+
+
+def print_table(results):
+    print(f"{'benchmark':<44} {'count':>7} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        latency = result['latency_ms']
+        cell = lambda value: f"{value:>9.3f}" if value is not None else f"{'-':>9}"
+        print(f"{result['name']:<44} {result['count']:>7} {result['errors']:>5} "
+              f"{cell(result.get('throughput_rps'))} {cell(latency['p50'])} {cell(latency['p95'])} {cell(latency['p99'])}")
@@ -0,0 +1,3 @@
+#!/bin/bash
+# Let streaming replicas (docker-compose.scale.yml) connect to this server
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -19,25 +19,161 @@ CREATE TABLE IF NOT EXISTS permissions (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Per-user permission version, bumped by trigger whenever a user's
+-- permissions change so cached permission tries can be invalidated.
+-- Versions come from one sequence, so MAX(version) is a global stamp.
+-- Sequence values can commit out of order, so changes are polled by the
+-- writing transaction id (txid) against the oldest still-running
+-- transaction instead: see AuthDB.permission_versions_since.
+CREATE SEQUENCE IF NOT EXISTS permission_version_seq;
+
+CREATE TABLE IF NOT EXISTS permission_versions (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    version BIGINT NOT NULL DEFAULT 0,
+    txid BIGINT NOT NULL DEFAULT txid_current()
+);
+
+-- Revoked tokens (by JWT id), kept until the token would have expired anyway
+-- and polled by txid like permission_versions
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    id BIGSERIAL PRIMARY KEY,
+    jti VARCHAR(64) UNIQUE NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    txid BIGINT NOT NULL DEFAULT txid_current()
+);
+
+-- Verified tokens shared by all auth workers (TOKEN_STORE=postgres). UNLOGGED:
+-- losing it on a crash only means tokens are verified again.
+CREATE UNLOGGED TABLE IF NOT EXISTS issued_tokens (
+    token_hash CHAR(64) PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    jti VARCHAR(64),
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION bump_permission_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.user_id IS NOT NULL THEN
+        INSERT INTO permission_versions (user_id, version) VALUES (OLD.user_id, nextval('permission_version_seq'))
+        ON CONFLICT (user_id) DO UPDATE SET version = nextval('permission_version_seq'), txid = txid_current();
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.user_id IS NOT NULL THEN
+        INSERT INTO permission_versions (user_id, version) VALUES (NEW.user_id, nextval('permission_version_seq'))
+        ON CONFLICT (user_id) DO UPDATE SET version = nextval('permission_version_seq'), txid = txid_current();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS permissions_version_bump ON permissions;
+CREATE TRIGGER permissions_version_bump
+    AFTER INSERT OR UPDATE OR DELETE ON permissions
+    FOR EACH ROW EXECUTE FUNCTION bump_permission_version();
+
+-- Content-addressed blobs: identical content is stored once and shared by
+-- every files row pointing at it. Blobs whose refcount drops to zero are
+-- deleted by the storage service's garbage collector after a grace period.
+CREATE TABLE IF NOT EXISTS blobs (
+    hash VARCHAR(64) PRIMARY KEY,   -- sha256 of the content, hex
+    size BIGINT NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    backend VARCHAR(16) NOT NULL DEFAULT 'postgres',  -- where the content lives: postgres (blob_chunks) or filesystem
+    codec VARCHAR(16),              -- gzip or zstd when stored compressed, NULL when stored as is
+    stored_size BIGINT,             -- bytes actually stored (equals size when codec is NULL)
+    released_at TIMESTAMP,          -- when refcount last dropped to zero
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS blob_chunks (
+    blob_hash VARCHAR(64) NOT NULL REFERENCES blobs(hash) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    byte_offset BIGINT NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (blob_hash, seq)
+);
+
 -- Files table for storage service
 CREATE TABLE IF NOT EXISTS files (
     id SERIAL PRIMARY KEY,
     path VARCHAR(500) NOT NULL,
     filename VARCHAR(255) NOT NULL,
-    content BYTEA,
+    content BYTEA,                  -- legacy inline content; NULL once migrated to a blob
     user_id INTEGER REFERENCES users(id),
+    blob_hash VARCHAR(64) REFERENCES blobs(hash),
+    size BIGINT,
+    chunk_size INTEGER,             -- legacy: set when content lives in file_chunks
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(path, filename)
 );
 
+-- Tell storage workers which file changed so they can drop cached content
+CREATE OR REPLACE FUNCTION notify_file_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('files_changed', json_build_object('path', OLD.path, 'filename', OLD.filename)::text);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (NEW.path, NEW.filename) IS DISTINCT FROM (OLD.path, OLD.filename)) THEN
+        PERFORM pg_notify('files_changed', json_build_object('path', NEW.path, 'filename', NEW.filename)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS files_change_notify ON files;
+CREATE TRIGGER files_change_notify
+    AFTER INSERT OR UPDATE OR DELETE ON files
+    FOR EACH ROW EXECUTE FUNCTION notify_file_change();
+
+-- Per-file content chunks, written before blob storage existed and
+-- converted to blobs by storage/migrate_blobs.py. byte_offset (here and in
+-- blob_chunks) lets a Range request read only the chunks it overlaps.
+CREATE TABLE IF NOT EXISTS file_chunks (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    byte_offset BIGINT NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (file_id, seq)
+);
+
+-- Multipart upload sessions: parts are uploaded independently (in any order).
+-- Completing an upload hashes the parts in order and points the file at the
+-- resulting content-addressed blob, copying the chunks into blob_chunks (or
+-- the blob backend) only if that content is not stored already
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id VARCHAR(32) PRIMARY KEY,
+    path VARCHAR(500) NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    user_id INTEGER REFERENCES users(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS upload_parts (
+    upload_id VARCHAR(32) NOT NULL REFERENCES upload_sessions(id) ON DELETE CASCADE,
+    part_number INTEGER NOT NULL,
+    size BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (upload_id, part_number)
+);
+
+CREATE TABLE IF NOT EXISTS upload_part_chunks (
+    upload_id VARCHAR(32) NOT NULL,
+    part_number INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    byte_offset BIGINT NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (upload_id, part_number, seq),
+    FOREIGN KEY (upload_id, part_number) REFERENCES upload_parts(upload_id, part_number) ON DELETE CASCADE
+);
+
 -- Clear existing data and insert fresh sample data
-TRUNCATE TABLE permissions, files, users RESTART IDENTITY CASCADE;
+TRUNCATE TABLE permissions, files, users, revoked_tokens, issued_tokens, blobs RESTART IDENTITY CASCADE;
 
 -- Insert sample users with properly hashed passwords
 INSERT INTO users (username, password_hash) VALUES 
-('admin', 'pbkdf2:sha256:260000$TestHash$testhash123'), -- password: admin123
-('user1', 'pbkdf2:sha256:260000$TestHash$testhash456'); -- password: user123
+('admin', 'pbkdf2:sha256:260000$Xq3vT9pLm2RkW7sA$e7dbab0457c47700af16563fe957ae9f6fae4263cdbaecfb80edd3fd8d8fb31a'), -- password: admin123
+('user1', 'pbkdf2:sha256:260000$Hn5cY8dJf1QzE4uB$aa874a2676d453e11d3915fe7465be23b73163daf1242ec7e71bdef32b22aeb6'); -- password: user123
 
 -- Insert permissions - FIXED: user1 should NOT have read access to root
 INSERT INTO permissions (user_id, path, can_read, can_write) VALUES
@@ -48,4 +184,15 @@ INSERT INTO permissions (user_id, path, can_read, can_write) VALUES
 
 -- Create indexes
 CREATE INDEX IF NOT EXISTS idx_files_path ON files(path);
-CREATE INDEX IF NOT EXISTS idx_permissions_user_path ON permissions(user_id, path);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_files_path_prefix ON files((path COLLATE "C"), (filename COLLATE "C"));
+CREATE INDEX IF NOT EXISTS idx_file_chunks_offset ON file_chunks(file_id, byte_offset);
+CREATE INDEX IF NOT EXISTS idx_blob_chunks_offset ON blob_chunks(blob_hash, byte_offset);
+CREATE INDEX IF NOT EXISTS idx_blobs_released ON blobs(released_at) WHERE refcount <= 0;
+CREATE INDEX IF NOT EXISTS idx_files_unmigrated ON files(id) WHERE blob_hash IS NULL;
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at);
+CREATE INDEX IF NOT EXISTS idx_permissions_user_path ON permissions(user_id, path);
+CREATE INDEX IF NOT EXISTS idx_permission_versions_version ON permission_versions(version);
+CREATE INDEX IF NOT EXISTS idx_permission_versions_txid ON permission_versions(txid);
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_txid ON revoked_tokens(txid);
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens(expires_at);
+CREATE INDEX IF NOT EXISTS idx_issued_tokens_expires ON issued_tokens(expires_at);
\ No newline at end of file
@@ -1,42 +1,157 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, g, stream_with_context
+from werkzeug.datastructures import ContentRange
 import requests
 import jwt
 import os
+import time
 import logging
-from io import BytesIO
-from models import StorageDB
+import mimetypes
+import datetime
+import json
+import base64
+import tarfile
+from models import PreconditionFailed
+from routing import RoutingStorageDB
+from auth_cache import DecisionCache, BackgroundPoller
+from capabilities import has_grants, evaluate_grants
+from revocation import RevocationList
+from content_cache import ContentCache, ChangeListener
+from compression import accepts_encoding
+from metrics import (REGISTRY, REQUEST_ID_HEADER, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+                     WSGIMetrics, RequestIdFilter, current_request_id, request_id_from)
 
 # Configure logging first
+log_handler = logging.StreamHandler()
+log_handler.addFilter(RequestIdFilter())
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+    handlers=[log_handler]
 )
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
+app.wsgi_app = WSGIMetrics(app.wsgi_app)
 
 # Get logger
 logger = logging.getLogger('storage_service')
 
 # Configuration
 AUTH_SERVICE_URL = os.environ.get('AUTH_SERVICE_URL', 'http://auth:5001')
+
+class AuthSession(requests.Session):
+    """requests.Session that passes the current request ID on to the auth service"""
+    
+    def request(self, method, url, **kwargs):
+        request_id = current_request_id.get()
+        if request_id is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{REQUEST_ID_HEADER: request_id})
+        return super().request(method, url, **kwargs)
+
+def make_auth_session():
+    """Keep-alive connections to the auth service, shared by all request threads"""
+    session = AuthSession()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=int(os.environ.get('AUTH_HTTP_POOL', 100))))
+    return session
+
+auth_http = make_auth_session()
 db = None
+auth_cache = DecisionCache.from_env()
+revocations = RevocationList()
+content_cache = ContentCache.from_env()
+change_listeners = None
+MAX_UPLOAD_PARTS = int(os.environ.get('UPLOAD_MAX_PARTS', 10000))
+UPLOAD_SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+BLOB_GC_GRACE = float(os.environ.get('BLOB_GC_GRACE', 3600))
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 1000))
+LIST_PAGE_MAX = int(os.environ.get('LIST_PAGE_MAX', 10000))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+BATCH_STATUS_MEMBER = '.batch-status.json'
+AUTH_CHECK_SECONDS = REGISTRY.histogram(
+    'storage_auth_check_seconds', 'Authorization latency by where the decision came from', ('source',))
+CONTENT_BYTES = REGISTRY.counter('storage_content_bytes_total', 'File content bytes served and stored', ('direction',))
+POOL_CONNECTIONS = REGISTRY.gauge('db_pool_connections', 'Pooled database connections by state', ('state',))
+LIST_FIELDS = {'size': 'size', 'hash': 'blob_hash', 'updated_at': 'updated_at'}
 
-def get_user_id_from_token(token):
-    """Extract user ID from token"""
+def decode_token(token):
+    """Verify token signature, expiry and revocation, returning its claims"""
+    auth_sync.ensure_started()
     try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload.get('user_id')
+        claims = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
     except jwt.InvalidTokenError as e:
         logger.warning(f"Invalid token: {str(e)}")
         return None
+    if revocations.is_revoked(claims.get('jti')):
+        logger.warning(f"Revoked token presented by user {claims.get('user_id')}")
+        return None
+    return claims
+
+def get_user_id_from_token(token):
+    """Extract user ID from token"""
+    claims = decode_token(token)
+    return claims.get('user_id') if claims else None
+
+def sync_with_auth():
+    """Pull permission version changes and token revocations from the auth service"""
+    params = {'since': auth_cache.sync_cursor}
+    response = auth_http.get(f"{AUTH_SERVICE_URL}/permissions/version", params=params, timeout=5)
+    if response.status_code == 200:
+        result = response.json()
+        users = result.get('users')
+        if users is not None:
+            users = {int(user_id): version for user_id, version in users.items()}
+        auth_cache.observe_versions(result.get('version'), users, result.get('cursor'))
+    
+    response = auth_http.get(f"{AUTH_SERVICE_URL}/tokens/revoked", params={'since': revocations.cursor}, timeout=5)
+    if response.status_code == 200:
+        result = response.json()
+        revocations.apply(result.get('cursor', 0), [(r['jti'], r['exp']) for r in result.get('revoked', [])])
+
+auth_sync = BackgroundPoller(
+    sync_with_auth,
+    interval=float(os.environ.get('AUTH_SYNC_INTERVAL', 5)),
+    logger=logger
+)
 
-def check_auth(token, path, operation):
-    """Check authorization with auth service"""
+def local_decision(claims, path, operation):
+    """Decide from capability grants or the decision cache; None if auth must be asked"""
+    user_id = claims.get('user_id') if claims else None
+    
+    if user_id is not None and has_grants(claims):
+        # An unknown version (first sync not done yet, or user evicted) could
+        # hide a revocation, so those grants are not trusted either
+        known_version = auth_cache.known_version(user_id)
+        if known_version is not None and claims.get('pv', 0) >= known_version:
+            authorized = evaluate_grants(claims['grants'], path, operation)
+            logger.info(f"Authorized locally from token grants for path: {path}, operation: {operation}: {authorized}")
+            return authorized
+        if known_version is not None:
+            # Grants predate a permission change: ask auth, and tell the client to refresh
+            logger.info(f"Token grants for user {user_id} are stale (pv {claims.get('pv')} < {known_version})")
+            g.token_refresh_required = True
+    
+    if user_id is not None and auth_cache.enabled:
+        cached = auth_cache.get(user_id, path, operation)
+        if cached is not None:
+            logger.info(f"Authorization cache hit for path: {path}, operation: {operation}: {cached}")
+            return cached
+    return None
+
+def check_auth(token, path, operation, claims=None):
+    """Check authorization with auth service, consulting the decision cache first"""
+    started = time.perf_counter()
+    if claims is None:
+        claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
+    
+    decided = local_decision(claims, path, operation)
+    if decided is not None:
+        AUTH_CHECK_SECONDS.labels('local').observe(time.perf_counter() - started)
+        return decided
+    
     try:
         logger.info(f"Checking authorization for path: {path}, operation: {operation}")
-        response = requests.post(
+        response = auth_http.post(
             f"{AUTH_SERVICE_URL}/authorize",
             json={
                 'token': token,
@@ -46,13 +161,66 @@ def check_auth(token, path, operation):
             timeout=5
         )
         logger.info(f"Auth service response: {response.status_code}")
-        if response.status_code == 200:
+        if response.status_code in (200, 403):
             result = response.json()
-            return result.get('authorized', False)
+            authorized = bool(result.get('authorized', False)) and response.status_code == 200
+            if user_id is not None:
+                auth_cache.put(user_id, path, operation, authorized,
+                               token_exp=claims.get('exp'),
+                               version=result.get('permissions_version'))
+            return authorized
         return False
     except requests.RequestException as e:
         logger.error(f"Auth service error: {str(e)}")
         return False
+    finally:
+        AUTH_CHECK_SECONDS.labels('remote').observe(time.perf_counter() - started)
+
+def check_auth_many(token, checks, claims):
+    """Authorize a set of (path, operation) pairs with at most one auth service call.
+    
+    Returns {(path, operation): authorized}.
+    """
+    started = time.perf_counter()
+    user_id = claims.get('user_id') if claims else None
+    decisions = {}
+    pending = []
+    for path, operation in checks:
+        decided = local_decision(claims, path, operation)
+        if decided is None:
+            pending.append((path, operation))
+        else:
+            decisions[(path, operation)] = decided
+    if not pending:
+        AUTH_CHECK_SECONDS.labels('local').observe(time.perf_counter() - started)
+        return decisions
+    
+    try:
+        logger.info(f"Checking authorization for {len(pending)} paths in one batch")
+        response = auth_http.post(
+            f"{AUTH_SERVICE_URL}/authorize/batch",
+            json={
+                'token': token,
+                'checks': [{'path': path, 'operation': operation} for path, operation in pending]
+            },
+            timeout=5
+        )
+        logger.info(f"Auth service batch response: {response.status_code}")
+        if response.status_code == 200:
+            result = response.json()
+            for item in result.get('results', []):
+                key = (item['path'], item['operation'])
+                decisions[key] = bool(item.get('authorized', False))
+                if user_id is not None:
+                    auth_cache.put(user_id, item['path'], item['operation'], decisions[key],
+                                   token_exp=claims.get('exp'),
+                                   version=result.get('permissions_version'))
+    except requests.RequestException as e:
+        logger.error(f"Auth service error: {str(e)}")
+    for key in pending:
+        decisions.setdefault(key, False)
+    AUTH_CHECK_SECONDS.labels('remote_batch').observe(time.perf_counter() - started)
+    return decisions
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -64,7 +232,7 @@ def login():
             return jsonify({'error': 'Username and password required'}), 400
         
         logger.info(f"Login attempt for user: {data.get('username')}")
-        response = requests.post(
+        response = auth_http.post(
             f"{AUTH_SERVICE_URL}/authenticate",
             json=data,
             timeout=5
@@ -77,13 +245,131 @@ def login():
         logger.error(f"Auth service connection error: {str(e)}")
         return jsonify({'error': 'Authentication service unavailable'}), 503
 
+def forward_token_request(endpoint):
+    """Forward a {"token": ...} request (from body or Bearer header) to the auth service"""
+    data = request.get_json(silent=True) or {}
+    token = data.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not token:
+        return jsonify({'error': 'Bearer token required'}), 401
+    try:
+        response = auth_http.post(f"{AUTH_SERVICE_URL}{endpoint}", json={'token': token}, timeout=5)
+        return jsonify(response.json()), response.status_code
+    except requests.RequestException as e:
+        logger.error(f"Auth service connection error: {str(e)}")
+        return jsonify({'error': 'Authentication service unavailable'}), 503
+
+@app.route('/refresh', methods=['POST'])
+def refresh_token():
+    """Exchange a token for one carrying current permissions"""
+    return forward_token_request('/refresh')
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    """Revoke a token"""
+    data = request.get_json(silent=True) or {}
+    token = data.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '')
+    response = forward_token_request('/logout')
+    if response[1] == 200:
+        claims = decode_token(token)
+        if claims and claims.get('jti'):
+            revocations.add(claims['jti'], claims['exp'])
+    return response
+
+upload_janitor = BackgroundPoller(
+    lambda: db is not None and db.cleanup_uploads(UPLOAD_SESSION_TTL),
+    interval=float(os.environ.get('UPLOAD_CLEANUP_INTERVAL', 600)),
+    logger=logger,
+    name='upload-cleanup'
+)
+
+blob_collector = BackgroundPoller(
+    lambda: db is not None and db.collect_garbage(BLOB_GC_GRACE),
+    interval=float(os.environ.get('BLOB_GC_INTERVAL', 300)),
+    logger=logger,
+    name='blob-gc'
+)
+
+@app.before_request
+def begin_request():
+    """Name the route for the metrics middleware and adopt (or assign) a request ID"""
+    request.environ['metrics.route'] = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.request_id = request_id_from(request.headers.get(REQUEST_ID_HEADER))
+    g.request_id_token = current_request_id.set(g.request_id)
+
+@app.after_request
+def add_token_refresh_header(response):
+    if g.get('token_refresh_required'):
+        response.headers['X-Token-Refresh'] = 'required'
+    if g.get('request_id'):
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        current_request_id.reset(token)
+
+def http_timestamp(value):
+    """Database timestamps are naive UTC; HTTP dates are whole seconds"""
+    if value is None:
+        return None
+    return value.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+
+def is_not_modified(etag, last_modified):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since for a GET"""
+    if request.if_none_match:
+        if request.if_none_match.star_tag:
+            return True
+        return etag is not None and request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+def if_range_matches(etag, last_modified):
+    """True unless an If-Range validator says the client's partial copy is stale"""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return etag is not None and if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and if_range.date == last_modified
+    return True
+
+def set_validators(response, etag, last_modified, weak=False):
+    if etag is not None:
+        response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+def encode_list_cursor(path, filename):
+    """Opaque continuation token for the (path, filename) of the last listed row"""
+    raw = json.dumps([path, filename], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_list_cursor(cursor):
+    """(path, filename) from encode_list_cursor, or None if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        path, filename = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(path, str) or not isinstance(filename, str):
+        return None
+    return path, filename
+
 @app.route('/list', methods=['GET'])
 def list_files():
-    """List files in a path"""
+    """List files in a path, one page at a time.
+    
+    Query parameters: limit (page size), cursor (next_cursor of the previous
+    page), recursive=true (include subdirectories) and fields (comma separated
+    subset of size, hash, updated_at). The JSON body is streamed.
+    """
     token = request.headers.get('Authorization', '').replace('Bearer ', '')
     path = request.args.get('path', '')
+    recursive = request.args.get('recursive', '').lower() in ('1', 'true', 'yes')
     
-    logger.info(f"List files request - Path: {path}, Token present: {bool(token)}")
+    logger.info(f"List files request - Path: {path}, Recursive: {recursive}, Token present: {bool(token)}")
     
     if not token:
         logger.warning("List files attempt without token")
@@ -93,20 +379,75 @@ def list_files():
         logger.warning("List files attempt without path")
         return jsonify({'error': 'Path parameter required'}), 400
     
-    user_id = get_user_id_from_token(token)
+    try:
+        limit = int(request.args.get('limit', LIST_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, LIST_PAGE_MAX)
+    
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_list_cursor(cursor)
+        if after is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in LIST_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+    
+    claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
     if not user_id:
         logger.warning(f"List files attempt with invalid token for path {path}")
         return jsonify({'error': 'Invalid token'}), 401
     
-    if not check_auth(token, path, 'read'):
+    if not check_auth(token, path, 'read', claims):
         logger.warning(f"User {user_id} denied read access to path {path}")
         return jsonify({'error': 'Access denied'}), 403
     
-    files_data = db.list_files(path)
-    files = [file_data['filename'] for file_data in files_data]
+    def entry(row):
+        if not fields and not recursive:
+            return row['filename']
+        item = {'path': row['path'], 'filename': row['filename']} if recursive else {'filename': row['filename']}
+        for field in fields:
+            value = row[LIST_FIELDS[field]]
+            item[field] = value.isoformat() if isinstance(value, datetime.datetime) else value
+        return item
+    
+    def generate():
+        # Subdirectories can carry their own (deny) rules, so recursive
+        # listings check each distinct path they return.
+        allowed = {path: True}
+        yield '{"path": %s, "files": [' % json.dumps(path)
+        count = 0
+        returned = 0
+        last = None
+        more = False
+        rows = db.iter_listing(path, after, limit + 1, recursive, user_id=user_id)
+        try:
+            for row in rows:
+                if count == limit:
+                    more = True
+                    break
+                count += 1
+                last = (row['path'], row['filename'])
+                if row['path'] not in allowed:
+                    allowed[row['path']] = check_auth(token, row['path'], 'read', claims)
+                if not allowed[row['path']]:
+                    continue
+                yield (', ' if returned else '') + json.dumps(entry(row))
+                returned += 1
+        finally:
+            rows.close()
+        next_cursor = encode_list_cursor(*last) if more else None
+        yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+        logger.info(f"User {user_id} listed {returned} files in {path} (recursive: {recursive})")
     
-    logger.info(f"User {user_id} listed {len(files)} files in {path}")
-    return jsonify({'path': path, 'files': files})
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @app.route('/get', methods=['GET'])
 def get_file():
@@ -125,27 +466,114 @@ def get_file():
         logger.warning("Get file attempt missing path or filename")
         return jsonify({'error': 'Path and filename parameters required'}), 400
     
-    user_id = get_user_id_from_token(token)
+    claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
     if not user_id:
         logger.warning(f"Get file attempt with invalid token for {path}/{filename}")
         return jsonify({'error': 'Invalid token'}), 401
     
-    if not check_auth(token, path, 'read'):
+    if not check_auth(token, path, 'read', claims):
         logger.warning(f"User {user_id} denied read access to {path}/{filename}")
         return jsonify({'error': 'Access denied'}), 403
     
-    # Get file data - don't restrict by ownership since we already checked path permissions
-    file_data = db.get_file(path, filename)
-    if file_data is None:
+    # Get file data - don't restrict by ownership since we already checked path permissions.
+    # The content cache is only consulted after the permission check above.
+    # A fill must count from before the metadata read: an invalidation that
+    # commits in between would otherwise let it cache the old version.
+    started_at = content_cache.begin_fill()
+    cached = content_cache.get(path, filename) if content_cache.live else None
+    file_info = cached.info if cached is not None else db.get_file_info(path, filename, user_id=user_id)
+    if cached is None and file_info is not None and content_cache.cacheable(file_info) \
+            and not db.is_primary_read(file_info):
+        # Only primary reads fill the cache: a replica may still return a
+        # version whose invalidation has already been received
+        file_info = db.get_file_info(path, filename, primary=True)
+    if file_info is None:
         logger.info(f"File not found: {path}/{filename}")
         return jsonify({'error': 'File not found'}), 404
     
-    logger.info(f"User {user_id} retrieved file {path}/{filename} (owned by user {file_data['user_id']})")
-    return send_file(
-        BytesIO(file_data['content']),
-        as_attachment=True,
-        download_name=filename
+    # Validators come from metadata only; a 304 never touches the content
+    etag = file_info['blob_hash']
+    last_modified = http_timestamp(file_info['updated_at'])
+    if is_not_modified(etag, last_modified):
+        logger.info(f"File {path}/{filename} not modified for user {user_id}")
+        response = Response(status=304)
+        set_validators(response, etag, last_modified)
+        return response
+    
+    if cached is None and not content_cache.live:
+        cached = content_cache.get(path, filename, file_info)
+    
+    local_path = db.file_path(file_info) if cached is None else None
+    if local_path is not None:
+        # Content is a real file: let Werkzeug and the WSGI server stream it with
+        # wsgi.file_wrapper/sendfile, including Range handling
+        logger.info(f"User {user_id} retrieved file {path}/{filename} from disk (owned by user {file_info['user_id']})")
+        response = send_file(
+            local_path,
+            as_attachment=True,
+            download_name=filename,
+            conditional=True,
+            etag=etag or False,
+            last_modified=last_modified
+        )
+        CONTENT_BYTES.labels('out').inc(response.content_length or 0)
+        return response
+    
+    size = file_info['size'] or 0
+    start, end, status = 0, size, 200
+    # Multi-range requests are answered with the whole file, as RFC 9110 allows
+    if request.range is not None and len(request.range.ranges) == 1 and if_range_matches(etag, last_modified):
+        byte_range = request.range.range_for_length(size)
+        begin, _ = request.range.ranges[0]
+        if byte_range is None and begin < 0 and size > 0:
+            # A suffix longer than the file means all of it (RFC 9110 14.1.3)
+            byte_range = (0, size)
+        if byte_range is None:
+            logger.info(f"Unsatisfiable range {request.headers.get('Range')} for {path}/{filename} ({size} bytes)")
+            response = jsonify({'error': 'Requested range not satisfiable'})
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        start, end = byte_range
+        status = 206
+    
+    # Compressed blobs go out as stored when the client can decode them;
+    # otherwise they are decompressed while streaming
+    codec = file_info['codec']
+    encoded = (cached is None and status == 200 and codec is not None
+               and accepts_encoding(request.headers.get('Accept-Encoding'), codec))
+    
+    logger.info(f"User {user_id} retrieved file {path}/{filename} bytes {start}-{end} (owned by user {file_info['user_id']}, cached: {cached is not None}, encoding: {codec if encoded else 'identity'})")
+    if cached is not None:
+        body = [cached.content[start:end]]
+    elif encoded:
+        body = db.iter_stored_content(file_info)
+    elif status == 200 and content_cache.cacheable(file_info):
+        body = content_cache.tee(path, filename, file_info, db.iter_file_content(file_info), started_at)
+    else:
+        body = db.iter_file_content(file_info, start, end)
+    
+    response = Response(
+        body,
+        status=status,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
     )
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if encoded:
+        response.content_encoding = codec
+        response.content_length = file_info['stored_size']
+    else:
+        response.content_length = end - start
+    CONTENT_BYTES.labels('out').inc(response.content_length)
+    if codec is not None:
+        response.vary.add('Accept-Encoding')
+    # The encoded representation's bytes differ, so its ETag is only weak
+    set_validators(response, etag, last_modified, weak=encoded)
+    if status == 206:
+        response.content_range = ContentRange('bytes', start, end, size)
+    return response
 
 @app.route('/put', methods=['PUT'])
 def put_file():
@@ -164,35 +592,449 @@ def put_file():
         logger.warning("Put file attempt missing path or filename")
         return jsonify({'error': 'Path and filename parameters required'}), 400
     
-    user_id = get_user_id_from_token(token)
+    claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
     if not user_id:
         logger.warning(f"Put file attempt with invalid token for {path}/{filename}")
         return jsonify({'error': 'Invalid token'}), 401
     
-    if not check_auth(token, path, 'write'):
+    if not check_auth(token, path, 'write', claims):
         logger.warning(f"User {user_id} denied write access to {path}/{filename}")
         return jsonify({'error': 'Access denied'}), 403
     
-    content = request.get_data()
+    # If-Match lets clients update without reading first; If-None-Match: * means create only
+    if_match = None
+    if 'If-Match' in request.headers:
+        if_match = ['*'] if request.if_match.star_tag else list(request.if_match)
+    if_none_match = request.if_none_match.star_tag
     
-    if db.put_file(path, filename, content, user_id):
-        logger.info(f"User {user_id} stored file {path}/{filename} ({len(content)} bytes)")
-        return jsonify({'message': 'File stored successfully'}), 200
+    try:
+        stored = db.put_file_stream(path, filename, request.stream, user_id,
+                                    if_match=if_match, if_none_match=if_none_match)
+    except PreconditionFailed as e:
+        logger.info(f"Conditional put rejected for user {user_id}: {str(e)}")
+        return jsonify({'error': 'Precondition failed'}), 412
+    
+    if stored is not None:
+        CONTENT_BYTES.labels('in').inc(stored['size'])
+        logger.info(f"User {user_id} stored file {path}/{filename} ({stored['size']} bytes)")
+        response = jsonify({'message': 'File stored successfully'})
+        response.set_etag(stored['hash'])
+        return response, 200
     else:
         logger.error(f"User {user_id} failed to store file {path}/{filename}")
         return jsonify({'error': 'Failed to store file'}), 500
 
+def authenticate_request():
+    """Resolve the Bearer token to (token, claims, user_id), or an error response"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not token:
+        return None, None, None, (jsonify({'error': 'Bearer token required'}), 401)
+    claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
+    if not user_id:
+        return None, None, None, (jsonify({'error': 'Invalid token'}), 401)
+    return token, claims, user_id, None
+
+def load_upload(upload_id, user_id):
+    """Fetch an upload session owned by user_id, or an error response"""
+    upload = db.get_upload(upload_id)
+    if upload is None:
+        return None, (jsonify({'error': 'Upload not found'}), 404)
+    if upload['user_id'] != user_id:
+        logger.warning(f"User {user_id} attempted to use upload {upload_id} owned by user {upload['user_id']}")
+        return None, (jsonify({'error': 'Access denied'}), 403)
+    return upload, None
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable multipart upload"""
+    path = request.args.get('path', '')
+    filename = request.args.get('filename', '')
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    if not path or not filename:
+        return jsonify({'error': 'Path and filename parameters required'}), 400
+    if not check_auth(token, path, 'write', claims):
+        logger.warning(f"User {user_id} denied write access to {path}/{filename}")
+        return jsonify({'error': 'Access denied'}), 403
+    
+    upload_id = db.create_upload(path, filename, user_id)
+    if upload_id is None:
+        return jsonify({'error': 'Failed to create upload'}), 500
+    logger.info(f"User {user_id} started upload {upload_id} for {path}/{filename}")
+    return jsonify({'upload_id': upload_id, 'path': path, 'filename': filename}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Show which parts of an upload have been received"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    upload, error = load_upload(upload_id, user_id)
+    if error:
+        return error
+    return jsonify({
+        'upload_id': upload['id'],
+        'path': upload['path'],
+        'filename': upload['filename'],
+        'parts': upload['parts']
+    }), 200
+
+@app.route('/uploads/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+def put_upload_part(upload_id, part_number):
+    """Upload (or re-upload) part N; parts may be sent in parallel"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    if part_number < 1 or part_number > MAX_UPLOAD_PARTS:
+        return jsonify({'error': f'Part number must be between 1 and {MAX_UPLOAD_PARTS}'}), 400
+    upload, error = load_upload(upload_id, user_id)
+    if error:
+        return error
+    
+    size = db.put_upload_part(upload_id, part_number, request.stream)
+    if size is None:
+        return jsonify({'error': 'Failed to store part'}), 500
+    logger.info(f"User {user_id} uploaded part {part_number} of {upload_id} ({size} bytes)")
+    return jsonify({'upload_id': upload_id, 'part_number': part_number, 'size': size}), 200
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """Assemble the uploaded parts into the target file"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    upload, error = load_upload(upload_id, user_id)
+    if error:
+        return error
+    if not check_auth(token, upload['path'], 'write', claims):
+        logger.warning(f"User {user_id} denied write access to {upload['path']}/{upload['filename']}")
+        return jsonify({'error': 'Access denied'}), 403
+    
+    size = db.complete_upload(upload_id, user_id=user_id)
+    if size is None:
+        return jsonify({'error': 'Upload incomplete or failed', 'parts': upload['parts']}), 409
+    logger.info(f"User {user_id} completed upload {upload_id} to {upload['path']}/{upload['filename']} ({size} bytes)")
+    return jsonify({'message': 'File stored successfully', 'size': size}), 200
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Abort an upload and discard its parts"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    upload, error = load_upload(upload_id, user_id)
+    if error:
+        return error
+    db.abort_upload(upload_id)
+    logger.info(f"User {user_id} aborted upload {upload_id}")
+    return jsonify({'message': 'Upload aborted'}), 200
+
+def archive_name(path, filename):
+    """Tar member name for a file: /docs + a.txt -> docs/a.txt"""
+    directory = path.strip('/')
+    return f"{directory}/{filename}" if directory else filename
+
+def split_archive_name(name):
+    """Inverse of archive_name: (path, filename), or None if name has no filename"""
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    directory, _, filename = name.rpartition('/')
+    if not filename:
+        return None
+    return '/' + directory.strip('/'), filename
+
+def parse_batch_files():
+    """(path, filename) list from a {"files": [{"path", "filename"}, ...]} body, or an error response"""
+    data = request.get_json(silent=True)
+    files = data.get('files') if isinstance(data, dict) else None
+    if not isinstance(files, list) or not files:
+        return None, (jsonify({'error': 'files list required'}), 400)
+    if len(files) > BATCH_MAX_ITEMS:
+        return None, (jsonify({'error': f'At most {BATCH_MAX_ITEMS} files per batch'}), 400)
+    keys = []
+    for item in files:
+        path = item.get('path') if isinstance(item, dict) else None
+        filename = item.get('filename') if isinstance(item, dict) else None
+        if not isinstance(path, str) or not isinstance(filename, str) or not path or not filename:
+            return None, (jsonify({'error': 'Each file needs a path and filename'}), 400)
+        keys.append((path, filename))
+    if len(set(keys)) != len(keys):
+        return None, (jsonify({'error': 'Duplicate files in batch'}), 400)
+    return keys, None
+
+def batch_result(path, filename, status, **extra):
+    result = {'path': path, 'filename': filename, 'status': status}
+    result.update(extra)
+    return result
+
+def tar_header(name, size, modified):
+    """PAX header for a member last modified at naive UTC datetime modified"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = http_timestamp(modified).timestamp()
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+
+def tar_padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+@app.route('/batch/get', methods=['POST'])
+def batch_get():
+    """Download many files as one streamed tar archive.
+    
+    Files that are missing, denied or fail mid-stream are reported in a final
+    .batch-status.json member that lists the status of every requested file.
+    """
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    keys, error = parse_batch_files()
+    if error:
+        return error
+    
+    decisions = check_auth_many(token, {(path, 'read') for path, _ in keys}, claims)
+    allowed = [key for key in keys if decisions[(key[0], 'read')]]
+    infos = db.get_files_info(allowed, user_id=user_id) if allowed else {}
+    if infos is None:
+        return jsonify({'error': 'Failed to read files'}), 500
+    
+    def generate():
+        results = []
+        for path, filename in keys:
+            info = infos.get((path, filename))
+            if not decisions[(path, 'read')]:
+                results.append(batch_result(path, filename, 403))
+                continue
+            if info is None:
+                results.append(batch_result(path, filename, 404))
+                continue
+            size = info['size'] or 0
+            yield tar_header(archive_name(path, filename), size, info['updated_at'])
+            cached = content_cache.get(path, filename, info)
+            chunks = [cached.content] if cached is not None else db.iter_file_content(info)
+            sent = 0
+            try:
+                for chunk in chunks:
+                    chunk = chunk[:size - sent]
+                    sent += len(chunk)
+                    yield chunk
+            except Exception as e:
+                logger.error(f"Batch download of {path}/{filename} failed: {str(e)}")
+            CONTENT_BYTES.labels('out').inc(sent)
+            if sent < size:
+                # The header promised size bytes; keep the archive well-formed
+                yield b'\0' * (size - sent)
+                results.append(batch_result(path, filename, 500, error='Content changed during download'))
+            else:
+                results.append(batch_result(path, filename, 200, etag=info['blob_hash'], size=size))
+            yield tar_padding(size)
+        
+        status = json.dumps({'results': results}).encode('utf-8')
+        yield tar_header(BATCH_STATUS_MEMBER, len(status), datetime.datetime.utcnow())
+        yield status + tar_padding(len(status))
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+        served = sum(1 for result in results if result['status'] == 200)
+        logger.info(f"User {user_id} batch-downloaded {served}/{len(keys)} files")
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-tar')
+    response.headers['Content-Disposition'] = 'attachment; filename="batch.tar"'
+    return response
+
+@app.route('/batch/put', methods=['POST'])
+def batch_put():
+    """Store every regular file in an uploaded tar archive in one transaction.
+    
+    Member names map to paths as in /batch/get (docs/a.txt -> /docs, a.txt).
+    Returns the status of each file. Each member's path is authorized as the
+    archive streams in, and denied members are skipped without being spooled.
+    """
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    
+    items = []  # (path, filename, spool, blob_hash, size); spool is None when denied
+    seen = set()
+    decisions = {}
+    try:
+        try:
+            with tarfile.open(fileobj=request.stream, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    key = split_archive_name(member.name)
+                    if key is None:
+                        return jsonify({'error': f'Invalid member name: {member.name}'}), 400
+                    if key in seen:
+                        return jsonify({'error': f'Duplicate member: {member.name}'}), 400
+                    seen.add(key)
+                    if len(items) == BATCH_MAX_ITEMS:
+                        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} files per batch'}), 400
+                    if key[0] not in decisions:
+                        decisions[key[0]] = check_auth(token, key[0], 'write', claims)
+                    if not decisions[key[0]]:
+                        items.append(key + (None, None, None))
+                        continue
+                    spool, blob_hash, size = db.spool(archive.extractfile(member))
+                    items.append(key + (spool, blob_hash, size))
+        except tarfile.TarError as e:
+            logger.warning(f"Batch put from user {user_id} with unreadable archive: {str(e)}")
+            return jsonify({'error': 'Request body must be a tar archive'}), 400
+        if not items:
+            return jsonify({'error': 'Archive contains no files'}), 400
+        
+        allowed = [item for item in items if item[2] is not None]
+        if not db.put_files(allowed, user_id):
+            logger.error(f"User {user_id} failed to store batch of {len(allowed)} files")
+            return jsonify({'error': 'Failed to store files'}), 500
+    finally:
+        for item in items:
+            if item[2] is not None:
+                item[2].close()
+    
+    results = [
+        batch_result(path, filename, 200, etag=blob_hash, size=size)
+        if spool is not None else batch_result(path, filename, 403)
+        for path, filename, spool, blob_hash, size in items
+    ]
+    CONTENT_BYTES.labels('in').inc(sum(item[4] for item in allowed))
+    logger.info(f"User {user_id} batch-stored {len(allowed)}/{len(items)} files")
+    return jsonify({'results': results}), 200
+
+@app.route('/batch/delete', methods=['POST'])
+def batch_delete():
+    """Delete many files in one statement, returning the status of each"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    keys, error = parse_batch_files()
+    if error:
+        return error
+    
+    decisions = check_auth_many(token, {(path, 'write') for path, _ in keys}, claims)
+    allowed = [key for key in keys if decisions[(key[0], 'write')]]
+    deleted = db.delete_files(allowed, user_id=user_id)
+    if deleted is None:
+        logger.error(f"User {user_id} failed to delete batch of {len(allowed)} files")
+        return jsonify({'error': 'Failed to delete files'}), 500
+    
+    results = []
+    for path, filename in keys:
+        if not decisions[(path, 'write')]:
+            status = 403
+        elif (path, filename) in deleted:
+            status = 200
+        else:
+            status = 404
+        results.append(batch_result(path, filename, status))
+    logger.info(f"User {user_id} batch-deleted {len(deleted)}/{len(keys)} files")
+    return jsonify({'results': results}), 200
+
+@app.route('/delete', methods=['DELETE'])
+def delete_file():
+    """Delete one file"""
+    token, claims, user_id, error = authenticate_request()
+    if error:
+        return error
+    path = request.args.get('path', '')
+    filename = request.args.get('filename', '')
+    if not path or not filename:
+        return jsonify({'error': 'Path and filename parameters required'}), 400
+    
+    if not check_auth(token, path, 'write', claims):
+        logger.warning(f"User {user_id} denied write access to {path}/{filename}")
+        return jsonify({'error': 'Access denied'}), 403
+    
+    deleted = db.delete_files([(path, filename)], user_id=user_id)
+    if deleted is None:
+        return jsonify({'error': 'Failed to delete file'}), 500
+    if not deleted:
+        return jsonify({'error': 'File not found'}), 404
+    logger.info(f"User {user_id} deleted file {path}/{filename}")
+    return jsonify({'message': 'File deleted successfully'}), 200
+
+@app.before_request
+def start_background_tasks():
+    global change_listeners
+    if change_listeners is None and db is not None:
+        change_listeners = [ChangeListener(dsn, content_cache) for dsn in db.primary_dsns]
+    for listener in change_listeners or []:
+        listener.ensure_started()
+    upload_janitor.ensure_started()
+    blob_collector.ensure_started()
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for testing"""
     return jsonify({'status': 'healthy'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, merged across worker processes"""
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/stats/pool', methods=['GET'])
+def pool_stats():
+    """Database connection pool usage, for sizing DB_POOL_MIN/DB_POOL_MAX"""
+    if db is None:
+        return jsonify({'error': 'Database not initialized'}), 503
+    return jsonify(db.pool_stats()), 200
+
+@app.route('/stats/auth-cache', methods=['GET'])
+def auth_cache_stats():
+    """Authorization decision cache hit/miss counters"""
+    stats = auth_cache.stats()
+    stats['revoked_tokens'] = len(revocations)
+    return jsonify(stats), 200
+
+@app.route('/stats/content-cache', methods=['GET'])
+def content_cache_stats():
+    """Hot-file cache hit ratio, resident bytes and evictions"""
+    return jsonify(content_cache.stats()), 200
+
+def create_app(dsn=None):
+    """App factory (gunicorn: 'app:create_app()').
+    
+    Safe to call before forking: pooled connections, background threads and
+    the change listener are all started lazily in the process that uses them.
+    """
+    global db
+    if db is None:
+        db = RoutingStorageDB.from_env(dsn or os.environ.get('DATABASE_DSN', 'postgresql://postgres:password@db:5432/file_storage'))
+        REGISTRY.on_collect(export_pool_stats)
+    return app
+
+def export_pool_stats():
+    stats = db.pool_stats()
+    for state in ('in_use', 'idle', 'waiting'):
+        POOL_CONNECTIONS.labels(state).set(stats[state])
+
+def init_worker():
+    """Per-process setup, run in each server worker after fork"""
+    global auth_http
+    # Never share keep-alive sockets to the auth service with the parent
+    auth_http = make_auth_session()
+    if db is not None:
+        try:
+            db.fill_pools()
+        except Exception as e:
+            logger.warning(f"Could not pre-open database connections: {str(e)}")
+
+def shutdown():
+    """Close pooled connections when a worker exits"""
+    auth_http.close()
+    if db is not None:
+        db.close()
+    REGISTRY.flush(final=True)
+
 if __name__ == '__main__':
-    dsn = os.environ.get('DATABASE_DSN', 'postgresql://postgres:password@db:5432/file_storage')
-    db = StorageDB(dsn)
+    create_app()
     
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
     
     logger.info(f"Starting storage service on {host}:{port}")
-    app.run(host=host, port=port, debug=False)
\ No newline at end of file
+    app.run(host=host, port=port, debug=False)
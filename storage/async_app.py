@@ -0,0 +1,588 @@
+"""asyncio serving mode for the storage service.
+
+Serves the /login, /list, /get, /put and /health contract of app.py on
+aiohttp, with asyncpg for the database and one keep-alive HTTP client pool
+to the auth service, so a process can hold many slow clients without a
+thread each. The Flask app in app.py remains the reference (sync) mode.
+
+    python async_app.py
+"""
+import os
+import json
+import base64
+import time
+import asyncio
+import logging
+import datetime
+import mimetypes
+from email.utils import format_datetime, parsedate_to_datetime
+
+import jwt
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError
+from aiohttp.helpers import content_disposition_header
+
+from models import StorageDB, PreconditionFailed
+from db_pool import ConnectionPool
+from async_models import AsyncStorageDB
+from routing import split_dsns
+from auth_cache import DecisionCache, BackgroundPoller
+from capabilities import has_grants, evaluate_grants
+from revocation import RevocationList
+from content_cache import ContentCache, ChangeListener
+from compression import accepts_encoding
+from metrics import (REGISTRY, REQUEST_ID_HEADER, CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_IN_FLIGHT,
+                     RequestIdFilter, current_request_id, request_id_from, observe_request)
+
+# Configure logging first
+log_handler = logging.StreamHandler()
+log_handler.addFilter(RequestIdFilter())
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+    handlers=[log_handler]
+)
+
+logger = logging.getLogger('storage_service')
+
+# Configuration
+SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')
+AUTH_SERVICE_URL = os.environ.get('AUTH_SERVICE_URL', 'http://auth:5001')
+AUTH_HTTP_POOL = int(os.environ.get('AUTH_HTTP_POOL', 100))
+AUTH_SYNC_INTERVAL = float(os.environ.get('AUTH_SYNC_INTERVAL', 5))
+UPLOAD_SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+BLOB_GC_GRACE = float(os.environ.get('BLOB_GC_GRACE', 3600))
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 1000))
+LIST_PAGE_MAX = int(os.environ.get('LIST_PAGE_MAX', 10000))
+LIST_FIELDS = {'size': 'size', 'hash': 'blob_hash', 'updated_at': 'updated_at'}
+AUTH_CHECK_SECONDS = REGISTRY.histogram(
+    'storage_auth_check_seconds', 'Authorization latency by where the decision came from', ('source',))
+CONTENT_BYTES = REGISTRY.counter('storage_content_bytes_total', 'File content bytes served and stored', ('direction',))
+
+# Application state
+DSN = web.AppKey('dsn', str)
+AUTH_SYNC = web.AppKey('auth_sync', asyncio.Future)
+MAINTENANCE_DB = web.AppKey('maintenance_db', StorageDB)
+
+db = None
+auth_http = None
+auth_cache = DecisionCache.from_env()
+revocations = RevocationList()
+content_cache = ContentCache.from_env()
+
+def error_response(message, status):
+    return web.json_response({'error': message}, status=status)
+
+def auth_headers():
+    """Headers for auth service calls made on behalf of the current request"""
+    request_id = current_request_id.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id is not None else None
+
+def bearer_token(request):
+    return request.headers.get('Authorization', '').replace('Bearer ', '')
+
+def decode_token(token):
+    """Verify token signature, expiry and revocation, returning its claims"""
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"Invalid token: {str(e)}")
+        return None
+    if revocations.is_revoked(claims.get('jti')):
+        logger.warning(f"Revoked token presented by user {claims.get('user_id')}")
+        return None
+    return claims
+
+async def sync_with_auth():
+    """Pull permission version changes and token revocations from the auth service"""
+    while True:
+        try:
+            params = {'since': auth_cache.sync_cursor}
+            async with auth_http.get(f"{AUTH_SERVICE_URL}/permissions/version", params=params) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    users = result.get('users')
+                    if users is not None:
+                        users = {int(user_id): version for user_id, version in users.items()}
+                    auth_cache.observe_versions(result.get('version'), users, result.get('cursor'))
+            async with auth_http.get(f"{AUTH_SERVICE_URL}/tokens/revoked",
+                                     params={'since': revocations.cursor}) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    revocations.apply(result.get('cursor', 0),
+                                      [(r['jti'], r['exp']) for r in result.get('revoked', [])])
+        except (ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"auth-sync poll failed: {str(e)}")
+        await asyncio.sleep(AUTH_SYNC_INTERVAL)
+
+async def check_auth(request, token, path, operation, claims):
+    """Check authorization: token grants, then the decision cache, then the auth service"""
+    started = time.perf_counter()
+    decided = local_decision(request, path, operation, claims)
+    if decided is not None:
+        AUTH_CHECK_SECONDS.labels('local').observe(time.perf_counter() - started)
+        return decided
+    try:
+        return await authorize_remote(token, path, operation, claims)
+    finally:
+        AUTH_CHECK_SECONDS.labels('remote').observe(time.perf_counter() - started)
+
+def local_decision(request, path, operation, claims):
+    """Decide from capability grants or the decision cache; None if auth must be asked"""
+    user_id = claims.get('user_id')
+
+    if has_grants(claims):
+        # Unknown versions (not synced yet, or evicted) are treated as stale
+        known_version = auth_cache.known_version(user_id)
+        if known_version is not None and claims.get('pv', 0) >= known_version:
+            return evaluate_grants(claims['grants'], path, operation)
+        if known_version is not None:
+            logger.info(f"Token grants for user {user_id} are stale (pv {claims.get('pv')} < {known_version})")
+            request['token_refresh_required'] = True
+
+    if auth_cache.enabled:
+        return auth_cache.get(user_id, path, operation)
+    return None
+
+async def authorize_remote(token, path, operation, claims):
+    """Ask the auth service, caching its answer"""
+    user_id = claims.get('user_id')
+    try:
+        async with auth_http.post(
+            f"{AUTH_SERVICE_URL}/authorize",
+            json={'token': token, 'path': path, 'operation': operation},
+            headers=auth_headers()
+        ) as response:
+            if response.status not in (200, 403):
+                return False
+            result = await response.json()
+            authorized = bool(result.get('authorized', False)) and response.status == 200
+            auth_cache.put(user_id, path, operation, authorized,
+                           token_exp=claims.get('exp'),
+                           version=result.get('permissions_version'))
+            return authorized
+    except (ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Auth service error: {str(e)}")
+        return False
+
+async def authenticate(request):
+    """(token, claims, user_id) for the request's Bearer token, or raise an error response"""
+    token = bearer_token(request)
+    if not token:
+        raise web.HTTPUnauthorized(text=json.dumps({'error': 'Bearer token required'}),
+                                   content_type='application/json')
+    claims = decode_token(token)
+    user_id = claims.get('user_id') if claims else None
+    if not user_id:
+        raise web.HTTPUnauthorized(text=json.dumps({'error': 'Invalid token'}),
+                                   content_type='application/json')
+    return token, claims, user_id
+
+@web.middleware
+async def request_metrics(request, handler):
+    """Request ID, in-flight gauge and latency histograms (see metrics.WSGIMetrics)"""
+    REGISTRY.ensure_started()
+    request['request_id'] = request_id_from(request.headers.get(REQUEST_ID_HEADER))
+    token = current_request_id.set(request['request_id'])
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    started = time.perf_counter()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        # Streamed responses are complete when the handler returns
+        observe_request(request.method, route, status, started, time.perf_counter(), 0)
+        current_request_id.reset(token)
+
+async def add_token_refresh_header(request, response):
+    if request.get('token_refresh_required'):
+        response.headers['X-Token-Refresh'] = 'required'
+    if request.get('request_id'):
+        response.headers[REQUEST_ID_HEADER] = request['request_id']
+
+async def login(request):
+    """Login endpoint that forwards to auth service"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'username' not in data or 'password' not in data:
+        logger.warning("Login attempt missing username or password")
+        return error_response('Username and password required', 400)
+
+    logger.info(f"Login attempt for user: {data.get('username')}")
+    try:
+        async with auth_http.post(f"{AUTH_SERVICE_URL}/authenticate", json=data,
+                                  headers=auth_headers()) as response:
+            logger.info(f"Login response status: {response.status}")
+            return web.json_response(await response.json(), status=response.status)
+    except (ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Auth service connection error: {str(e)}")
+        return error_response('Authentication service unavailable', 503)
+
+def encode_list_cursor(path, filename):
+    raw = json.dumps([path, filename], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_list_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        path, filename = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(path, str) or not isinstance(filename, str):
+        return None
+    return path, filename
+
+async def list_files(request):
+    """List files in a path, one page at a time (same parameters as the sync /list)"""
+    path = request.query.get('path', '')
+    recursive = request.query.get('recursive', '').lower() in ('1', 'true', 'yes')
+    token, claims, user_id = await authenticate(request)
+    if not path:
+        return error_response('Path parameter required', 400)
+
+    try:
+        limit = int(request.query.get('limit', LIST_PAGE_SIZE))
+    except ValueError:
+        return error_response('limit must be an integer', 400)
+    if limit < 1:
+        return error_response('limit must be positive', 400)
+    limit = min(limit, LIST_PAGE_MAX)
+
+    after = None
+    cursor = request.query.get('cursor')
+    if cursor:
+        after = decode_list_cursor(cursor)
+        if after is None:
+            return error_response('Invalid cursor', 400)
+
+    fields = [field for field in request.query.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in LIST_FIELDS]
+    if unknown:
+        return error_response(f"Unknown fields: {', '.join(unknown)}", 400)
+
+    if not await check_auth(request, token, path, 'read', claims):
+        logger.warning(f"User {user_id} denied read access to path {path}")
+        return error_response('Access denied', 403)
+
+    def entry(row):
+        if not fields and not recursive:
+            return row['filename']
+        item = {'path': row['path'], 'filename': row['filename']} if recursive else {'filename': row['filename']}
+        for field in fields:
+            value = row[LIST_FIELDS[field]]
+            item[field] = value.isoformat() if isinstance(value, datetime.datetime) else value
+        return item
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    await response.prepare(request)
+    await response.write(('{"path": %s, "files": [' % json.dumps(path)).encode('utf-8'))
+    allowed = {path: True}
+    count = returned = 0
+    last = None
+    more = False
+    rows = db.iter_listing(path, after, limit + 1, recursive)
+    try:
+        async for row in rows:
+            if count == limit:
+                more = True
+                break
+            count += 1
+            last = (row['path'], row['filename'])
+            if row['path'] not in allowed:
+                allowed[row['path']] = await check_auth(request, token, row['path'], 'read', claims)
+            if not allowed[row['path']]:
+                continue
+            await response.write(((', ' if returned else '') + json.dumps(entry(row))).encode('utf-8'))
+            returned += 1
+    finally:
+        await rows.aclose()
+    next_cursor = encode_list_cursor(*last) if more else None
+    await response.write(('], "next_cursor": %s}' % json.dumps(next_cursor)).encode('utf-8'))
+    await response.write_eof()
+    logger.info(f"User {user_id} listed {returned} files in {path} (recursive: {recursive})")
+    return response
+
+def http_timestamp(value):
+    """Database timestamps are naive UTC; HTTP dates are whole seconds"""
+    if value is None:
+        return None
+    return value.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+
+def parse_http_date(value):
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+def parse_etags(value, weak=True):
+    """(star, set of opaque tags) from an If-Match / If-None-Match header"""
+    tags = set()
+    for part in (value or '').split(','):
+        part = part.strip()
+        if part == '*':
+            return True, set()
+        if part.startswith('W/'):
+            if not weak:
+                continue
+            part = part[2:]
+        if len(part) >= 2 and part[0] == part[-1] == '"':
+            tags.add(part[1:-1])
+    return False, tags
+
+def is_not_modified(request, etag, last_modified):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since for a GET"""
+    if 'If-None-Match' in request.headers:
+        star, tags = parse_etags(request.headers['If-None-Match'])
+        return star or (etag is not None and etag in tags)
+    since = parse_http_date(request.headers.get('If-Modified-Since'))
+    if since is not None and last_modified is not None:
+        return last_modified <= since
+    return False
+
+def if_range_matches(request, etag, last_modified):
+    """True unless an If-Range validator says the client's partial copy is stale"""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        _, tags = parse_etags(value, weak=False)
+        return etag is not None and etag in tags
+    date = parse_http_date(value)
+    return date is not None and last_modified is not None and date == last_modified
+
+def parse_range(value, size):
+    """(start, end) for a single byte range, None to serve the whole file, or False if unsatisfiable"""
+    if not value or not value.startswith('bytes='):
+        return None
+    specs = value[len('bytes='):].split(',')
+    if len(specs) != 1:
+        # Multi-range requests are answered with the whole file, as RFC 9110 allows
+        return None
+    first, sep, last = specs[0].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0 or size == 0:
+                return False
+            return max(size - length, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start < 0 or end <= start and last:
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size)
+
+def set_validators(response, etag, last_modified, weak=False):
+    if etag is not None:
+        response.headers['ETag'] = f'W/"{etag}"' if weak else f'"{etag}"'
+    if last_modified is not None:
+        response.headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+
+async def get_file(request):
+    """Get file content"""
+    path = request.query.get('path', '')
+    filename = request.query.get('filename', '')
+    token, claims, user_id = await authenticate(request)
+    if not path or not filename:
+        return error_response('Path and filename parameters required', 400)
+
+    if not await check_auth(request, token, path, 'read', claims):
+        logger.warning(f"User {user_id} denied read access to {path}/{filename}")
+        return error_response('Access denied', 403)
+
+    # Fills count from before the metadata read, so an invalidation that
+    # commits in between rejects them
+    started_at = content_cache.begin_fill()
+    cached = content_cache.get(path, filename) if content_cache.live else None
+    file_info = cached.info if cached is not None else await db.get_file_info(path, filename)
+    if file_info is None:
+        logger.info(f"File not found: {path}/{filename}")
+        return error_response('File not found', 404)
+
+    etag = file_info['blob_hash']
+    last_modified = http_timestamp(file_info['updated_at'])
+    if is_not_modified(request, etag, last_modified):
+        response = web.Response(status=304)
+        set_validators(response, etag, last_modified)
+        return response
+
+    if cached is None and not content_cache.live:
+        cached = content_cache.get(path, filename, file_info)
+
+    size = file_info['size'] or 0
+    start, end, status = 0, size, 200
+    if if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range is False:
+            response = error_response('Requested range not satisfiable', 416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        if byte_range is not None:
+            (start, end), status = byte_range, 206
+
+    codec = file_info['codec']
+    encoded = (cached is None and status == 200 and codec is not None
+               and accepts_encoding(request.headers.get('Accept-Encoding'), codec))
+
+    response = web.StreamResponse(status=status)
+    response.content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response.headers['Content-Disposition'] = content_disposition_header('attachment', quote_fields=False, filename=filename)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if encoded:
+        response.headers['Content-Encoding'] = codec
+        response.content_length = file_info['stored_size']
+    else:
+        response.content_length = end - start
+    if codec is not None:
+        response.headers['Vary'] = 'Accept-Encoding'
+    CONTENT_BYTES.labels('out').inc(response.content_length)
+    set_validators(response, etag, last_modified, weak=encoded)
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    await response.prepare(request)
+
+    logger.info(f"User {user_id} retrieved file {path}/{filename} bytes {start}-{end} (owned by user {file_info['user_id']}, cached: {cached is not None}, encoding: {codec if encoded else 'identity'})")
+    if cached is not None:
+        await response.write(cached.content[start:end])
+    elif encoded:
+        chunks = db.iter_stored_content(file_info)
+        try:
+            async for chunk in chunks:
+                await response.write(chunk)
+        finally:
+            await chunks.aclose()
+    else:
+        fill = status == 200 and content_cache.cacheable(file_info)
+        parts = []
+        chunks = db.iter_file_content(file_info, start, end)
+        try:
+            async for chunk in chunks:
+                if fill:
+                    parts.append(chunk)
+                await response.write(chunk)
+        finally:
+            await chunks.aclose()
+        if fill:
+            content_cache.put(path, filename, file_info, b''.join(parts), started_at)
+    await response.write_eof()
+    return response
+
+async def put_file(request):
+    """Store or update file"""
+    path = request.query.get('path', '')
+    filename = request.query.get('filename', '')
+    token, claims, user_id = await authenticate(request)
+    if not path or not filename:
+        return error_response('Path and filename parameters required', 400)
+
+    if not await check_auth(request, token, path, 'write', claims):
+        logger.warning(f"User {user_id} denied write access to {path}/{filename}")
+        return error_response('Access denied', 403)
+
+    # If-Match lets clients update without reading first; If-None-Match: * means create only
+    if_match = None
+    if 'If-Match' in request.headers:
+        star, tags = parse_etags(request.headers['If-Match'], weak=False)
+        if_match = ['*'] if star else list(tags)
+    if_none_match = parse_etags(request.headers.get('If-None-Match'))[0]
+
+    try:
+        stored = await db.put_file_stream(path, filename, request.content.iter_chunked(db.chunk_size),
+                                          user_id, if_match=if_match, if_none_match=if_none_match)
+    except PreconditionFailed as e:
+        logger.info(f"Conditional put rejected for user {user_id}: {str(e)}")
+        return error_response('Precondition failed', 412)
+
+    if stored is None:
+        logger.error(f"User {user_id} failed to store file {path}/{filename}")
+        return error_response('Failed to store file', 500)
+    CONTENT_BYTES.labels('in').inc(stored['size'])
+    logger.info(f"User {user_id} stored file {path}/{filename} ({stored['size']} bytes)")
+    response = web.json_response({'message': 'File stored successfully'})
+    response.headers['ETag'] = f'"{stored["hash"]}"'
+    return response
+
+async def health_check(request):
+    """Health check endpoint for testing"""
+    return web.json_response({'status': 'healthy'})
+
+async def metrics(request):
+    """Prometheus metrics, merged across worker processes"""
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+async def on_startup(app):
+    global db, auth_http
+    dsn = app[DSN]
+    db = AsyncStorageDB(dsn)
+    await db.open()
+    auth_http = ClientSession(
+        connector=TCPConnector(limit=AUTH_HTTP_POOL, keepalive_timeout=30),
+        timeout=ClientTimeout(total=5)
+    )
+    if AUTH_SYNC_INTERVAL > 0:
+        app[AUTH_SYNC] = asyncio.ensure_future(sync_with_auth())
+
+    # Maintenance and cache invalidation reuse the sync implementations on
+    # their own threads, with a small psycopg2 pool of their own.
+    maintenance_db = StorageDB(dsn, pool=ConnectionPool(dsn, min_size=0, max_size=2,
+                                                        logger_name='storage_service'))
+    app[MAINTENANCE_DB] = maintenance_db
+    BackgroundPoller(lambda: maintenance_db.cleanup_uploads(UPLOAD_SESSION_TTL),
+                     interval=float(os.environ.get('UPLOAD_CLEANUP_INTERVAL', 600)),
+                     logger=logger, name='upload-cleanup').ensure_started()
+    BackgroundPoller(lambda: maintenance_db.collect_garbage(BLOB_GC_GRACE),
+                     interval=float(os.environ.get('BLOB_GC_INTERVAL', 300)),
+                     logger=logger, name='blob-gc').ensure_started()
+    ChangeListener(dsn, content_cache).ensure_started()
+
+async def on_cleanup(app):
+    task = app.get(AUTH_SYNC)
+    if task is not None:
+        task.cancel()
+    await auth_http.close()
+    await db.close()
+    app[MAINTENANCE_DB].close()
+    REGISTRY.flush(final=True)
+
+def create_app(dsn=None):
+    # Files are not routed to shards here: serving one shard's database would
+    # miss every file on the others
+    shards = split_dsns(os.environ.get('DATABASE_SHARD_DSNS'))
+    if len(shards) > 1:
+        raise ValueError("The asyncio mode serves a single database; "
+                         "DATABASE_SHARD_DSNS lists several (use SERVER_MODE=gunicorn)")
+    app = web.Application(middlewares=[request_metrics])
+    app[DSN] = dsn or (shards[0] if shards else
+                         os.environ.get('DATABASE_DSN', 'postgresql://postgres:password@db:5432/file_storage'))
+    app.router.add_post('/login', login)
+    app.router.add_get('/list', list_files)
+    app.router.add_get('/get', get_file)
+    app.router.add_put('/put', put_file)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.on_response_prepare.append(add_token_refresh_header)
+    return app
+
+if __name__ == '__main__':
+    host = os.environ.get('HOST', '0.0.0.0')
+    port = int(os.environ.get('PORT', 5000))
+
+    logger.info(f"Starting storage service (asyncio) on {host}:{port}")
+    web.run_app(create_app(), host=host, port=port, access_log=None)
@@ -0,0 +1,375 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+from models import ContentChanged, PreconditionFailed, read_chunks
+from backends import create_backends
+from compression import Compressor, StreamDecoder
+from metrics import instrument_methods
+
+
+class AgedConnection(asyncpg.Connection):
+    """asyncpg connection that remembers when it was opened"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened_at = time.monotonic()
+
+
+class AsyncStorageDB:
+    """asyncpg counterpart of StorageDB for the asyncio serving mode.
+
+    Covers what /list, /get and /put need, against the same schema and with
+    the same blob reference counting, so both modes can serve one database
+    side by side. Blobs in the postgres backend are read and written with
+    asyncpg; filesystem blobs go through the backend on the default executor.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.logger = logging.getLogger('storage_service')
+        self.pool = None
+        self.chunk_size = int(os.environ.get('STORAGE_CHUNK_SIZE', 256 * 1024))
+        self.fetch_chunks = int(os.environ.get('STORAGE_FETCH_CHUNKS', 4))
+        self.spool_memory = int(os.environ.get('STORAGE_SPOOL_MEMORY', 1024 * 1024))
+        self.pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+        self.max_lifetime = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+        self.compressor = Compressor.from_env()
+        self.backends, self.backend = create_backends(self)
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+            max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+            max_inactive_connection_lifetime=float(os.environ.get('DB_POOL_MAX_INACTIVE', 300)),
+            connection_class=AgedConnection,
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    @asynccontextmanager
+    async def get_connection(self):
+        """Borrow a pooled connection (async with).
+
+        As in db_pool, a connection older than max_lifetime is retired when it
+        is returned; closing it hands its slot back for a fresh connection.
+        """
+        async with self.pool.acquire(timeout=self.pool_timeout) as conn:
+            yield conn
+            if self.max_lifetime and time.monotonic() - conn.opened_at > self.max_lifetime \
+                    and not conn.is_in_transaction():
+                await conn.close()
+
+    def pool_stats(self):
+        return {
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+            'min_size': self.pool.get_min_size(),
+            'max_size': self.pool.get_max_size(),
+        }
+
+    async def _in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def iter_listing(self, path, after=None, limit=1000, recursive=False):
+        """Same rows and order as StorageDB.iter_listing, through an asyncpg cursor"""
+        params = [path, limit]
+        if recursive:
+            prefix = path if path.endswith('/') else path + '/'
+            params += [prefix[:-1] + '0', prefix]
+            where = """
+                (f.path COLLATE "C") >= $1 AND (f.path COLLATE "C") < $3
+                AND (f.path = $1 OR (f.path COLLATE "C") >= $4)
+            """
+            order = 'ORDER BY (f.path COLLATE "C"), (f.filename COLLATE "C")'
+            if after is not None:
+                where += ' AND ((f.path COLLATE "C"), (f.filename COLLATE "C")) > ($5, $6)'
+                params += [after[0], after[1]]
+        else:
+            where = "f.path = $1"
+            order = "ORDER BY f.filename"
+            if after is not None:
+                where += " AND f.filename > $3"
+                params.append(after[1])
+
+        async with self.get_connection() as conn:
+            async with conn.transaction():
+                query = f"""
+                    SELECT f.path, f.filename, f.user_id, f.size, f.blob_hash, f.updated_at
+                    FROM files f
+                    WHERE {where}
+                    {order}
+                    LIMIT $2
+                """
+                async for row in conn.cursor(query, *params, prefetch=min(limit, 1000)):
+                    yield row
+
+    async def get_file_info(self, path, filename):
+        """Get file metadata without reading its content"""
+        try:
+            async with self.get_connection() as conn:
+                row = await conn.fetchrow("""
+                    SELECT f.id, f.user_id, f.blob_hash, b.backend AS blob_backend,
+                           b.codec, b.stored_size, f.chunk_size, f.updated_at,
+                           COALESCE(f.size, octet_length(f.content)) AS size
+                    FROM files f
+                    LEFT JOIN blobs b ON b.hash = f.blob_hash
+                    WHERE f.path = $1 AND f.filename = $2
+                """, path, filename)
+                return dict(row) if row else None
+        except Exception as e:
+            self.logger.error(f"Get file info error: {str(e)}")
+            return None
+
+    async def iter_file_content(self, info, start=0, end=None):
+        """Yield bytes [start, end) of a file, reading only the chunks that overlap it"""
+        size = info['size'] or 0
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+
+        codec = info['codec'] if info['blob_hash'] is not None else None
+        if info['blob_hash'] is not None and info['blob_backend'] != 'postgres':
+            async for data in self._iter_local(info['blob_backend'], info['blob_hash'], start, end, codec):
+                yield data
+            return
+
+        if info['blob_hash'] is not None:
+            query = """
+                SELECT byte_offset, data
+                FROM blob_chunks
+                WHERE blob_hash = $1
+                  AND byte_offset >= (
+                      SELECT COALESCE(MAX(byte_offset), 0)
+                      FROM blob_chunks
+                      WHERE blob_hash = $1 AND byte_offset <= $2
+                  )
+                  AND byte_offset < $3
+                ORDER BY byte_offset
+            """
+            params = (info['blob_hash'], start, end)
+        elif info['chunk_size'] is not None:
+            # Pre-blob chunked row, pinned to the version get_file_info read
+            # (ContentChanged is raised below if it has been overwritten)
+            query = """
+                SELECT c.byte_offset, c.data
+                FROM file_chunks c
+                JOIN files f ON f.id = c.file_id AND f.updated_at = $4
+                WHERE c.file_id = $1
+                  AND c.byte_offset >= (
+                      SELECT COALESCE(MAX(byte_offset), 0)
+                      FROM file_chunks
+                      WHERE file_id = $1 AND byte_offset <= $2
+                  )
+                  AND c.byte_offset < $3
+                ORDER BY c.byte_offset
+            """
+            params = (info['id'], start, end, info['updated_at'])
+        else:
+            # Legacy row with inline content: slice it server-side
+            async with self.get_connection() as conn:
+                for offset in range(start, end, self.chunk_size):
+                    data = await conn.fetchval(
+                        "SELECT substring(content FROM $1 FOR $2) FROM files WHERE id = $3",
+                        offset + 1, min(self.chunk_size, end - offset), info['id']
+                    )
+                    if not data:
+                        raise ContentChanged(f"File {info['id']} changed after {offset} of {end} bytes were read")
+                    yield data
+            return
+
+        position = start
+        async with self.get_connection() as conn:
+            async with conn.transaction():
+                async for byte_offset, data in conn.cursor(query, *params, prefetch=self.fetch_chunks):
+                    if codec is not None:
+                        # Each stored chunk is a complete member: decode just this one
+                        data = StreamDecoder(codec).decode(data)
+                    low = max(start - byte_offset, 0)
+                    high = min(end - byte_offset, len(data))
+                    position = byte_offset + high
+                    yield data[low:high] if low or high < len(data) else data
+        if position < end:
+            raise ContentChanged(f"File {info['id']} changed after {position} of {end} bytes were read")
+
+    async def iter_stored_content(self, info):
+        """Yield an encoded blob's bytes as stored, for clients that accept its codec"""
+        if info['blob_backend'] != 'postgres':
+            async for data in self._iter_local(info['blob_backend'], info['blob_hash'], 0, info['stored_size']):
+                yield data
+            return
+        async with self.get_connection() as conn:
+            async with conn.transaction():
+                async for (data,) in conn.cursor(
+                        "SELECT data FROM blob_chunks WHERE blob_hash = $1 ORDER BY seq",
+                        info['blob_hash'], prefetch=self.fetch_chunks):
+                    yield data
+
+    async def _iter_local(self, backend_name, blob_hash, start, end, codec=None):
+        f = await self._in_executor(open, self.backends[backend_name].local_path(blob_hash), 'rb')
+        try:
+            if codec is not None:
+                # Encoded files have no offset index: decode from the start and skip
+                decoder = StreamDecoder(codec)
+                offset = 0
+                while offset < end:
+                    data = await self._in_executor(f.read, self.chunk_size)
+                    if not data:
+                        return
+                    data = decoder.decode(data)
+                    low = max(start - offset, 0)
+                    high = min(end - offset, len(data))
+                    offset += len(data)
+                    if low < high:
+                        yield data[low:high]
+                return
+            await self._in_executor(f.seek, start)
+            remaining = end - start
+            while remaining > 0:
+                data = await self._in_executor(f.read, min(self.chunk_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+        finally:
+            await self._in_executor(f.close)
+
+    async def spool(self, chunks):
+        """Copy an async iterable of bytes to a spooled temp file, hashing it.
+
+        Once the spool rolls over its writes hit the disk, so hashing and
+        writing run on the executor, a chunk_size buffer at a time.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+        digest = hashlib.sha256()
+
+        def write(data):
+            digest.update(data)
+            spool.write(data)
+
+        size = 0
+        buffer = bytearray()
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                if len(buffer) >= self.chunk_size:
+                    data, buffer = buffer, bytearray()
+                    await self._in_executor(write, data)
+            await self._in_executor(write, buffer)
+            await self._in_executor(spool.seek, 0)
+        except BaseException:
+            spool.close()
+            raise
+        return spool, digest.hexdigest(), size
+
+    async def _acquire_blob(self, conn, blob_hash, size):
+        row = await conn.fetchrow("""
+            INSERT INTO blobs (hash, size, refcount, backend)
+            VALUES ($1, $2, 1, $3)
+            ON CONFLICT (hash)
+            DO UPDATE SET refcount = blobs.refcount + 1, released_at = NULL
+            RETURNING (xmax = 0) AS inserted, backend
+        """, blob_hash, size, self.backend.name)
+        backend = self.backends[row['backend']]
+        if row['inserted']:
+            return backend, True
+        if backend.name == 'postgres':
+            return backend, False
+        return backend, not await self._in_executor(backend.has, blob_hash)
+
+    async def _write_blob(self, conn, backend, blob_hash, spool, size):
+        # Sampling and compression are CPU work, so they run on the executor
+        codec = await self._in_executor(self.compressor.choose, spool, size)
+        if backend.name != 'postgres':
+            stored = await self._in_executor(backend.write, None, blob_hash, spool, codec)
+        else:
+            chunks = read_chunks(spool, self.chunk_size)
+            seq = offset = stored = 0
+            while True:
+                # Reading a rolled-over spool is disk IO as well
+                chunk = await self._in_executor(next, chunks, None)
+                if chunk is None:
+                    break
+                data = chunk if codec is None else await self._in_executor(self.compressor.encode, codec, chunk)
+                await conn.execute(
+                    "INSERT INTO blob_chunks (blob_hash, seq, byte_offset, data) VALUES ($1, $2, $3, $4)",
+                    blob_hash, seq, offset, data
+                )
+                seq += 1
+                offset += len(chunk)
+                stored += len(data)
+        await conn.execute(
+            "UPDATE blobs SET codec = $1, stored_size = $2 WHERE hash = $3",
+            codec, stored, blob_hash
+        )
+
+    async def _release_blob(self, conn, blob_hash):
+        await conn.execute("""
+            UPDATE blobs
+            SET refcount = refcount - 1,
+                released_at = CASE WHEN refcount <= 1 THEN CURRENT_TIMESTAMP END
+            WHERE hash = $1
+        """, blob_hash)
+
+    async def put_file_stream(self, path, filename, chunks, user_id, if_match=None, if_none_match=False):
+        """Store or update a file from an async iterable of bytes.
+
+        Same contract as StorageDB.put_file_stream: returns {'size', 'hash'},
+        None on failure, and raises PreconditionFailed.
+        """
+        try:
+            spool, blob_hash, size = await self.spool(chunks)
+            with spool:
+                async with self.get_connection() as conn:
+                    async with conn.transaction():
+                        created = await conn.fetchval("""
+                            INSERT INTO files (path, filename, user_id)
+                            VALUES ($1, $2, $3)
+                            ON CONFLICT (path, filename) DO NOTHING
+                            RETURNING id
+                        """, path, filename, user_id)
+                        file_id, previous = await conn.fetchrow("""
+                            SELECT id, blob_hash FROM files
+                            WHERE path = $1 AND filename = $2
+                            FOR UPDATE
+                        """, path, filename)
+                        existed = created is None
+                        if if_none_match and existed:
+                            raise PreconditionFailed(f"{path}/{filename} already exists")
+                        if if_match is not None and not (
+                                existed and ('*' in if_match or previous in if_match)):
+                            raise PreconditionFailed(f"{path}/{filename} does not match {if_match}")
+
+                        backend, needs_content = await self._acquire_blob(conn, blob_hash, size)
+                        if needs_content:
+                            await self._write_blob(conn, backend, blob_hash, spool, size)
+                        else:
+                            self.logger.info(f"Deduplicated {path}/{filename} onto existing blob {blob_hash[:12]}")
+                        await conn.execute("""
+                            UPDATE files
+                            SET blob_hash = $1, size = $2, user_id = $3, content = NULL, chunk_size = NULL,
+                                updated_at = CURRENT_TIMESTAMP
+                            WHERE id = $4
+                        """, blob_hash, size, user_id, file_id)
+                        await conn.execute("DELETE FROM file_chunks WHERE file_id = $1", file_id)
+                        if previous is not None:
+                            await self._release_blob(conn, previous)
+                    return {'size': size, 'hash': blob_hash}
+        except PreconditionFailed:
+            raise
+        except Exception as e:
+            self.logger.error(f"Put file error: {str(e)}")
+            return None
+
+
+instrument_methods(AsyncStorageDB, exclude=('open', 'close', 'get_connection', 'pool_stats'))
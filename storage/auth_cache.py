@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class DecisionCache:
+    """Bounded TTL + LRU cache of (user_id, path, operation) -> authorized.
+
+    Grants live for ttl seconds and denials for deny_ttl seconds, and no entry
+    outlives the expiry of the token that produced it. Entries are also
+    dropped when the auth service reports a new permissions version for their
+    user, either piggybacked on /authorize responses or polled.
+
+    The latest version of up to max_users users is kept (LRU) so token grants
+    can be checked for staleness. A user whose version is unknown, because
+    nothing has been synced yet or they were evicted, counts as stale.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30.0, deny_ttl=5.0, max_users=100000):
+        self.max_entries = max_entries
+        self.max_users = max_users
+        self.ttl = ttl
+        self.deny_ttl = deny_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (authorized, expires_at)
+        self._user_versions = OrderedDict()  # user_id -> version
+        self._global_version = None
+        self._sync_cursor = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.environ.get('AUTH_CACHE_SIZE', 10000)),
+            ttl=float(os.environ.get('AUTH_CACHE_TTL', 30)),
+            deny_ttl=float(os.environ.get('AUTH_CACHE_DENY_TTL', 5)),
+            max_users=int(os.environ.get('AUTH_CACHE_USERS', 100000)),
+        )
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, user_id, path, operation):
+        """Cached decision, or None on a miss"""
+        key = (user_id, path, operation)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, user_id, path, operation, authorized, token_exp=None, version=None):
+        if version is not None:
+            with self._lock:
+                self._observe_user_version(user_id, version)
+        if not self.enabled:
+            return
+        now = time.time()
+        expires_at = now + (self.ttl if authorized else self.deny_ttl)
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._entries[(user_id, path, operation)] = (authorized, expires_at)
+            self._entries.move_to_end((user_id, path, operation))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _observe_user_version(self, user_id, version):
+        known = self._user_versions.get(user_id)
+        if known is not None and version < known:
+            return
+        if known != version:
+            stale = [key for key in self._entries if key[0] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self._invalidations += 1
+        self._user_versions[user_id] = version
+        self._user_versions.move_to_end(user_id)
+        while len(self._user_versions) > self.max_users:
+            self._user_versions.popitem(last=False)
+
+    def observe_versions(self, version, users=None, cursor=None):
+        """Apply a permissions version poll from the auth service.
+
+        users maps user_id -> version for everyone changed since the poll
+        cursor; only their entries are dropped, and a change seen twice is a
+        no-op. Without it, any movement of the global stamp drops everything
+        (forgotten users are then stale, never fresh).
+        """
+        with self._lock:
+            if users is not None:
+                for user_id, user_version in users.items():
+                    self._observe_user_version(user_id, user_version)
+            elif self._global_version is not None and version != self._global_version:
+                self._entries.clear()
+                self._user_versions.clear()
+                self._invalidations += 1
+            self._global_version = version
+            if cursor is not None:
+                self._sync_cursor = max(self._sync_cursor, cursor)
+
+    @property
+    def global_version(self):
+        return self._global_version
+
+    @property
+    def sync_cursor(self):
+        """Cursor to send as `since` on the next poll (0 polls every user)"""
+        return self._sync_cursor
+
+    def known_version(self, user_id):
+        """Latest permissions version seen for user_id, or None if unknown"""
+        with self._lock:
+            version = self._user_versions.get(user_id)
+            if version is not None:
+                self._user_versions.move_to_end(user_id)
+            return version
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._user_versions.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == user_id]:
+                    del self._entries[key]
+                self._user_versions.pop(user_id, None)
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'users_tracked': len(self._user_versions),
+                'permissions_version': self._global_version,
+            }
+
+
+class BackgroundPoller:
+    """Daemon thread calling poll() every interval seconds, started once per process"""
+
+    def __init__(self, poll, interval, logger, name='auth-sync'):
+        self.poll = poll
+        self.interval = interval
+        self.logger = logger
+        self.name = name
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the poller in this process (safe to call on every request)"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.warning(f"{self.name} poll failed: {str(e)}")
+            time.sleep(self.interval)
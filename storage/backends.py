@@ -0,0 +1,203 @@
+import os
+import logging
+import tempfile
+
+from compression import decode_chunks, slice_chunks
+
+
+class IterStream:
+    """Minimal read()-able file object over an iterator of byte strings"""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class PostgresBackend:
+    """Blob content as BYTEA rows in blob_chunks (the default backend)"""
+
+    name = 'postgres'
+
+    def __init__(self, db):
+        self.db = db
+
+    def has(self, blob_hash):
+        # Chunks are written in the same transaction as the blobs row
+        return True
+
+    def write(self, conn, blob_hash, stream, codec=None):
+        """Store stream, each chunk encoded with codec if given; returns bytes stored"""
+        encode = (lambda data: self.db.compressor.encode(codec, data)) if codec else None
+        with conn.cursor() as cur:
+            return self.db._write_chunks(
+                cur,
+                "INSERT INTO blob_chunks (blob_hash, seq, byte_offset, data) VALUES (%s, %s, %s, %s)",
+                (blob_hash,),
+                stream,
+                encode
+            )
+
+    def iter_range(self, blob_hash, start, end, codec=None):
+        # byte_offset is always the offset in the decoded content, and every
+        # encoded chunk decodes on its own, so ranges only touch the chunks they overlap
+        with self.db.get_connection() as conn:
+            with conn.cursor(name=f"blob_{blob_hash[:16]}") as cur:
+                cur.itersize = self.db.fetch_chunks
+                cur.execute("""
+                    SELECT byte_offset, data
+                    FROM blob_chunks
+                    WHERE blob_hash = %(key)s
+                      AND byte_offset >= (
+                          SELECT COALESCE(MAX(byte_offset), 0)
+                          FROM blob_chunks
+                          WHERE blob_hash = %(key)s AND byte_offset <= %(start)s
+                      )
+                      AND byte_offset < %(end)s
+                    ORDER BY byte_offset
+                """, {'key': blob_hash, 'start': start, 'end': end})
+                for byte_offset, data in cur:
+                    data = bytes(data)
+                    if codec is not None:
+                        data = b''.join(decode_chunks(codec, [data]))
+                    low = max(start - byte_offset, 0)
+                    high = min(end - byte_offset, len(data))
+                    yield data[low:high] if low or high < len(data) else data
+
+    def iter_stored(self, blob_hash):
+        """Yield the blob's bytes as stored (still encoded)"""
+        with self.db.get_connection() as conn:
+            with conn.cursor(name=f"stored_{blob_hash[:16]}") as cur:
+                cur.itersize = self.db.fetch_chunks
+                cur.execute(
+                    "SELECT data FROM blob_chunks WHERE blob_hash = %s ORDER BY seq",
+                    (blob_hash,)
+                )
+                for (data,) in cur:
+                    yield bytes(data)
+
+    def local_path(self, blob_hash):
+        return None
+
+    def delete(self, blob_hash):
+        # blob_chunks rows go with the blobs row (ON DELETE CASCADE)
+        pass
+
+
+class FilesystemBackend:
+    """Blob content as files in a sharded directory tree (root/ab/cd/<hash>).
+
+    Files are written to root/tmp and renamed into place, so a blob path is
+    either absent or complete. Postgres keeps only the metadata, and downloads
+    can be served straight from disk with sendfile.
+    """
+
+    name = 'filesystem'
+
+    def __init__(self, db, root):
+        self.db = db
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.logger = logging.getLogger('storage_service')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def _path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def has(self, blob_hash):
+        return os.path.exists(self._path(blob_hash))
+
+    def write(self, conn, blob_hash, stream, codec=None):
+        """Store stream, each chunk encoded with codec if given; returns bytes stored"""
+        target = self._path(blob_hash)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, prefix=blob_hash[:16])
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = stream.read(self.db.chunk_size)
+                    if not data:
+                        break
+                    if codec is not None:
+                        data = self.db.compressor.encode(codec, data)
+                    f.write(data)
+                    size += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, target)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return size
+
+    def iter_range(self, blob_hash, start, end, codec=None):
+        if codec is not None:
+            # Encoded files have no offset index: decode from the start and skip
+            yield from slice_chunks(decode_chunks(codec, self.iter_stored(blob_hash)), start, end)
+            return
+        with open(self._path(blob_hash), 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(self.db.chunk_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+    def iter_stored(self, blob_hash):
+        """Yield the blob's bytes as stored (still encoded)"""
+        with open(self._path(blob_hash), 'rb') as f:
+            while True:
+                data = f.read(self.db.chunk_size)
+                if not data:
+                    return
+                yield data
+
+    def local_path(self, blob_hash):
+        return self._path(blob_hash)
+
+    def delete(self, blob_hash):
+        try:
+            os.unlink(self._path(blob_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning(f"Could not remove blob file {blob_hash}: {str(e)}")
+
+
+def filesystem_root():
+    """STORAGE_FS_ROOT, defaulted when the filesystem backend is configured; None if unused"""
+    if os.environ.get('STORAGE_BACKEND', PostgresBackend.name) == FilesystemBackend.name:
+        return os.environ.get('STORAGE_FS_ROOT', '/data/blobs')
+    return os.environ.get('STORAGE_FS_ROOT') or None
+
+
+def create_backends(db, fs_root=None):
+    """All backends, keyed by name, plus the one new blobs are written to.
+
+    fs_root overrides STORAGE_FS_ROOT (each shard keeps its own blob files).
+    """
+    backends = {PostgresBackend.name: PostgresBackend(db)}
+    configured = os.environ.get('STORAGE_BACKEND', PostgresBackend.name)
+    root = fs_root or filesystem_root()
+    if root:
+        backends[FilesystemBackend.name] = FilesystemBackend(db, root)
+    if configured not in backends:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {configured}")
+    return backends, backends[configured]
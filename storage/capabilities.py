@@ -0,0 +1,38 @@
+def candidate_paths(path):
+    """Paths whose grant can decide access to path, most specific first.
+
+    Same order as the auth service's resolver: the exact path string, then
+    each ancestor from deepest to shallowest, then "/".
+    """
+    parts = [part for part in path.split('/') if part]
+    candidates = [path]
+    for depth in range(len(parts), 0, -1):
+        ancestor = '/' + '/'.join(parts[:depth])
+        if ancestor not in candidates:
+            candidates.append(ancestor)
+    if '/' not in candidates:
+        candidates.append('/')
+    return candidates
+
+
+def has_grants(claims):
+    """True if the token carries an embedded grant list (capability token)"""
+    return isinstance(claims.get('grants'), list)
+
+
+def evaluate_grants(grants, path, operation):
+    """Authorize operation on path from [[path, can_read, can_write], ...] grants"""
+    if operation == 'read':
+        index = 1
+    elif operation == 'write':
+        index = 2
+    else:
+        return False
+    by_path = {}
+    for grant in grants:
+        by_path.setdefault(grant[0], grant)
+    for candidate in candidate_paths(path):
+        grant = by_path.get(candidate)
+        if grant is not None:
+            return bool(grant[index])
+    return False
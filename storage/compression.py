@@ -0,0 +1,170 @@
+import os
+import gzip
+import math
+import zlib
+import logging
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # optional: zstd is offered only when the package is installed
+    zstandard = None
+
+CODECS = ('gzip', 'zstd')
+
+
+def available_codecs():
+    return tuple(codec for codec in CODECS if codec != 'zstd' or zstandard is not None)
+
+
+def sample_entropy(data):
+    """Shannon entropy of data in bits per byte (0.0 - 8.0)"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def accepts_encoding(header, codec):
+    """True if an Accept-Encoding header value allows codec (q > 0)"""
+    if not header or codec is None:
+        return False
+    allowed = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        allowed[name.strip().lower()] = quality
+    aliases = {'gzip': ('gzip', 'x-gzip')}.get(codec, (codec,))
+    for name in aliases:
+        if name in allowed:
+            return allowed[name] > 0
+    return allowed.get('*', 0) > 0
+
+
+class StreamDecoder:
+    """Incremental decoder for a sequence of gzip members or zstd frames.
+
+    Stored blobs are a concatenation of independently compressed chunks, so
+    the decoder starts a fresh decompressor whenever one member ends.
+    """
+
+    def __init__(self, codec):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        if codec == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd content stored but the zstandard package is not installed")
+        self.codec = codec
+        self._decompressor = self._new()
+
+    def _new(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(wbits=31)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data):
+        out = []
+        while data:
+            out.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._new()
+        return b''.join(out)
+
+
+def decode_chunks(codec, chunks):
+    """Yield the decoded content of an iterable of stored chunks"""
+    decoder = StreamDecoder(codec)
+    for chunk in chunks:
+        data = decoder.decode(chunk)
+        if data:
+            yield data
+
+
+def slice_chunks(chunks, start, end):
+    """Yield bytes [start, end) of the content produced by chunks"""
+    offset = 0
+    for data in chunks:
+        if offset >= end:
+            return
+        low = max(start - offset, 0)
+        high = min(end - offset, len(data))
+        offset += len(data)
+        if low < high:
+            yield data[low:high] if low or high < len(data) else data
+
+
+class Compressor:
+    """Chooses and applies the codec for newly written blob content.
+
+    Content is compressed chunk by chunk into self-contained gzip members (or
+    zstd frames), so a stored blob is one valid compressed stream that can be
+    sent to clients as is, while ranged reads of postgres blobs only decode
+    the chunks they overlap. Small content, and content whose sampled byte
+    entropy says it is already compressed or encrypted, is stored as is.
+    """
+
+    def __init__(self, codec=None, level=None, min_size=1024, max_entropy=7.5, sample_size=64 * 1024):
+        self.logger = logging.getLogger('storage_service')
+        if codec in (None, '', 'none'):
+            codec = None
+        elif codec not in CODECS:
+            raise ValueError(f"Unknown STORAGE_COMPRESSION: {codec}")
+        elif codec not in available_codecs():
+            self.logger.warning(f"{codec} compression is not available here; falling back to gzip")
+            codec = 'gzip'
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self.max_entropy = max_entropy
+        self.sample_size = sample_size
+
+    @classmethod
+    def from_env(cls):
+        level = os.environ.get('STORAGE_COMPRESSION_LEVEL')
+        return cls(
+            codec=os.environ.get('STORAGE_COMPRESSION', 'none').lower(),
+            level=int(level) if level else None,
+            min_size=int(os.environ.get('STORAGE_COMPRESSION_MIN_SIZE', 1024)),
+            max_entropy=float(os.environ.get('STORAGE_COMPRESSION_MAX_ENTROPY', 7.5)),
+        )
+
+    @property
+    def enabled(self):
+        return self.codec is not None
+
+    def choose(self, spool, size):
+        """Codec to store a spooled body with, or None to store it as is.
+
+        Samples up to sample_size bytes in four windows spread over the body,
+        then rewinds the spool.
+        """
+        if not self.enabled or size < self.min_size:
+            return None
+        window = max(self.sample_size // 4, 1)
+        sample = bytearray()
+        for i in range(4):
+            spool.seek(max(min(size * i // 4, size - window), 0))
+            sample.extend(spool.read(window))
+            if size <= window:
+                break
+        spool.seek(0)
+        entropy = sample_entropy(bytes(sample))
+        if entropy > self.max_entropy:
+            return None
+        return self.codec
+
+    def encode(self, codec, data):
+        """One chunk as a self-contained member of codec's stream format"""
+        if codec == 'gzip':
+            return gzip.compress(data, compresslevel=6 if self.level is None else self.level, mtime=0)
+        if codec == 'zstd':
+            return zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+        raise ValueError(f"Unknown codec: {codec}")
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class CachedFile:
+    __slots__ = ('info', 'content')
+
+    def __init__(self, info, content):
+        self.info = info
+        self.content = content
+
+
+class ContentCache:
+    """Byte-budgeted LRU of whole small files, keyed by (path, filename).
+
+    Entries carry the metadata they were read with. While the change listener
+    is connected, invalidations arrive through Postgres NOTIFY and entries can
+    be served without touching the database. Otherwise an entry is only used
+    when it matches freshly queried metadata (same blob hash and updated_at).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_object=1024 * 1024, max_tracked=10000):
+        self.max_bytes = max_bytes
+        self.max_object = min(max_object, max_bytes)
+        self.listeners = []  # one ChangeListener per primary database
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CachedFile
+        self._bytes = 0
+        # Invalidation clock: fills that started before a key was invalidated are
+        # rejected, so a slow download can never re-insert stale content.
+        self._clock = 0
+        self._invalidated = OrderedDict()  # key -> clock
+        self._invalidated_floor = 0
+        self._max_tracked = max_tracked
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.environ.get('CONTENT_CACHE_BYTES', 64 * 1024 * 1024)),
+            max_object=int(os.environ.get('CONTENT_CACHE_MAX_OBJECT', 1024 * 1024)),
+        )
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def live(self):
+        """True while NOTIFY invalidation is connected, so entries need no revalidation"""
+        return self.enabled and bool(self.listeners) and all(listener.connected for listener in self.listeners)
+
+    def cacheable(self, info):
+        return self.enabled and (info['size'] or 0) <= self.max_object
+
+    def get(self, path, filename, info=None):
+        """Return a CachedFile, validated against info when given.
+
+        Without info, entries are only returned while NOTIFY invalidation is live.
+        """
+        if not self.enabled or (info is None and not self.live):
+            return None
+        key = (path, filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and info is not None and not self._same_version(entry.info, info):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    @staticmethod
+    def _same_version(cached, current):
+        return (cached['blob_hash'] is not None
+                and cached['blob_hash'] == current['blob_hash']
+                and cached['updated_at'] == current['updated_at'])
+
+    def begin_fill(self):
+        """Clock value to pass to put() for a fill that starts now"""
+        with self._lock:
+            return self._clock
+
+    def put(self, path, filename, info, content, started_at):
+        if not self.cacheable(info) or len(content) != (info['size'] or 0) or info['blob_hash'] is None:
+            return False
+        key = (path, filename)
+        with self._lock:
+            invalidated = self._invalidated.get(key)
+            if invalidated is not None and invalidated > started_at:
+                return False
+            if invalidated is None and self._invalidated_floor > started_at:
+                return False
+            self._remove(key)
+            self._entries[key] = CachedFile(info, content)
+            self._bytes += len(content)
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.content)
+                self._evictions += 1
+            return True
+
+    def tee(self, path, filename, info, chunks, started_at):
+        """Pass chunks through, caching the assembled file if it is read completely.
+
+        started_at must come from begin_fill() before info was read, so an
+        invalidation that lands in between rejects the fill.
+        """
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        self.put(path, filename, info, b''.join(parts), started_at)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.content)
+
+    def invalidate(self, path, filename):
+        key = (path, filename)
+        with self._lock:
+            self._clock += 1
+            self._invalidated[key] = self._clock
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self._max_tracked:
+                _, clock = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, clock)
+            if key in self._entries:
+                self._remove(key)
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._clock += 1
+            self._invalidated.clear()
+            self._invalidated_floor = self._clock
+            self._entries.clear()
+            self._bytes = 0
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes_resident': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_object': self.max_object,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'listener_connected': bool(self.listeners) and all(listener.connected for listener in self.listeners),
+            }
+
+
+class ChangeListener:
+    """LISTENs on files_changed and invalidates cache entries as writes commit.
+
+    Runs on its own (unpooled) connection in a daemon thread, started once per
+    process. Whenever the connection drops the cache is cleared, because
+    notifications may have been missed. Sharded storage runs one listener
+    per primary.
+    """
+
+    channel = 'files_changed'
+
+    def __init__(self, dsn, cache, poll_timeout=5.0):
+        self.dsn = dsn
+        self.cache = cache
+        self.poll_timeout = poll_timeout
+        self.connected = False
+        self.logger = logging.getLogger('storage_service')
+        self._pid = None
+        self._lock = threading.Lock()
+        cache.listeners.append(self)
+
+    def ensure_started(self):
+        if not self.cache.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.connected = False
+            thread = threading.Thread(target=self._run, name='files-changed-listener', daemon=True)
+            thread.start()
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                # Anything cached before LISTEN took effect may already be stale
+                self.cache.clear()
+                self.connected = True
+                backoff = 1.0
+                self.logger.info("Content cache listening for file changes")
+                while True:
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            change = json.loads(notify.payload)
+                            self.cache.invalidate(change['path'], change['filename'])
+                        except (ValueError, KeyError):
+                            self.cache.clear()
+            except Exception as e:
+                self.logger.warning(f"Content cache listener disconnected: {str(e)}")
+            finally:
+                self.connected = False
+                self.cache.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
@@ -0,0 +1,269 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from metrics import REGISTRY
+
+POOL_ACQUIRE_SECONDS = REGISTRY.histogram(
+    'db_pool_acquire_seconds', 'Time to check a connection out of the pool (including connecting)')
+POOL_CONNECT_SECONDS = REGISTRY.histogram(
+    'db_connect_seconds', 'Time to open a new database connection')
+POOL_TIMEOUTS = REGISTRY.counter('db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection')
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe, fork-aware PostgreSQL connection pool.
+
+    Connections are health checked on checkout, retired after max_lifetime
+    seconds and never shared across a fork: a child process that inherits the
+    pool drops the parent's sockets (without closing them) and starts fresh.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, max_lifetime=1800,
+                 timeout=5.0, check_idle=30.0, logger_name='db_pool'):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.logger = logging.getLogger(logger_name)
+        self._reset()
+
+    @classmethod
+    def from_env(cls, dsn, prefix='DB_POOL_', logger_name='db_pool'):
+        """Build a pool using DB_POOL_* environment variables for sizing"""
+        return cls(
+            dsn,
+            min_size=int(os.environ.get(f'{prefix}MIN', 1)),
+            max_size=int(os.environ.get(f'{prefix}MAX', 10)),
+            max_lifetime=float(os.environ.get(f'{prefix}MAX_LIFETIME', 1800)),
+            timeout=float(os.environ.get(f'{prefix}TIMEOUT', 5)),
+            check_idle=float(os.environ.get(f'{prefix}CHECK_IDLE', 30)),
+            logger_name=logger_name,
+        )
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()      # (conn, created_at, returned_at)
+        self._in_use = {}         # id(conn) -> (conn, created_at)
+        self._opening = 0
+        self._waiting = 0
+        self._closed = False
+        # Connections inherited from a parent process are kept referenced so
+        # that garbage collection never sends a Terminate over a shared socket.
+        self._orphans = getattr(self, '_orphans', [])
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            inherited = [entry[0] for entry in self._idle]
+            inherited.extend(entry[0] for entry in self._in_use.values())
+            self._orphans.extend(inherited)
+            self.logger.info(f"Fork detected, discarding {len(inherited)} inherited connections")
+            self._reset()
+
+    def _connect(self):
+        with POOL_CONNECT_SECONDS.time():
+            conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats['connections_discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, created_at, returned_at):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if self.check_idle is not None and now - returned_at >= self.check_idle:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                self.logger.warning(f"Pooled connection failed health check: {str(e)}")
+                return False
+        return True
+
+    def getconn(self):
+        """Check out a connection, waiting up to timeout seconds for one"""
+        self._check_fork()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            candidate = None
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                while True:
+                    if self._idle:
+                        candidate = self._idle.pop()
+                        break
+                    if len(self._in_use) + self._opening < self.max_size:
+                        self._opening += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        POOL_TIMEOUTS.inc()
+                        raise PoolTimeout(f"No connection available within {self.timeout}s")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if candidate is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+                with self._cond:
+                    self._opening -= 1
+                break
+
+            conn, created_at, returned_at = candidate
+            if self._is_healthy(conn, created_at, returned_at):
+                break
+            self._discard(conn)
+            with self._cond:
+                self._cond.notify()
+
+        waited = time.monotonic() - started
+        POOL_ACQUIRE_SECONDS.observe(waited)
+        with self._cond:
+            self._in_use[id(conn)] = (conn, created_at)
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a checked-out connection to the pool"""
+        self._check_fork()
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            # Checked out before a fork; this process does not own the socket.
+            self._orphans.append(conn)
+            return
+        created_at = entry[1]
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        expired = self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+        if discard or conn.closed or expired or self._closed:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, created_at, time.monotonic()))
+        with self._cond:
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; commit on success, roll back on error"""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard or conn.closed)
+
+    def fill(self):
+        """Open connections until the pool holds at least min_size"""
+        self._check_fork()
+        while True:
+            with self._cond:
+                total = len(self._idle) + len(self._in_use) + self._opening
+                if total >= self.min_size or self._closed:
+                    return
+                self._opening += 1
+            try:
+                conn = self._connect()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+            now = time.monotonic()
+            with self._cond:
+                self._idle.append((conn, now, now))
+                self._cond.notify()
+
+    def close(self):
+        """Close all idle connections; in-use ones are closed when returned"""
+        self._check_fork()
+        with self._cond:
+            self._closed = True
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Snapshot of pool usage for sizing and monitoring"""
+        self._check_fork()
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': len(self._idle) + len(self._in_use),
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': checkouts,
+                'connections_created': self._stats['connections_created'],
+                'connections_discarded': self._stats['connections_discarded'],
+                'timeouts': self._stats['timeouts'],
+                'wait_time_total_ms': round(self._stats['wait_time_total'] * 1000, 3),
+                'wait_time_avg_ms': round(self._stats['wait_time_total'] * 1000 / checkouts, 3) if checkouts else 0.0,
+                'wait_time_max_ms': round(self._stats['wait_time_max'] * 1000, 3),
+            }
@@ -0,0 +1,20 @@
+#!/bin/sh
+# SERVER_MODE: gunicorn (default, multi-process Flask), async (multi-process
+# aiohttp workers running async_app) or dev (single-process Werkzeug server)
+set -e
+
+case "${SERVER_MODE:-gunicorn}" in
+    gunicorn)
+        exec gunicorn -c gunicorn.conf.py 'app:create_app()'
+        ;;
+    async)
+        exec gunicorn -c gunicorn.conf.py --worker-class aiohttp.GunicornWebWorker 'async_app:create_app()'
+        ;;
+    dev)
+        exec python app.py
+        ;;
+    *)
+        echo "Unknown SERVER_MODE: ${SERVER_MODE}" >&2
+        exit 1
+        ;;
+esac
@@ -0,0 +1,538 @@
+"""Prometheus text-format metrics with no external dependencies.
+
+Counters, gauges and histograms live in one process-wide REGISTRY and cost
+a lock and an addition per update. When METRICS_DIR is set (gunicorn does
+this), each worker also writes a snapshot of its metrics there every few
+seconds, and /metrics on any worker merges them, so one scrape covers the
+whole service. Counters and histograms of exited workers are kept; gauges
+only count live ones.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import bisect
+import fcntl
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REQUEST_ID_HEADER = 'X-Request-ID'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request ID of the request being handled in this thread / task
+current_request_id = contextvars.ContextVar('request_id', default=None)
+_REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+
+def request_id_from(header_value):
+    """The caller's request ID if it is sane, else a fresh one"""
+    if header_value and _REQUEST_ID_PATTERN.fullmatch(header_value):
+        return header_value
+    return uuid.uuid4().hex
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds %(request_id)s to log records ('-' outside a request)"""
+
+    def filter(self, record):
+        record.request_id = current_request_id.get() or '-'
+        return True
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return self.counts + [self.sum]
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """The child series for these label values (in labelnames order)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets) if self.kind == 'histogram' else _Value()
+
+    def __getattr__(self, name):
+        # An unlabelled metric is its own single series: counter.inc(), histogram.observe()
+        if name in ('inc', 'dec', 'set', 'observe', 'time') and not self.labelnames:
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+    def snapshot(self):
+        with self._lock:
+            children = list(self._children.items())
+        return {
+            'kind': self.kind,
+            'help': self.documentation,
+            'labels': list(self.labelnames),
+            'buckets': list(self.buckets) if self.kind == 'histogram' else None,
+            'samples': [[list(values), child.snapshot()] for values, child in children],
+        }
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+
+class Registry:
+    def __init__(self, directory=None, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self.logger = logging.getLogger('metrics')
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._writer_pid = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            directory=os.environ.get('METRICS_DIR') or None,
+            interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)),
+        )
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def on_collect(self, callback):
+        """Run callback (e.g. to set pool gauges) before every snapshot"""
+        self._collectors.append(callback)
+
+    def snapshot(self, gauges=True):
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                self.logger.warning(f"Metrics collector failed: {str(e)}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics if gauges or metric.kind != 'gauge'}
+
+    # Multi-process snapshots
+
+    def ensure_started(self):
+        """Start this process's snapshot writer (no-op without METRICS_DIR)"""
+        if self.directory is None or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        # A file left under this pid belongs to an earlier process that had it
+        with self._dir_lock():
+            self._archive([self._path(os.getpid())])
+        thread = threading.Thread(target=self._write_loop, name='metrics-writer', daemon=True)
+        thread.start()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    @contextmanager
+    def _dir_lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.warning(f"Metrics snapshot failed: {str(e)}")
+
+    def flush(self, final=False):
+        """Write this process's snapshot; a final one (at exit) leaves gauges out"""
+        if self.directory is None or self._writer_pid != os.getpid():
+            return
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(gauges=not final), f)
+        os.replace(tmp_path, path)
+
+    def _archive(self, paths):
+        """Fold snapshot files of exited processes into archive.json (dir lock held)"""
+        archive_path = os.path.join(self.directory, 'archive.json')
+        merged = _load(archive_path) or {}
+        folded = False
+        for path in paths:
+            snapshot = _load(path)
+            if snapshot is not None:
+                _merge(merged, snapshot, gauges=False)
+                folded = True
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        if folded:
+            with open(f"{archive_path}.tmp", 'w') as f:
+                json.dump(merged, f)
+            os.replace(f"{archive_path}.tmp", archive_path)
+
+    def collect(self):
+        """This process's metrics merged with every other process's latest snapshot"""
+        merged = {}
+        _merge(merged, self.snapshot(), gauges=True)
+        if self.directory is None or not os.path.isdir(self.directory):
+            return merged
+        with self._dir_lock():
+            dead = []
+            for entry in os.listdir(self.directory):
+                if not entry.endswith('.json') or entry == 'archive.json':
+                    continue
+                pid = int(entry[:-5])
+                if pid == os.getpid():
+                    continue
+                if not _alive(pid):
+                    dead.append(self._path(pid))
+                    continue
+                snapshot = _load(self._path(pid))
+                if snapshot is not None:
+                    _merge(merged, snapshot, gauges=True)
+            if dead:
+                self._archive(dead)
+            archived = _load(os.path.join(self.directory, 'archive.json'))
+        if archived is not None:
+            _merge(merged, archived, gauges=False)
+        return merged
+
+    def render(self):
+        return render(self.collect())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(into, snapshot, gauges):
+    """Add snapshot's series into the merged snapshot (gauges are summed across processes)"""
+    for name, metric in snapshot.items():
+        if metric['kind'] == 'gauge' and not gauges:
+            continue
+        target = into.setdefault(name, dict(metric, samples=[]))
+        series = {tuple(values): value for values, value in target['samples']}
+        for values, value in metric['samples']:
+            key = tuple(values)
+            current = series.get(key)
+            if current is None:
+                series[key] = value
+            elif isinstance(value, list):
+                series[key] = [a + b for a, b in zip(current, value)]
+            else:
+                series[key] = current + value
+        target['samples'] = [[list(key), value] for key, value in series.items()]
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(snapshot):
+    """Prometheus text exposition of a (merged) snapshot"""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for values, value in sorted(metric['samples']):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_format_labels(metric['labels'], values)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            bounds = list(metric['buckets']) + [float('inf')]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                le = ('le', _format_value(bound))
+                lines.append(f"{name}_bucket{_format_labels(metric['labels'], values, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labels'], values)} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(metric['labels'], values)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry.from_env()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Request latency until the body is sent', ('method', 'route', 'status'))
+HTTP_HANDLER_SECONDS = REGISTRY.histogram(
+    'http_handler_duration_seconds', 'Time until the handler returned its response', ('method', 'route'))
+HTTP_IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'Requests being handled')
+HTTP_RESPONSE_BYTES = REGISTRY.counter('http_response_bytes_total', 'Response body bytes sent', ('route',))
+DB_OPERATION_SECONDS = REGISTRY.histogram(
+    'db_operation_seconds', 'Database method latency, including connection checkout', ('operation',))
+
+
+def timed(func, series):
+    """Wrap func so the time spent inside it is observed into series.
+
+    For (async) generators only the time spent producing items counts, not
+    the time the consumer holds them.
+    """
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    yield item
+            finally:
+                started = time.perf_counter()
+                await generator.aclose()
+                series.observe(elapsed + time.perf_counter() - started)
+    elif inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    yield item
+            finally:
+                started = time.perf_counter()
+                generator.close()
+                series.observe(elapsed + time.perf_counter() - started)
+    elif inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - started)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_methods(cls, histogram=DB_OPERATION_SECONDS, exclude=('get_connection', 'pool_stats', 'close')):
+    """Time every public method of cls into histogram, labelled by method name"""
+    for name, func in list(vars(cls).items()):
+        if not name.startswith('_') and name not in exclude and inspect.isfunction(func):
+            setattr(cls, name, timed(func, histogram.labels(name)))
+    return cls
+
+
+def observe_request(method, route, status, started, handled, sent):
+    """Record one finished request; started and handled are perf_counter() values"""
+    HTTP_HANDLER_SECONDS.labels(method, route).observe(handled - started)
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(time.perf_counter() - started)
+    if sent:
+        HTTP_RESPONSE_BYTES.labels(route).inc(sent)
+
+
+class WSGIMetrics:
+    """WSGI middleware: latency, in-flight and response bytes per route.
+
+    http_request_duration_seconds runs until the response body has been
+    sent; http_handler_duration_seconds stops when the app returns its
+    response, so the difference is streaming / serialization time. The app
+    names the route by setting environ['metrics.route'].
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        REGISTRY.ensure_started()
+        started = time.perf_counter()
+        status = ['500', 0]
+
+        def capture(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            for name, value in headers:
+                if name.lower() == 'content-length' and value.isdigit():
+                    status[1] = int(value)
+            return start_response(status_line, headers, exc_info)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            body = self.app(environ, capture)
+        except BaseException:
+            HTTP_IN_FLIGHT.dec()
+            self._observe(environ, status[0], started, started, 0)
+            raise
+        handled = time.perf_counter()
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Wrapping would hide the file from the server's sendfile path,
+            # so hook its close() instead
+            close = body.close
+
+            def measured_close():
+                try:
+                    close()
+                finally:
+                    HTTP_IN_FLIGHT.dec()
+                    self._observe(environ, status[0], started, handled, status[1])
+            body.close = measured_close
+            return body
+        return _MeasuredBody(self, environ, status, started, handled, body)
+
+    def _observe(self, environ, status, started, handled, sent):
+        observe_request(environ.get('REQUEST_METHOD', ''), environ.get('metrics.route', 'unmatched'),
+                        status, started, handled, sent)
+
+
+class _MeasuredBody:
+    def __init__(self, middleware, environ, status, started, handled, body):
+        self.middleware = middleware
+        self.environ = environ
+        self.status = status
+        self.started = started
+        self.handled = handled
+        self.body = body
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            self.middleware._observe(self.environ, self.status[0], self.started, self.handled, self.sent)
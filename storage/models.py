@@ -1,14 +1,58 @@
+import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import logging
+import uuid
+import hashlib
+import tempfile
+from io import BytesIO
+from db_pool import ConnectionPool
+from backends import IterStream, create_backends
+from compression import Compressor
+from metrics import instrument_methods
+
+class PreconditionFailed(Exception):
+    """A conditional write's If-Match / If-None-Match check did not hold"""
+
+class ContentChanged(Exception):
+    """A pre-blob file was overwritten or migrated while its content was being read"""
+
+def read_chunks(stream, chunk_size):
+    """Yield chunk_size blocks from a file-like stream (the last one may be shorter)"""
+    while True:
+        buffer = bytearray()
+        while len(buffer) < chunk_size:
+            data = stream.read(chunk_size - len(buffer))
+            if not data:
+                break
+            buffer.extend(data)
+        if not buffer:
+            return
+        yield bytes(buffer)
+        if len(buffer) < chunk_size:
+            return
 
 class StorageDB:
-    def __init__(self, dsn):
+    def __init__(self, dsn, pool=None, fs_root=None):
         self.dsn = dsn
         self.logger = logging.getLogger('storage_service')
+        self.pool = pool or ConnectionPool.from_env(dsn, logger_name='storage_service')
+        self.chunk_size = int(os.environ.get('STORAGE_CHUNK_SIZE', 256 * 1024))
+        self.fetch_chunks = int(os.environ.get('STORAGE_FETCH_CHUNKS', 4))
+        self.spool_memory = int(os.environ.get('STORAGE_SPOOL_MEMORY', 1024 * 1024))
+        self.compressor = Compressor.from_env()
+        self.backends, self.backend = create_backends(self, fs_root)
     
     def get_connection(self):
-        return psycopg2.connect(self.dsn)
+        """Borrow a pooled connection (commits on success, returned to the pool on exit)"""
+        return self.pool.connection()
+    
+    def pool_stats(self):
+        """Connection pool usage: in use, idle, wait time"""
+        return self.pool.stats()
+    
+    def close(self):
+        self.pool.close()
     
     def list_files(self, path):
         """List files in a path (regardless of user)"""
@@ -27,50 +71,698 @@ class StorageDB:
             self.logger.error(f"List files error: {str(e)}")
             return []
     
+    def iter_listing(self, path, after=None, limit=1000, recursive=False):
+        """Yield up to limit file rows under path in (path, filename) order, without content.
+        
+        after is the (path, filename) of the last row of the previous page. With
+        recursive, files in every subdirectory of path are included; the range
+        predicate is a prefix scan on the C-collated (path, filename) index.
+        """
+        params = {'path': path, 'limit': limit}
+        if recursive:
+            prefix = path if path.endswith('/') else path + '/'
+            params.update(prefix=prefix, upper=prefix[:-1] + '0')  # '0' sorts right after '/'
+            where = """
+                (f.path COLLATE "C") >= %(path)s AND (f.path COLLATE "C") < %(upper)s
+                AND (f.path = %(path)s OR (f.path COLLATE "C") >= %(prefix)s)
+            """
+            order = 'ORDER BY (f.path COLLATE "C"), (f.filename COLLATE "C")'
+            if after is not None:
+                where += ' AND ((f.path COLLATE "C"), (f.filename COLLATE "C")) > (%(after_path)s, %(after_filename)s)'
+                params.update(after_path=after[0], after_filename=after[1])
+        else:
+            where = "f.path = %(path)s"
+            order = "ORDER BY f.filename"
+            if after is not None:
+                where += " AND f.filename > %(after_filename)s"
+                params.update(after_filename=after[1])
+        
+        with self.get_connection() as conn:
+            with conn.cursor(name='list_files', cursor_factory=RealDictCursor) as cur:
+                cur.itersize = min(limit, 1000)
+                cur.execute(f"""
+                    SELECT f.path, f.filename, f.user_id, f.size, f.blob_hash, f.updated_at
+                    FROM files f
+                    WHERE {where}
+                    {order}
+                    LIMIT %(limit)s
+                """, params)
+                yield from cur
+    
     def get_file(self, path, filename):
         """Get file content (regardless of user - permissions are handled at API level)"""
+        try:
+            info = self.get_file_info(path, filename)
+            if info is None:
+                return None
+            return {
+                'content': b''.join(self.iter_file_content(info)),
+                'user_id': info['user_id']
+            }
+        except Exception as e:
+            self.logger.error(f"Get file error: {str(e)}")
+            return None
+    
+    def get_file_info(self, path, filename):
+        """Get file metadata without reading its content"""
         try:
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
                     cur.execute("""
-                        SELECT content, user_id 
-                        FROM files 
-                        WHERE path = %s AND filename = %s
+                        SELECT f.id, f.user_id, f.blob_hash, b.backend AS blob_backend,
+                               b.codec, b.stored_size, f.chunk_size, f.updated_at,
+                               COALESCE(f.size, octet_length(f.content)) AS size
+                        FROM files f
+                        LEFT JOIN blobs b ON b.hash = f.blob_hash
+                        WHERE f.path = %s AND f.filename = %s
                     """, (path, filename))
                     result = cur.fetchone()
                     return result if result else None
         except Exception as e:
-            self.logger.error(f"Get file error: {str(e)}")
+            self.logger.error(f"Get file info error: {str(e)}")
             return None
     
+    def get_files_info(self, keys):
+        """Metadata for many (path, filename) pairs in one query; returns {key: info}"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    rows = execute_values(cur, """
+                        SELECT v.path, v.filename, f.id, f.user_id, f.blob_hash,
+                               b.backend AS blob_backend, b.codec, b.stored_size,
+                               f.chunk_size, f.updated_at,
+                               COALESCE(f.size, octet_length(f.content)) AS size
+                        FROM (VALUES %s) AS v(path, filename)
+                        JOIN files f ON f.path = v.path AND f.filename = v.filename
+                        LEFT JOIN blobs b ON b.hash = f.blob_hash
+                    """, keys, page_size=max(len(keys), 1), fetch=True)
+                    return {(row.pop('path'), row.pop('filename')): row for row in rows}
+        except Exception as e:
+            self.logger.error(f"Get files info error: {str(e)}")
+            return None
+    
+    def iter_file_content(self, info, start=0, end=None):
+        """Yield bytes [start, end) of a file chunk by chunk through a server-side cursor.
+        
+        Only the chunks overlapping the range are read. The pooled connection is
+        held until the generator is exhausted or closed. Raises ContentChanged
+        mid-stream if a pre-blob file changes under it.
+        """
+        size = info['size'] or 0
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        
+        if info['blob_hash'] is not None:
+            # Blobs are immutable, so no version pinning is needed
+            yield from self.backends[info['blob_backend']].iter_range(
+                info['blob_hash'], start, end, info['codec'])
+            return
+        
+        with self.get_connection() as conn:
+            yield from self._iter_row_content(conn, info, start, end)
+    
+    def _iter_row_content(self, conn, info, start, end):
+        """Yield bytes [start, end) of a pre-blob file on conn.
+        
+        Raises ContentChanged if the row no longer holds the version read into
+        info, so a response sized from info is aborted instead of ending short.
+        """
+        position = start
+        if info['chunk_size'] is not None:
+            # Pre-blob chunked row. The join pins the version read into info
+            with conn.cursor(name=f"content_{info['id']}") as cur:
+                cur.itersize = self.fetch_chunks
+                cur.execute("""
+                    SELECT c.byte_offset, c.data
+                    FROM file_chunks c
+                    JOIN files f ON f.id = c.file_id AND f.updated_at = %(updated_at)s
+                    WHERE c.file_id = %(key)s
+                      AND c.byte_offset >= (
+                          SELECT COALESCE(MAX(byte_offset), 0)
+                          FROM file_chunks
+                          WHERE file_id = %(key)s AND byte_offset <= %(start)s
+                      )
+                      AND c.byte_offset < %(end)s
+                    ORDER BY c.byte_offset
+                """, {'key': info['id'], 'updated_at': info['updated_at'], 'start': start, 'end': end})
+                for byte_offset, data in cur:
+                    data = bytes(data)
+                    low = max(start - byte_offset, 0)
+                    high = min(end - byte_offset, len(data))
+                    position = byte_offset + high
+                    yield data[low:high] if low or high < len(data) else data
+        else:
+            # Legacy row with inline content: slice it server-side
+            with conn.cursor() as cur:
+                for offset in range(start, end, self.chunk_size):
+                    cur.execute(
+                        "SELECT substring(content FROM %s FOR %s) FROM files WHERE id = %s",
+                        (offset + 1, min(self.chunk_size, end - offset), info['id'])
+                    )
+                    row = cur.fetchone()
+                    if row is None or not row[0]:
+                        break
+                    position = offset + len(row[0])
+                    yield bytes(row[0])
+        if position < end:
+            raise ContentChanged(f"File {info['id']} changed after {position} of {end} bytes were read")
+    
+    def iter_stored_content(self, info):
+        """Yield an encoded blob's bytes as stored, for clients that accept its codec"""
+        yield from self.backends[info['blob_backend']].iter_stored(info['blob_hash'])
+    
+    def _write_chunks(self, cur, insert_sql, key, stream, encode=None):
+        """Insert stream as (key..., seq, byte_offset, data) rows; returns bytes stored.
+        
+        With encode, each chunk is stored encoded; byte_offset stays the offset
+        in the original stream.
+        """
+        offset = stored = 0
+        for seq, chunk in enumerate(read_chunks(stream, self.chunk_size)):
+            data = encode(chunk) if encode is not None else chunk
+            cur.execute(insert_sql, key + (seq, offset, psycopg2.Binary(data)))
+            offset += len(chunk)
+            stored += len(data)
+        return stored
+    
+    def _write_blob(self, conn, backend, blob_hash, spool, size):
+        """Write a spooled body as new blob content, compressed when that pays off"""
+        codec = self.compressor.choose(spool, size)
+        stored = backend.write(conn, blob_hash, spool, codec)
+        self._set_blob_encoding(conn, blob_hash, codec, stored)
+        if codec is not None:
+            self.logger.info(f"Stored blob {blob_hash[:12]} {codec}-compressed ({size} -> {stored} bytes)")
+    
+    def _set_blob_encoding(self, conn, blob_hash, codec, stored_size):
+        """Record how a blob's content was just (re)written"""
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE blobs SET codec = %s, stored_size = %s WHERE hash = %s",
+                (codec, stored_size, blob_hash)
+            )
+    
+    def spool(self, stream):
+        """Copy stream to a spooled temp file, hashing it; returns (spool, sha256 hex, size)"""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in read_chunks(stream, self.chunk_size):
+            digest.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        spool.seek(0)
+        return spool, digest.hexdigest(), size
+    
+    def _acquire_blob(self, conn, blob_hash, size):
+        """Take a reference on blob_hash, creating its row (in the configured backend) if needed.
+        
+        Returns the backend holding the blob and whether its content still has
+        to be written there.
+        """
+        return self._acquire_blobs(conn, {blob_hash: (size, 1)})[blob_hash]
+    
+    def _acquire_blobs(self, conn, blobs):
+        """Multi-row _acquire_blob: blobs maps hash -> (size, references to add).
+        
+        Returns hash -> (backend, needs_content).
+        """
+        with conn.cursor() as cur:
+            rows = execute_values(cur, """
+                INSERT INTO blobs (hash, size, refcount, backend)
+                VALUES %s
+                ON CONFLICT (hash)
+                DO UPDATE SET refcount = blobs.refcount + EXCLUDED.refcount, released_at = NULL
+                RETURNING hash, (xmax = 0) AS inserted, backend
+            """, [(blob_hash, size, count, self.backend.name)
+                  for blob_hash, (size, count) in sorted(blobs.items())],
+                page_size=max(len(blobs), 1), fetch=True)
+        acquired = {}
+        for blob_hash, inserted, backend_name in rows:
+            backend = self.backends[backend_name]
+            acquired[blob_hash] = (backend, inserted or not backend.has(blob_hash))
+        return acquired
+    
+    def _release_blob(self, conn, blob_hash):
+        """Drop a reference; unreferenced blobs are reclaimed by collect_garbage"""
+        self._release_blobs(conn, {blob_hash: 1})
+    
+    def _release_blobs(self, conn, counts):
+        """Multi-row _release_blob: counts maps hash -> references to drop"""
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                UPDATE blobs
+                SET refcount = blobs.refcount - v.count,
+                    released_at = CASE WHEN blobs.refcount <= v.count THEN CURRENT_TIMESTAMP END
+                FROM (VALUES %s) AS v(hash, count)
+                WHERE blobs.hash = v.hash
+            """, sorted(counts.items()), page_size=max(len(counts), 1))
+    
+    def _lock_file(self, conn, path, filename, user_id):
+        """Create (if needed) and lock the files row; returns (id, current blob_hash, existed)"""
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO files (path, filename, user_id)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (path, filename) DO NOTHING
+                RETURNING id
+            """, (path, filename, user_id))
+            created = cur.fetchone() is not None
+            cur.execute("""
+                SELECT id, blob_hash FROM files
+                WHERE path = %s AND filename = %s
+                FOR UPDATE
+            """, (path, filename))
+            file_id, current = cur.fetchone()
+        return file_id, current, not created
+    
+    def _point_file(self, conn, file_id, previous, user_id, blob_hash, size):
+        """Point a locked files row at blob_hash, releasing the blob it held before"""
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE files
+                SET blob_hash = %s, size = %s, user_id = %s, content = NULL, chunk_size = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (blob_hash, size, user_id, file_id))
+            cur.execute("DELETE FROM file_chunks WHERE file_id = %s", (file_id,))
+        if previous is not None:
+            self._release_blob(conn, previous)
+    
+    def _link_file(self, conn, path, filename, user_id, blob_hash, size):
+        """Point (path, filename) at blob_hash, releasing whatever it held before"""
+        file_id, previous, _ = self._lock_file(conn, path, filename, user_id)
+        self._point_file(conn, file_id, previous, user_id, blob_hash, size)
+        return file_id
+    
+    def file_path(self, info):
+        """Local filesystem path holding the file's content, if its backend has one"""
+        if info['blob_hash'] is None or info['codec'] is not None:
+            return None
+        return self.backends[info['blob_backend']].local_path(info['blob_hash'])
+    
     def put_file(self, path, filename, content, user_id):
         """Store or update file"""
+        return self.put_file_stream(path, filename, BytesIO(content), user_id) is not None
+    
+    def put_file_stream(self, path, filename, stream, user_id, if_match=None, if_none_match=False):
+        """Store or update a file read incrementally from stream.
+        
+        Returns {'size', 'hash'} or None on failure. The body is spooled and
+        hashed before any database work, so content that is already stored
+        becomes a metadata-only write. if_match (a list of content hashes, or
+        ['*']) and if_none_match (create only) are checked against the locked
+        row and raise PreconditionFailed.
+        """
+        try:
+            spool, blob_hash, size = self.spool(stream)
+            with spool:
+                with self.get_connection() as conn:
+                    file_id, previous, existed = self._lock_file(conn, path, filename, user_id)
+                    if if_none_match and existed:
+                        raise PreconditionFailed(f"{path}/{filename} already exists")
+                    if if_match is not None and not (
+                            existed and ('*' in if_match or previous in if_match)):
+                        raise PreconditionFailed(f"{path}/{filename} does not match {if_match}")
+                    
+                    backend, needs_content = self._acquire_blob(conn, blob_hash, size)
+                    if needs_content:
+                        self._write_blob(conn, backend, blob_hash, spool, size)
+                    else:
+                        self.logger.info(f"Deduplicated {path}/{filename} onto existing blob {blob_hash[:12]}")
+                    self._point_file(conn, file_id, previous, user_id, blob_hash, size)
+                    conn.commit()
+                    return {'size': size, 'hash': blob_hash}
+        except PreconditionFailed:
+            raise
+        except Exception as e:
+            self.logger.error(f"Put file error: {str(e)}")
+            return None
+    
+    def put_files(self, items, user_id):
+        """Store many files in one transaction.
+        
+        items are (path, filename, spool, blob_hash, size) tuples, spooled with
+        spool(), with distinct (path, filename). Every statement is multi-row
+        apart from writing new content. Returns True, or False if the
+        transaction failed and nothing was stored.
+        """
+        if not items:
+            return True
+        # One lock order for every batch, so concurrent batches cannot deadlock
+        items = sorted(items, key=lambda item: (item[0], item[1]))
+        keys = [(path, filename) for path, filename, _, _, _ in items]
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute("""
-                        INSERT INTO files (path, filename, content, user_id, updated_at)
-                        VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
-                        ON CONFLICT (path, filename) 
-                        DO UPDATE SET content = %s, user_id = %s, updated_at = CURRENT_TIMESTAMP
-                    """, (path, filename, content, user_id, content, user_id))
+                    execute_values(cur, """
+                        INSERT INTO files (path, filename, user_id)
+                        VALUES %s
+                        ON CONFLICT (path, filename) DO NOTHING
+                    """, [key + (user_id,) for key in keys], page_size=len(keys))
+                    rows = execute_values(cur, """
+                        SELECT f.path, f.filename, f.id, f.blob_hash
+                        FROM files f
+                        JOIN (VALUES %s) AS v(path, filename)
+                          ON f.path = v.path AND f.filename = v.filename
+                        ORDER BY f.path, f.filename
+                        FOR UPDATE OF f
+                    """, keys, page_size=len(keys), fetch=True)
+                    current = {(path, filename): (file_id, previous) for path, filename, file_id, previous in rows}
+                    
+                    wanted = {}
+                    for _, _, _, blob_hash, size in items:
+                        wanted[blob_hash] = (size, wanted.get(blob_hash, (size, 0))[1] + 1)
+                    acquired = self._acquire_blobs(conn, wanted)
+                    for path, filename, spool, blob_hash, size in items:
+                        backend, needs_content = acquired[blob_hash]
+                        if needs_content:
+                            self._write_blob(conn, backend, blob_hash, spool, size)
+                            acquired[blob_hash] = (backend, False)
+                    
+                    updates = []
+                    released = {}
+                    for path, filename, _, blob_hash, size in items:
+                        file_id, previous = current[(path, filename)]
+                        updates.append((file_id, blob_hash, size, user_id))
+                        if previous is not None:
+                            released[previous] = released.get(previous, 0) + 1
+                    execute_values(cur, """
+                        UPDATE files
+                        SET blob_hash = v.blob_hash, size = v.size, user_id = v.user_id,
+                            content = NULL, chunk_size = NULL, updated_at = CURRENT_TIMESTAMP
+                        FROM (VALUES %s) AS v(id, blob_hash, size, user_id)
+                        WHERE files.id = v.id
+                    """, updates, page_size=len(updates))
+                    cur.execute("DELETE FROM file_chunks WHERE file_id = ANY(%s)",
+                                ([file_id for file_id, _, _, _ in updates],))
+                    if released:
+                        self._release_blobs(conn, released)
                     conn.commit()
                     return True
         except Exception as e:
-            self.logger.error(f"Put file error: {str(e)}")
+            self.logger.error(f"Batch put error: {str(e)}")
             return False
     
     def delete_file(self, path, filename):
         """Delete file"""
+        deleted = self.delete_files([(path, filename)])
+        return bool(deleted)
+    
+    def delete_files(self, keys):
+        """Delete many (path, filename) pairs in one statement; returns the set deleted, or None on error"""
+        if not keys:
+            return set()
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    rows = execute_values(cur, """
+                        DELETE FROM files f
+                        USING (VALUES %s) AS v(path, filename)
+                        WHERE f.path = v.path AND f.filename = v.filename
+                        RETURNING f.path, f.filename, f.blob_hash
+                    """, sorted(keys), page_size=len(keys), fetch=True)
+                    released = {}
+                    for _, _, blob_hash in rows:
+                        if blob_hash is not None:
+                            released[blob_hash] = released.get(blob_hash, 0) + 1
+                    if released:
+                        self._release_blobs(conn, released)
+                    conn.commit()
+                    return {(path, filename) for path, filename, _ in rows}
+        except Exception as e:
+            self.logger.error(f"Delete file error: {str(e)}")
+            return None
+    
+    def collect_garbage(self, grace_seconds, batch_size=100):
+        """Delete blobs unreferenced for longer than grace_seconds; returns count removed.
+        
+        The grace period lets in-flight downloads of a just-replaced file finish.
+        """
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
-                        DELETE FROM files 
-                        WHERE path = %s AND filename = %s
-                    """, (path, filename))
+                        DELETE FROM blobs
+                        WHERE hash IN (
+                            SELECT hash FROM blobs
+                            WHERE refcount <= 0
+                              AND released_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        AND refcount <= 0
+                        RETURNING hash, backend
+                    """, (grace_seconds, batch_size))
+                    # Remove external content while the rows are still locked, so a
+                    # concurrent upload of the same hash waits and then rewrites it
+                    for blob_hash, backend_name in cur.fetchall():
+                        self.backends[backend_name].delete(blob_hash)
+                    conn.commit()
+                    if cur.rowcount:
+                        self.logger.info(f"Garbage collected {cur.rowcount} unreferenced blobs")
+                    return cur.rowcount
+        except Exception as e:
+            self.logger.error(f"Blob garbage collection error: {str(e)}")
+            return 0
+    
+    def migrate_to_blobs(self, batch_size=100):
+        """Move a batch of pre-blob files (inline or file_chunks content) into blobs.
+        
+        Each file is converted in its own short transaction while the service
+        keeps serving it; returns the number of files converted.
+        """
+        converted = 0
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id FROM files
+                        WHERE blob_hash IS NULL
+                        ORDER BY id
+                        LIMIT %s
+                    """, (batch_size,))
+                    file_ids = [row['id'] for row in cur.fetchall()]
+            for file_id in file_ids:
+                if self._migrate_file(file_id):
+                    converted += 1
+        except Exception as e:
+            self.logger.error(f"Blob migration error: {str(e)}")
+        return converted
+    
+    def _migrate_file(self, file_id):
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT id, user_id, blob_hash, chunk_size, updated_at,
+                           COALESCE(size, octet_length(content), 0) AS size
+                    FROM files
+                    WHERE id = %s AND blob_hash IS NULL
+                    FOR UPDATE SKIP LOCKED
+                """, (file_id,))
+                info = cur.fetchone()
+                if info is None:
+                    return False
+                
+                # The row lock keeps the content stable while it is hashed; it
+                # is read on this connection so no second one is held meanwhile
+                digest = hashlib.sha256()
+                for chunk in self._iter_row_content(conn, info, 0, info['size']):
+                    digest.update(chunk)
+                blob_hash = digest.hexdigest()
+                
+                backend, needs_content = self._acquire_blob(conn, blob_hash, info['size'])
+                if needs_content and backend.name != 'postgres':
+                    stored = backend.write(conn, blob_hash, IterStream(self._iter_row_content(conn, info, 0, info['size'])))
+                    self._set_blob_encoding(conn, blob_hash, None, stored)
+                elif needs_content:
+                    if info['chunk_size'] is not None:
+                        cur.execute("""
+                            INSERT INTO blob_chunks (blob_hash, seq, byte_offset, data)
+                            SELECT %s, seq, byte_offset, data FROM file_chunks WHERE file_id = %s
+                        """, (blob_hash, file_id))
+                    else:
+                        cur.execute("""
+                            INSERT INTO blob_chunks (blob_hash, seq, byte_offset, data)
+                            SELECT %(hash)s, g.i, g.i * %(chunk)s,
+                                   substring(f.content FROM g.i * %(chunk)s + 1 FOR %(chunk)s)
+                            FROM files f,
+                                 generate_series(0, (octet_length(f.content) - 1) / %(chunk)s) AS g(i)
+                            WHERE f.id = %(id)s
+                        """, {'hash': blob_hash, 'chunk': self.chunk_size, 'id': file_id})
+                cur.execute("""
+                    UPDATE files
+                    SET blob_hash = %s, size = %s, content = NULL, chunk_size = NULL
+                    WHERE id = %s
+                """, (blob_hash, info['size'], file_id))
+                cur.execute("DELETE FROM file_chunks WHERE file_id = %s", (file_id,))
+                conn.commit()
+                return True
+    
+    def create_upload(self, path, filename, user_id):
+        """Start a multipart upload session; returns its id"""
+        try:
+            upload_id = uuid.uuid4().hex
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO upload_sessions (id, path, filename, user_id)
+                        VALUES (%s, %s, %s, %s)
+                    """, (upload_id, path, filename, user_id))
+                    conn.commit()
+                    return upload_id
+        except Exception as e:
+            self.logger.error(f"Create upload error: {str(e)}")
+            return None
+    
+    def get_upload(self, upload_id):
+        """Get an upload session with its received part numbers"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT s.id, s.path, s.filename, s.user_id, s.created_at,
+                               COALESCE(array_agg(p.part_number ORDER BY p.part_number)
+                                        FILTER (WHERE p.part_number IS NOT NULL), '{}') AS parts
+                        FROM upload_sessions s
+                        LEFT JOIN upload_parts p ON p.upload_id = s.id
+                        WHERE s.id = %s
+                        GROUP BY s.id
+                    """, (upload_id,))
+                    result = cur.fetchone()
+                    return result if result else None
+        except Exception as e:
+            self.logger.error(f"Get upload error: {str(e)}")
+            return None
+    
+    def put_upload_part(self, upload_id, part_number, stream):
+        """Store (or replace) one part of an upload from stream; returns bytes stored or None"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO upload_parts (upload_id, part_number, size)
+                        VALUES (%s, %s, 0)
+                        ON CONFLICT (upload_id, part_number) DO UPDATE SET size = 0
+                    """, (upload_id, part_number))
+                    cur.execute(
+                        "DELETE FROM upload_part_chunks WHERE upload_id = %s AND part_number = %s",
+                        (upload_id, part_number)
+                    )
+                    size = self._write_chunks(
+                        cur,
+                        """INSERT INTO upload_part_chunks (upload_id, part_number, seq, byte_offset, data)
+                           VALUES (%s, %s, %s, %s, %s)""",
+                        (upload_id, part_number),
+                        stream
+                    )
+                    cur.execute("""
+                        UPDATE upload_parts SET size = %s WHERE upload_id = %s AND part_number = %s
+                    """, (size, upload_id, part_number))
+                    cur.execute(
+                        "UPDATE upload_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                        (upload_id,)
+                    )
+                    conn.commit()
+                    return size
+        except Exception as e:
+            self.logger.error(f"Upload part error: {str(e)}")
+            return None
+    
+    def complete_upload(self, upload_id):
+        """Assemble parts 1..N into the target file server-side; returns total size or None"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT path, filename, user_id FROM upload_sessions
+                        WHERE id = %s FOR UPDATE
+                    """, (upload_id,))
+                    session = cur.fetchone()
+                    if session is None:
+                        return None
+                    cur.execute("""
+                        SELECT COUNT(*) AS parts, COALESCE(MAX(part_number), 0) AS last_part,
+                               COALESCE(SUM(size), 0) AS size
+                        FROM upload_parts WHERE upload_id = %s
+                    """, (upload_id,))
+                    parts = cur.fetchone()
+                    if parts['parts'] == 0 or parts['parts'] != parts['last_part']:
+                        self.logger.warning(f"Upload {upload_id} has missing parts ({parts['parts']} of {parts['last_part']})")
+                        return None
+                    
+                    # Hash the assembled content by streaming the parts in order
+                    digest = hashlib.sha256()
+                    for data in self._iter_upload_chunks(conn, upload_id):
+                        digest.update(data)
+                    blob_hash = digest.hexdigest()
+                    
+                    backend, needs_content = self._acquire_blob(conn, blob_hash, parts['size'])
+                    if needs_content and backend.name != 'postgres':
+                        stored = backend.write(conn, blob_hash, IterStream(self._iter_upload_chunks(conn, upload_id)))
+                        self._set_blob_encoding(conn, blob_hash, None, stored)
+                    elif needs_content:
+                        # Chunks are copied inside Postgres; no content is re-buffered
+                        cur.execute("""
+                            INSERT INTO blob_chunks (blob_hash, seq, byte_offset, data)
+                            SELECT %s,
+                                   ROW_NUMBER() OVER w - 1,
+                                   COALESCE(SUM(octet_length(data)) OVER w, 0) - octet_length(data),
+                                   data
+                            FROM upload_part_chunks
+                            WHERE upload_id = %s
+                            WINDOW w AS (ORDER BY part_number, seq)
+                        """, (blob_hash, upload_id))
+                    self._link_file(conn, session['path'], session['filename'], session['user_id'],
+                                    blob_hash, parts['size'])
+                    cur.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
+                    conn.commit()
+                    return parts['size']
+        except Exception as e:
+            self.logger.error(f"Complete upload error: {str(e)}")
+            return None
+    
+    def _iter_upload_chunks(self, conn, upload_id):
+        """Yield an upload's part chunks in assembly order through a server-side cursor"""
+        with conn.cursor(name=f"upload_{upload_id}") as chunks:
+            chunks.itersize = self.fetch_chunks
+            chunks.execute("""
+                SELECT data FROM upload_part_chunks
+                WHERE upload_id = %s
+                ORDER BY part_number, seq
+            """, (upload_id,))
+            for (data,) in chunks:
+                yield bytes(data)
+    
+    def abort_upload(self, upload_id):
+        """Discard an upload session and its parts"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
                     conn.commit()
                     return cur.rowcount > 0
         except Exception as e:
-            self.logger.error(f"Delete file error: {str(e)}")
-            return False
\ No newline at end of file
+            self.logger.error(f"Abort upload error: {str(e)}")
+            return False
+    
+    def cleanup_uploads(self, max_age_seconds):
+        """Delete upload sessions idle for longer than max_age_seconds"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        DELETE FROM upload_sessions
+                        WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    """, (max_age_seconds,))
+                    conn.commit()
+                    if cur.rowcount:
+                        self.logger.info(f"Removed {cur.rowcount} abandoned upload sessions")
+                    return cur.rowcount
+        except Exception as e:
+            self.logger.error(f"Upload cleanup error: {str(e)}")
+            return 0
+
+
+# Every public StorageDB method is timed into db_operation_seconds
+instrument_methods(StorageDB)
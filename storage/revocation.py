@@ -0,0 +1,48 @@
+import time
+import threading
+
+
+class RevocationList:
+    """In-memory set of revoked token ids, kept in sync from a cursor-based source.
+
+    Each entry is dropped once the token it revokes would have expired, so the
+    set only ever holds tokens that are still otherwise valid.
+    """
+
+    def __init__(self, refresh_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self.cursor = 0
+        self._lock = threading.Lock()
+        self._revoked = {}  # jti -> exp (epoch seconds)
+        self._refreshed_at = None
+
+    def add(self, jti, exp):
+        with self._lock:
+            self._revoked[jti] = exp
+
+    def apply(self, cursor, entries):
+        """Merge (jti, exp) entries fetched from the source up to cursor"""
+        now = time.time()
+        with self._lock:
+            for jti, exp in entries:
+                if exp > now:
+                    self._revoked[jti] = exp
+            self.cursor = max(self.cursor, cursor)
+            self._refreshed_at = time.monotonic()
+            expired = [jti for jti, exp in self._revoked.items() if exp <= now]
+            for jti in expired:
+                del self._revoked[jti]
+
+    def refresh_if_due(self, fetch):
+        """Call fetch(cursor) -> (cursor, entries) if the last refresh is stale"""
+        refreshed_at = self._refreshed_at
+        if refreshed_at is not None and time.monotonic() - refreshed_at < self.refresh_interval:
+            return
+        cursor, entries = fetch(self.cursor)
+        self.apply(cursor, entries)
+
+    def is_revoked(self, jti):
+        return jti is not None and jti in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
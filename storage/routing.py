@@ -0,0 +1,462 @@
+import os
+import mmap
+import time
+import fcntl
+import heapq
+import struct
+import hashlib
+import logging
+import itertools
+import tempfile
+import threading
+from contextlib import contextmanager
+from models import StorageDB
+from backends import filesystem_root
+from metrics import REGISTRY
+
+READS = REGISTRY.counter(
+    'storage_db_reads_total',
+    'Metadata reads by the node that served them (primary_ryw: pinned by read-your-writes, '
+    'primary_fallback: a replica miss confirmed on the primary)',
+    ('target',))
+
+
+def parse_lsn(text):
+    """'16/B374D848' -> int, so WAL positions compare numerically"""
+    high, _, low = text.partition('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def split_dsns(text, separator=','):
+    return [dsn.strip() for dsn in (text or '').split(separator) if dsn.strip()]
+
+
+def shard_of(path, shards):
+    """Stable shard index for a path; every file in a directory lives on one shard"""
+    if shards == 1:
+        return 0
+    digest = hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+class WritePositions:
+    """Latest primary WAL position each user has written, per shard.
+
+    A fixed table of slots in a shared mapping of an unlinked temporary
+    file: created before the fork (gunicorn preloads the app), it is shared
+    by every worker, so a write served by one worker pins the user's reads
+    in all of them. Users hash onto slots; a collision only sends a few
+    extra reads to the primary.
+
+    Slots are read and updated under an fcntl lock on the file, which
+    excludes the other workers and, unlike a semaphore, is released by the
+    kernel if a worker is killed while holding it. fcntl locks belong to a
+    process, so threads of one worker also take a thread lock.
+    """
+
+    def __init__(self, shards, slots=65536):
+        self.slots = slots
+        self._file = tempfile.TemporaryFile()
+        self._file.truncate(shards * slots * 8)
+        self._memory = mmap.mmap(self._file.fileno(), shards * slots * 8)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def _offset(self, shard, user_id):
+        digest = hashlib.blake2b(str(user_id).encode('utf-8'), digest_size=8).digest()
+        return (shard * self.slots + int.from_bytes(digest, 'big') % self.slots) * 8
+
+    def record(self, shard, user_id, lsn):
+        offset = self._offset(shard, user_id)
+        # Read-compare-write: a slower worker must never lower a position
+        with self._locked():
+            if lsn > struct.unpack_from('<Q', self._memory, offset)[0]:
+                struct.pack_into('<Q', self._memory, offset, lsn)
+
+    def get(self, shard, user_id):
+        """WAL position a node must have replayed to serve this user (0: any)"""
+        offset = self._offset(shard, user_id)
+        with self._locked():
+            return struct.unpack_from('<Q', self._memory, offset)[0]
+
+
+class Replica:
+    """A read replica and what is known about how far it has replayed"""
+
+    def __init__(self, name, db, check_interval=1.0, retry_after=10.0):
+        self.name = name
+        self.db = db
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.replayed = 0
+        self.checked_at = None
+        self.down_until = 0.0
+        self.logger = logging.getLogger('storage_service')
+        self._probe_lock = threading.Lock()
+
+    def usable(self, required):
+        """True if the replica is up and has replayed at least WAL position required"""
+        now = time.monotonic()
+        if now < self.down_until:
+            return False
+        stale = self.checked_at is None or now - self.checked_at >= self.check_interval
+        if (stale or self.replayed < required) and self._probe_lock.acquire(blocking=False):
+            # One thread probes; the others use what is known so far
+            try:
+                self._probe()
+            finally:
+                self._probe_lock.release()
+        return self.checked_at is not None and time.monotonic() >= self.down_until and self.replayed >= required
+
+    def _probe(self):
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_last_wal_replay_lsn()")
+                    (lsn,) = cur.fetchone()
+        except Exception as e:
+            self.logger.warning(f"Replica {self.name} unavailable for {self.retry_after:g}s: {str(e)}")
+            self.down_until = time.monotonic() + self.retry_after
+            return
+        # NULL means the node is not a standby (e.g. a test setup pointing the
+        # replica at its primary): it is always current
+        self.replayed = parse_lsn(lsn) if lsn is not None else float('inf')
+        self.checked_at = time.monotonic()
+        self.down_until = 0.0
+
+
+class Shard:
+    """One primary and its replicas"""
+
+    def __init__(self, index, primary, replicas):
+        self.index = index
+        self.primary = primary
+        self.replicas = replicas
+        self._turn = itertools.count()
+
+    def replicas_in_turn(self):
+        """Replicas in round-robin order, starting one further each call"""
+        if not self.replicas:
+            return []
+        start = next(self._turn) % len(self.replicas)
+        return self.replicas[start:] + self.replicas[:start]
+
+    def primary_lsn(self):
+        with self.primary.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_current_wal_lsn()")
+                return parse_lsn(cur.fetchone()[0])
+
+
+class RoutingStorageDB:
+    """StorageDB interface over sharded primaries and their read replicas.
+
+    files rows (and the blobs and upload sessions that belong to them) are
+    partitioned across the primaries by a hash of path. Metadata and content
+    reads go to a replica of the path's shard, except that a user who wrote
+    to a shard reads from nodes that have replayed that write: the primary's
+    WAL position after each write is recorded per user and compared with
+    each replica's pg_last_wal_replay_lsn(). With one shard and no replicas
+    every call goes straight to a single StorageDB.
+
+    Rows returned by reads carry their node under 'source', so content is
+    read from the same node as the metadata describing it.
+    """
+
+    def __init__(self, primary_dsns, replica_dsns=(), fs_root=None, check_interval=1.0, retry_after=10.0):
+        if not primary_dsns:
+            raise ValueError("At least one primary DSN is required")
+        if len(replica_dsns) > len(primary_dsns):
+            raise ValueError(f"Replicas given for {len(replica_dsns)} shards, but there are {len(primary_dsns)}")
+        self.logger = logging.getLogger('storage_service')
+        sharded = len(primary_dsns) > 1
+        self.shards = []
+        self.nodes = {}
+        for index, dsn in enumerate(primary_dsns):
+            # Shards may hold blobs with the same hash, so each keeps its own
+            # blob files; shard 0 uses the root as before
+            root = os.path.join(fs_root, f"shard-{index}") if fs_root and sharded and index else fs_root
+            primary = StorageDB(dsn, fs_root=root)
+            self.nodes[f"shard{index}/primary"] = primary
+            replicas = []
+            for number, replica_dsn in enumerate(replica_dsns[index] if index < len(replica_dsns) else []):
+                name = f"shard{index}/replica{number}"
+                replica = StorageDB(replica_dsn, fs_root=root)
+                self.nodes[name] = replica
+                replicas.append(Replica(name, replica, check_interval, retry_after))
+            self.shards.append(Shard(index, primary, replicas))
+        self.positions = WritePositions(len(self.shards)) if any(shard.replicas for shard in self.shards) else None
+
+    @classmethod
+    def from_env(cls, dsn):
+        """DATABASE_SHARD_DSNS (default: dsn alone) and DATABASE_REPLICA_DSNS.
+
+        Replicas are comma separated; with several shards, the groups for each
+        shard are separated by ';' in shard order.
+        """
+        primaries = split_dsns(os.environ.get('DATABASE_SHARD_DSNS')) or [dsn]
+        replicas = [split_dsns(group) for group in os.environ.get('DATABASE_REPLICA_DSNS', '').split(';')]
+        while replicas and not replicas[-1]:
+            replicas.pop()
+        return cls(
+            primaries,
+            replicas,
+            fs_root=filesystem_root(),
+            check_interval=float(os.environ.get('DATABASE_REPLICA_CHECK_INTERVAL', 1)),
+            retry_after=float(os.environ.get('DATABASE_REPLICA_RETRY', 10)),
+        )
+
+    @property
+    def primary_dsns(self):
+        return [shard.primary.dsn for shard in self.shards]
+
+    def shard_for(self, path):
+        return self.shards[shard_of(path, len(self.shards))]
+
+    def _reader(self, shard, user_id, primary=False):
+        """Node to read shard from for user_id, and the reads_total target it counts as"""
+        if not shard.replicas:
+            return shard.primary, 'primary'
+        required = self.positions.get(shard.index, user_id) if user_id is not None else 0
+        if not primary:
+            for replica in shard.replicas_in_turn():
+                if replica.usable(required):
+                    return replica.db, 'replica'
+        return shard.primary, 'primary_ryw' if required and not primary else 'primary'
+
+    def _wrote(self, shard, user_id):
+        """Remember the shard's WAL position after user_id's committed write"""
+        if self.positions is None or user_id is None or not shard.replicas:
+            return
+        try:
+            self.positions.record(shard.index, user_id, shard.primary_lsn())
+        except Exception as e:
+            # Without a position the user's next reads may miss the write; never fail it
+            self.logger.error(f"Could not record write position for user {user_id}: {str(e)}")
+
+    @staticmethod
+    def _tag(info, node):
+        if info is not None:
+            info['source'] = node
+        return info
+
+    def _group(self, items, path_of):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard_for(path_of(item)).index, []).append(item)
+        return [(self.shards[index], group) for index, group in sorted(groups.items())]
+
+    # Pools
+
+    def pool_stats(self):
+        """Connection pool usage; with several nodes, totals plus each node's stats"""
+        if len(self.nodes) == 1:
+            return self.shards[0].primary.pool_stats()
+        nodes = {name: node.pool_stats() for name, node in self.nodes.items()}
+        totals = {key: sum(stats[key] for stats in nodes.values())
+                  for key in ('min_size', 'max_size', 'size', 'in_use', 'idle', 'waiting', 'checkouts',
+                              'connections_created', 'connections_discarded', 'timeouts')}
+        totals['nodes'] = nodes
+        return totals
+
+    def fill_pools(self):
+        """Open DB_POOL_MIN connections to every node; an unreachable node is skipped"""
+        for name, node in self.nodes.items():
+            try:
+                node.pool.fill()
+            except Exception as e:
+                self.logger.warning(f"Could not pre-open connections to {name}: {str(e)}")
+
+    def close(self):
+        for node in self.nodes.values():
+            node.close()
+
+    # Reads
+
+    def list_files(self, path, user_id=None):
+        node, target = self._reader(self.shard_for(path), user_id)
+        READS.labels(target).inc()
+        return node.list_files(path)
+
+    def iter_listing(self, path, after=None, limit=1000, recursive=False, user_id=None):
+        """StorageDB.iter_listing; a recursive listing merges every shard's sorted rows"""
+        shards = self.shards if recursive else [self.shard_for(path)]
+        listings = []
+        for shard in shards:
+            node, target = self._reader(shard, user_id)
+            READS.labels(target).inc()
+            listings.append(node.iter_listing(path, after, limit, recursive))
+        if len(listings) == 1:
+            yield from listings[0]
+            return
+        try:
+            # Python orders str by code point, the same order as the C-collated
+            # (path, filename) index each shard lists in
+            merged = heapq.merge(*listings, key=lambda row: (row['path'], row['filename']))
+            yield from itertools.islice(merged, limit)
+        finally:
+            for listing in listings:
+                listing.close()
+
+    def get_file(self, path, filename, user_id=None):
+        shard = self.shard_for(path)
+        node, target = self._reader(shard, user_id)
+        READS.labels(target).inc()
+        result = node.get_file(path, filename)
+        if result is None and node is not shard.primary:
+            # Missing on a replica: it may not have replayed the file yet
+            READS.labels('primary_fallback').inc()
+            result = shard.primary.get_file(path, filename)
+        return result
+
+    def get_file_info(self, path, filename, user_id=None, primary=False):
+        """StorageDB.get_file_info; primary=True reads the shard's primary"""
+        shard = self.shard_for(path)
+        node, target = self._reader(shard, user_id, primary)
+        READS.labels(target).inc()
+        info = node.get_file_info(path, filename)
+        if info is None and node is not shard.primary:
+            READS.labels('primary_fallback').inc()
+            node = shard.primary
+            info = node.get_file_info(path, filename)
+        return self._tag(info, node)
+
+    def get_files_info(self, keys, user_id=None):
+        found = {}
+        for shard, group in self._group(keys, lambda key: key[0]):
+            node, target = self._reader(shard, user_id)
+            READS.labels(target).inc()
+            infos = node.get_files_info(group)
+            missing = group if infos is None else [key for key in group if key not in infos]
+            if missing and node is not shard.primary:
+                READS.labels('primary_fallback').inc()
+                for key, info in (shard.primary.get_files_info(missing) or {}).items():
+                    found[key] = self._tag(info, shard.primary)
+            elif infos is None:
+                return None
+            for key, info in (infos or {}).items():
+                found[key] = self._tag(info, node)
+        return found
+
+    def is_primary_read(self, info):
+        return any(info.get('source') is shard.primary for shard in self.shards)
+
+    def iter_file_content(self, info, start=0, end=None):
+        return info['source'].iter_file_content(info, start, end)
+
+    def iter_stored_content(self, info):
+        return info['source'].iter_stored_content(info)
+
+    def file_path(self, info):
+        return info['source'].file_path(info)
+
+    # Writes
+
+    def spool(self, stream):
+        return self.shards[0].primary.spool(stream)
+
+    def put_file(self, path, filename, content, user_id):
+        shard = self.shard_for(path)
+        stored = shard.primary.put_file(path, filename, content, user_id)
+        if stored:
+            self._wrote(shard, user_id)
+        return stored
+
+    def put_file_stream(self, path, filename, stream, user_id, if_match=None, if_none_match=False):
+        shard = self.shard_for(path)
+        stored = shard.primary.put_file_stream(path, filename, stream, user_id,
+                                               if_match=if_match, if_none_match=if_none_match)
+        if stored is not None:
+            self._wrote(shard, user_id)
+        return stored
+
+    def put_files(self, items, user_id):
+        """StorageDB.put_files; a batch spanning shards commits one transaction per shard"""
+        stored = True
+        for shard, group in self._group(items, lambda item: item[0]):
+            if shard.primary.put_files(group, user_id):
+                self._wrote(shard, user_id)
+            else:
+                stored = False
+        return stored
+
+    def delete_file(self, path, filename, user_id=None):
+        deleted = self.delete_files([(path, filename)], user_id)
+        return bool(deleted)
+
+    def delete_files(self, keys, user_id=None):
+        """StorageDB.delete_files across shards; None if any shard failed"""
+        deleted = set()
+        failed = False
+        for shard, group in self._group(keys, lambda key: key[0]):
+            result = shard.primary.delete_files(group)
+            if result is None:
+                failed = True
+                continue
+            deleted |= result
+            if result:
+                self._wrote(shard, user_id)
+        return None if failed else deleted
+
+    # Uploads: sessions live on the target path's shard, whose index
+    # prefixes the upload id when there are several
+
+    def _upload_shard(self, upload_id):
+        if len(self.shards) == 1:
+            return self.shards[0], upload_id
+        index, _, raw = upload_id.partition('-')
+        if not index.isdigit() or int(index) >= len(self.shards) or not raw:
+            return None, None
+        return self.shards[int(index)], raw
+
+    def create_upload(self, path, filename, user_id):
+        shard = self.shard_for(path)
+        upload_id = shard.primary.create_upload(path, filename, user_id)
+        if upload_id is None or len(self.shards) == 1:
+            return upload_id
+        return f"{shard.index}-{upload_id}"
+
+    def get_upload(self, upload_id):
+        shard, raw = self._upload_shard(upload_id)
+        if shard is None:
+            return None
+        upload = shard.primary.get_upload(raw)
+        if upload is not None:
+            upload['id'] = upload_id
+        return upload
+
+    def put_upload_part(self, upload_id, part_number, stream):
+        shard, raw = self._upload_shard(upload_id)
+        return shard.primary.put_upload_part(raw, part_number, stream) if shard is not None else None
+
+    def complete_upload(self, upload_id, user_id=None):
+        shard, raw = self._upload_shard(upload_id)
+        if shard is None:
+            return None
+        size = shard.primary.complete_upload(raw)
+        if size is not None:
+            self._wrote(shard, user_id)
+        return size
+
+    def abort_upload(self, upload_id):
+        shard, raw = self._upload_shard(upload_id)
+        return shard.primary.abort_upload(raw) if shard is not None else False
+
+    # Maintenance runs on every primary
+
+    def cleanup_uploads(self, max_age_seconds):
+        return sum(shard.primary.cleanup_uploads(max_age_seconds) for shard in self.shards)
+
+    def collect_garbage(self, grace_seconds, batch_size=100):
+        return sum(shard.primary.collect_garbage(grace_seconds, batch_size) for shard in self.shards)
+
+    def migrate_to_blobs(self, batch_size=100):
+        return sum(shard.primary.migrate_to_blobs(batch_size) for shard in self.shards)
@@ -0,0 +1,112 @@
+import os
+import sys
+import datetime
+
+import pytest
+
+INIT_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'init.sql')
+
+# Service modules import each other by bare name, as they do when run from
+# the service directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class MemoryFiles:
+    """Stands in for RoutingStorageDB on the read paths of the storage app"""
+
+    def __init__(self):
+        self.files = {}
+
+    def add(self, path, filename, content, user_id=1, blob_hash=None):
+        info = {
+            'id': len(self.files) + 1, 'user_id': user_id, 'size': len(content),
+            'blob_hash': blob_hash or f"{len(self.files) + 1:064x}", 'blob_backend': 'postgres',
+            'codec': None, 'stored_size': len(content), 'chunk_size': None,
+            'updated_at': datetime.datetime(2024, 5, 1, 12, 0, 0),
+        }
+        self.files[(path, filename)] = (info, content)
+        return info
+
+    def get_file_info(self, path, filename, user_id=None, primary=False):
+        entry = self.files.get((path, filename))
+        return dict(entry[0]) if entry else None
+
+    def get_files_info(self, keys, user_id=None):
+        return {key: dict(self.files[key][0]) for key in keys if key in self.files}
+
+    def is_primary_read(self, info):
+        return True
+
+    def file_path(self, info):
+        return None
+
+    def iter_file_content(self, info, start=0, end=None):
+        content = next(c for i, c in self.files.values() if i['id'] == info['id'])
+        end = len(content) if end is None else end
+        for offset in range(start, end, 7):
+            yield content[offset:min(offset + 7, end)]
+
+
+@pytest.fixture
+def memory_files():
+    return MemoryFiles()
+
+
+@pytest.fixture
+def client(monkeypatch, memory_files):
+    """Test client for the sync storage app, every request authorized as user 1"""
+    import app as storage_app
+    from content_cache import ContentCache
+
+    monkeypatch.setattr(storage_app, 'db', memory_files)
+    monkeypatch.setattr(storage_app, 'content_cache', ContentCache(max_bytes=0))
+    monkeypatch.setattr(storage_app, 'change_listeners', [])
+    monkeypatch.setattr(storage_app.upload_janitor, 'interval', 0)
+    monkeypatch.setattr(storage_app.blob_collector, 'interval', 0)
+    monkeypatch.setattr(storage_app, 'decode_token', lambda token: {'user_id': 1})
+    monkeypatch.setattr(storage_app, 'check_auth', lambda token, path, operation, claims=None: True)
+    monkeypatch.setattr(storage_app, 'check_auth_many',
+                        lambda token, checks, claims: {check: True for check in checks})
+    return storage_app.app.test_client()
+
+
+@pytest.fixture(scope='session')
+def database_dsn():
+    """A scratch database initialised with init.sql, under TEST_DATABASE_DSN's server"""
+    base = os.environ.get('TEST_DATABASE_DSN')
+    if not base:
+        pytest.skip('TEST_DATABASE_DSN not set')
+    import psycopg2
+    from psycopg2.extensions import make_dsn
+
+    name = f"storage_test_{os.getpid()}"
+    admin = psycopg2.connect(base)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE DATABASE {name}")
+    dsn = make_dsn(base, dbname=name)
+    with open(INIT_SQL) as f:
+        schema = ''.join(line for line in f if not line.startswith('\\c '))
+    conn = psycopg2.connect(dsn)
+    with conn, conn.cursor() as cur:
+        cur.execute(schema)
+    conn.close()
+    yield dsn
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE {name} WITH (FORCE)")
+    admin.close()
+
+
+@pytest.fixture
+def storage_db(database_dsn):
+    """StorageDB on the scratch database, emptied of files and blobs afterwards"""
+    import psycopg2
+    from models import StorageDB
+
+    db = StorageDB(database_dsn)
+    yield db
+    db.close()
+    conn = psycopg2.connect(database_dsn)
+    with conn, conn.cursor() as cur:
+        cur.execute("TRUNCATE files, file_chunks, blobs, blob_chunks, upload_sessions CASCADE")
+    conn.close()
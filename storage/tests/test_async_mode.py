@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import tempfile
+import threading
+
+import pytest
+
+import async_models
+from async_app import parse_range
+from async_models import AsyncStorageDB
+
+
+@pytest.mark.parametrize('header, size, expected', [
+    ('bytes=0-9', 100, (0, 10)),
+    ('bytes= 3-4', 100, (3, 5)),
+    ('bytes=5-', 100, (5, 100)),
+    ('bytes=0-1000', 100, (0, 100)),
+    ('bytes=99-', 100, (99, 100)),
+    ('bytes=-5', 100, (95, 100)),
+    ('bytes=-200', 100, (0, 100)),
+    ('bytes=100-', 100, False),
+    ('bytes=0-9', 0, False),
+    ('bytes=-0', 100, False),
+    ('bytes=-5', 0, False),
+    (None, 100, None),
+    ('items=0-1', 100, None),
+    ('bytes=0-0,5-6', 100, None),
+    ('bytes=5-2', 100, None),
+    ('bytes=a-b', 100, None),
+    ('bytes=10', 100, None),
+])
+def test_parse_range(header, size, expected):
+    assert parse_range(header, size) == expected
+
+
+class RecordingSpool(tempfile.SpooledTemporaryFile):
+    threads = set()
+
+    def write(self, data):
+        RecordingSpool.threads.add(threading.get_ident())
+        return super().write(data)
+
+
+def make_db(spool_memory, chunk_size):
+    db = AsyncStorageDB.__new__(AsyncStorageDB)
+    db.spool_memory = spool_memory
+    db.chunk_size = chunk_size
+    return db
+
+
+async def body(parts):
+    for part in parts:
+        await asyncio.sleep(0)
+        yield part
+
+
+def test_spool_writes_off_the_event_loop(monkeypatch):
+    monkeypatch.setattr(async_models.tempfile, 'SpooledTemporaryFile', RecordingSpool)
+    RecordingSpool.threads = set()
+    parts = [bytes([i]) * 700 for i in range(20)]
+
+    async def run():
+        loop_thread = threading.get_ident()
+        spool, digest, size = await make_db(spool_memory=4096, chunk_size=1024).spool(body(parts))
+        return loop_thread, spool, digest, size
+
+    loop_thread, spool, digest, size = asyncio.run(run())
+    with spool:
+        content = b''.join(parts)
+        assert (digest, size) == (hashlib.sha256(content).hexdigest(), len(content))
+        assert spool._rolled
+        assert spool.read() == content
+    assert RecordingSpool.threads and loop_thread not in RecordingSpool.threads
+
+
+def test_failed_body_closes_the_spool(monkeypatch):
+    spools = []
+
+    class Tracking(tempfile.SpooledTemporaryFile):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            spools.append(self)
+
+    monkeypatch.setattr(async_models.tempfile, 'SpooledTemporaryFile', Tracking)
+
+    async def broken():
+        yield b'x' * 10
+        raise ConnectionResetError()
+
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(make_db(spool_memory=4, chunk_size=4).spool(broken()))
+    assert spools[0].closed
+
+
+def asyncpg_url(dsn):
+    from urllib.parse import quote, urlencode
+    from psycopg2.extensions import parse_dsn
+
+    params = parse_dsn(dsn)
+    auth = quote(params.pop('user', ''))
+    if 'password' in params:
+        auth += ':' + quote(params.pop('password'))
+    dbname = params.pop('dbname', '')
+    return f"postgresql://{auth}@/{quote(dbname)}?{urlencode(params)}"
+
+
+def test_rolled_over_upload_round_trips_through_postgres(storage_db, database_dsn):
+    content = bytes(range(256)) * 64
+
+    async def run():
+        db = AsyncStorageDB(asyncpg_url(database_dsn))
+        db.spool_memory = 1024
+        db.chunk_size = 4096
+        await db.open()
+        try:
+            stored = await db.put_file_stream('/async', 'f.bin', body([content[:5000], content[5000:]]), 1)
+            info = await db.get_file_info('/async', 'f.bin')
+            read = b''.join([chunk async for chunk in db.iter_file_content(info)])
+            ranged = b''.join([chunk async for chunk in db.iter_file_content(info, 4000, 9000)])
+            return stored, read, ranged
+        finally:
+            await db.close()
+
+    stored, read, ranged = asyncio.run(run())
+    assert stored == {'size': len(content), 'hash': hashlib.sha256(content).hexdigest()}
+    assert read == content
+    assert ranged == content[4000:9000]
+
+
+def test_async_mode_refuses_several_shards(monkeypatch):
+    import async_app
+    monkeypatch.setenv('DATABASE_SHARD_DSNS', 'dbname=a,dbname=b')
+    with pytest.raises(ValueError):
+        async_app.create_app()
+    monkeypatch.setenv('DATABASE_SHARD_DSNS', 'dbname=a')
+    assert async_app.create_app()[async_app.DSN] == 'dbname=a'
+
+
+class AsyncMemoryFiles:
+    """Async face of the MemoryFiles stand-in, for the /get handler"""
+
+    def __init__(self, files, on_info=None):
+        self.files = files
+        self.on_info = on_info
+
+    async def get_file_info(self, path, filename):
+        info = self.files.get_file_info(path, filename)
+        if self.on_info is not None:
+            self.on_info(path, filename)
+        return info
+
+    async def iter_file_content(self, info, start=0, end=None):
+        for chunk in self.files.iter_file_content(info, start, end):
+            yield chunk
+
+
+def test_get_does_not_cache_content_invalidated_during_the_request(monkeypatch, memory_files):
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_app
+    from content_cache import ContentCache
+
+    class Listener:
+        connected = True
+
+    cache = ContentCache()
+    cache.listeners.append(Listener())
+    memory_files.add('/p', 'f', b'old')
+
+    async def authenticate(request):
+        return 't', {'user_id': 1}, 1
+
+    async def check_auth(request, token, path, operation, claims):
+        return True
+
+    monkeypatch.setattr(async_app, 'content_cache', cache)
+    # A write's NOTIFY arrives right after the metadata read
+    monkeypatch.setattr(async_app, 'db', AsyncMemoryFiles(memory_files, on_info=cache.invalidate))
+    monkeypatch.setattr(async_app, 'authenticate', authenticate)
+    monkeypatch.setattr(async_app, 'check_auth', check_auth)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/get', async_app.get_file)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/get', params={'path': '/p', 'filename': 'f'})
+            return response.status, await response.read()
+
+    assert asyncio.run(run()) == (200, b'old')
+    assert cache.get('/p', 'f') is None
+
+
+def test_connections_are_retired_by_age(database_dsn, monkeypatch):
+    monkeypatch.setenv('DB_POOL_MIN', '1')
+    monkeypatch.setenv('DB_POOL_MAX', '1')
+    monkeypatch.setenv('DB_POOL_MAX_LIFETIME', '0.2')
+
+    async def backend_pid(db):
+        async with db.get_connection() as conn:
+            return await conn.fetchval("SELECT pg_backend_pid()")
+
+    async def run():
+        db = AsyncStorageDB(asyncpg_url(database_dsn))
+        await db.open()
+        try:
+            first = await backend_pid(db)
+            # A young connection is reused...
+            assert await backend_pid(db) == first
+            await asyncio.sleep(0.3)
+            # ...and one that outlived DB_POOL_MAX_LIFETIME is closed on return
+            assert await backend_pid(db) == first
+            return first, await backend_pid(db)
+        finally:
+            await db.close()
+
+    first, replacement = asyncio.run(run())
+    assert replacement != first
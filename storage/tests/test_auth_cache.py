@@ -0,0 +1,121 @@
+import pytest
+
+import auth_cache
+from auth_cache import DecisionCache
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth_cache.time, 'time', clock)
+    return clock
+
+
+def test_grants_and_denials_expire_separately(clock):
+    cache = DecisionCache(ttl=30, deny_ttl=5)
+    cache.put(1, '/a', 'read', True)
+    cache.put(1, '/b', 'read', False)
+    assert cache.get(1, '/a', 'read') is True
+    assert cache.get(1, '/b', 'read') is False
+    clock.now += 10
+    assert cache.get(1, '/a', 'read') is True
+    assert cache.get(1, '/b', 'read') is None
+    clock.now += 25
+    assert cache.get(1, '/a', 'read') is None
+
+
+def test_entries_never_outlive_the_token(clock):
+    cache = DecisionCache(ttl=30)
+    cache.put(1, '/a', 'read', True, token_exp=clock.now + 2)
+    clock.now += 3
+    assert cache.get(1, '/a', 'read') is None
+    cache.put(1, '/a', 'read', True, token_exp=clock.now - 1)
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = DecisionCache(max_entries=2)
+    cache.put(1, '/a', 'read', True)
+    cache.put(1, '/b', 'read', True)
+    assert cache.get(1, '/a', 'read') is True
+    cache.put(1, '/c', 'read', True)
+    assert cache.get(1, '/b', 'read') is None
+    assert cache.get(1, '/a', 'read') is True
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disabled_cache_stores_nothing(clock):
+    cache = DecisionCache(max_entries=0)
+    cache.put(1, '/a', 'read', True)
+    assert not cache.enabled
+    assert cache.get(1, '/a', 'read') is None
+
+
+def test_new_version_drops_only_that_users_entries(clock):
+    cache = DecisionCache()
+    cache.put(1, '/a', 'read', True, version=3)
+    cache.put(2, '/a', 'read', True, version=3)
+    cache.put(1, '/b', 'read', True, version=4)
+    assert cache.get(1, '/a', 'read') is None
+    assert cache.get(1, '/b', 'read') is True
+    assert cache.get(2, '/a', 'read') is True
+
+
+def test_invalidate(clock):
+    cache = DecisionCache()
+    cache.put(1, '/a', 'read', True)
+    cache.put(2, '/a', 'read', True)
+    cache.invalidate(1)
+    assert cache.get(1, '/a', 'read') is None
+    assert cache.get(2, '/a', 'read') is True
+    cache.invalidate()
+    assert cache.get(2, '/a', 'read') is None
+
+
+def test_user_versions_start_unknown_and_follow_polls(clock):
+    cache = DecisionCache()
+    assert cache.known_version(1) is None
+    assert cache.sync_cursor == 0
+    cache.observe_versions(10, {1: 7, 2: 10}, cursor=500)
+    assert cache.known_version(1) == 7
+    assert cache.sync_cursor == 500
+    # Re-delivered or older versions are harmless
+    cache.put(1, '/a', 'read', True)
+    cache.observe_versions(10, {1: 7, 2: 9}, cursor=400)
+    assert cache.get(1, '/a', 'read') is True
+    assert cache.known_version(2) == 10
+    assert cache.sync_cursor == 500
+
+
+def test_versions_are_learned_with_the_cache_disabled(clock):
+    cache = DecisionCache(max_entries=0)
+    cache.put(1, '/a', 'read', True, version=4)
+    assert cache.known_version(1) == 4
+
+
+def test_tracked_users_are_bounded(clock):
+    cache = DecisionCache(max_users=2)
+    cache.observe_versions(3, {1: 1, 2: 2}, cursor=10)
+    assert cache.known_version(1) == 1
+    cache.observe_versions(4, {3: 3}, cursor=11)
+    assert cache.known_version(2) is None
+    assert cache.known_version(1) == 1
+    assert cache.stats()['users_tracked'] == 2
+
+
+def test_forgetting_versions_makes_users_unknown(clock):
+    cache = DecisionCache()
+    cache.observe_versions(3, {1: 3}, cursor=10)
+    cache.observe_versions(5)
+    assert cache.known_version(1) is None
+    cache.observe_versions(5, {1: 3}, cursor=12)
+    cache.invalidate(1)
+    assert cache.known_version(1) is None
@@ -0,0 +1,72 @@
+import io
+import os
+
+import pytest
+
+from backends import FilesystemBackend, IterStream, PostgresBackend, create_backends
+
+BLOB_HASH = 'ab' * 32
+
+
+class Owner:
+    chunk_size = 4
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return FilesystemBackend(Owner(), str(tmp_path))
+
+
+def test_iter_stream_reads_across_chunk_boundaries():
+    stream = IterStream([b'abc', b'', b'defg', b'h'])
+    assert stream.read(2) == b'ab'
+    assert stream.read(4) == b'cdef'
+    assert stream.read() == b'gh'
+    assert stream.read(1) == b''
+
+
+def test_write_is_sharded_and_leaves_no_temp_files(backend, tmp_path):
+    assert not backend.has(BLOB_HASH)
+    assert backend.write(None, BLOB_HASH, io.BytesIO(b'0123456789')) == 10
+    assert backend.has(BLOB_HASH)
+    assert backend.local_path(BLOB_HASH) == os.path.join(str(tmp_path), 'ab', 'ab', BLOB_HASH)
+    assert os.listdir(backend.tmp_dir) == []
+
+
+def test_failed_write_removes_the_temp_file(backend):
+    class Broken:
+        def read(self, size):
+            raise IOError("client went away")
+
+    with pytest.raises(IOError):
+        backend.write(None, BLOB_HASH, Broken())
+    assert not backend.has(BLOB_HASH)
+    assert os.listdir(backend.tmp_dir) == []
+
+
+def test_ranges_and_stored_bytes(backend):
+    backend.write(None, BLOB_HASH, io.BytesIO(b'0123456789'))
+    assert list(backend.iter_range(BLOB_HASH, 3, 9)) == [b'3456', b'78']
+    assert b''.join(backend.iter_stored(BLOB_HASH)) == b'0123456789'
+
+
+def test_delete_is_idempotent(backend):
+    backend.write(None, BLOB_HASH, io.BytesIO(b'x'))
+    backend.delete(BLOB_HASH)
+    backend.delete(BLOB_HASH)
+    assert not backend.has(BLOB_HASH)
+
+
+def test_create_backends_from_environment(monkeypatch, tmp_path):
+    monkeypatch.delenv('STORAGE_FS_ROOT', raising=False)
+    monkeypatch.delenv('STORAGE_BACKEND', raising=False)
+    backends, default = create_backends(Owner())
+    assert set(backends) == {'postgres'} and isinstance(default, PostgresBackend)
+
+    monkeypatch.setenv('STORAGE_BACKEND', 'filesystem')
+    backends, default = create_backends(Owner(), fs_root=str(tmp_path))
+    assert set(backends) == {'postgres', 'filesystem'} and default.root == str(tmp_path)
+
+    monkeypatch.setenv('STORAGE_BACKEND', 's3')
+    with pytest.raises(ValueError):
+        create_backends(Owner(), fs_root=str(tmp_path))
@@ -0,0 +1,107 @@
+import io
+import json
+import time
+import tarfile
+import datetime
+
+import pytest
+
+import app as storage_app
+from app import archive_name, split_archive_name, tar_header
+
+HEADERS = {'Authorization': 'Bearer t'}
+
+
+@pytest.mark.parametrize('path, filename, name', [
+    ('/docs', 'a.txt', 'docs/a.txt'),
+    ('/', 'top.txt', 'top.txt'),
+    ('/a/b/', 'c', 'a/b/c'),
+])
+def test_archive_names_round_trip(path, filename, name):
+    assert archive_name(path, filename) == name
+    assert split_archive_name(name) == ('/' + path.strip('/'), filename)
+
+
+def test_split_archive_name_normalises_and_rejects_directories():
+    assert split_archive_name('./docs/a.txt') == ('/docs', 'a.txt')
+    assert split_archive_name('/docs/a.txt') == ('/docs', 'a.txt')
+    assert split_archive_name('docs/') is None
+
+
+def test_tar_mtime_is_utc_whatever_the_local_zone(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        header = tar_header('a.txt', 0, datetime.datetime(2024, 5, 1, 12, 0, 0))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    member = tarfile.open(fileobj=io.BytesIO(header + b'\0' * 1024)).next()
+    assert member.mtime == datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def make_tar(members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class SpoolingFiles:
+    def __init__(self, memory_files):
+        self.spooled = []
+        self.stored = None
+        memory_files.spool = self.spool
+        memory_files.put_files = self.put_files
+
+    def spool(self, stream):
+        content = stream.read()
+        self.spooled.append(content)
+        return io.BytesIO(content), f'hash-{len(self.spooled)}', len(content)
+
+    def put_files(self, items, user_id):
+        self.stored = [(path, filename, spool.getvalue()) for path, filename, spool, _, _ in items]
+        return True
+
+
+def test_batch_put_never_spools_denied_members(client, memory_files, monkeypatch):
+    files = SpoolingFiles(memory_files)
+    checked = []
+
+    def check_auth(token, path, operation, claims=None):
+        checked.append((path, operation))
+        return path != '/secret'
+
+    monkeypatch.setattr(storage_app, 'check_auth', check_auth)
+    body = make_tar([('docs/a.txt', b'a'), ('secret/s.txt', b'nope'), ('docs/b.txt', b'b')])
+    response = client.post('/batch/put', data=body, headers=HEADERS)
+    assert response.status_code == 200
+    assert [r['status'] for r in response.get_json()['results']] == [200, 403, 200]
+    assert files.spooled == [b'a', b'b']
+    assert files.stored == [('/docs', 'a.txt', b'a'), ('/docs', 'b.txt', b'b')]
+    assert checked == [('/docs', 'write'), ('/secret', 'write')]
+
+
+def test_batch_put_rejects_bad_archives(client, memory_files):
+    SpoolingFiles(memory_files)
+    assert client.post('/batch/put', data=b'not a tar', headers=HEADERS).status_code == 400
+    duplicate = make_tar([('docs/a.txt', b'a'), ('./docs/a.txt', b'b')])
+    assert client.post('/batch/put', data=duplicate, headers=HEADERS).status_code == 400
+
+
+def test_batch_get_streams_a_tar_with_a_status_member(client, memory_files, monkeypatch):
+    memory_files.add('/docs', 'a.txt', b'hello')
+    monkeypatch.setattr(storage_app, 'check_auth_many',
+                        lambda token, checks, claims: {check: check[0] != '/secret' for check in checks})
+    body = {'files': [{'path': '/docs', 'filename': 'a.txt'},
+                      {'path': '/docs', 'filename': 'missing'},
+                      {'path': '/secret', 'filename': 'b'}]}
+    response = client.post('/batch/get', json=body, headers=HEADERS)
+    archive = tarfile.open(fileobj=io.BytesIO(response.data))
+    members = {member.name: archive.extractfile(member).read() for member in archive}
+    assert members['docs/a.txt'] == b'hello'
+    status = json.loads(members[storage_app.BATCH_STATUS_MEMBER])
+    assert [r['status'] for r in status['results']] == [200, 404, 403]
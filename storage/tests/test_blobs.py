@@ -0,0 +1,67 @@
+import io
+import hashlib
+
+import psycopg2
+
+
+def blobs(dsn):
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT hash, refcount FROM blobs ORDER BY hash")
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def read(db, path, filename):
+    return b''.join(db.iter_file_content(db.get_file_info(path, filename)))
+
+
+def test_identical_content_is_stored_once(storage_db, database_dsn):
+    content = b'shared content' * 1000
+    digest = hashlib.sha256(content).hexdigest()
+    assert storage_db.put_file('/a', 'one.txt', content, 1)
+    assert storage_db.put_file('/b', 'two.txt', content, 1)
+    assert blobs(database_dsn) == {digest: 2}
+    assert read(storage_db, '/b', 'two.txt') == content
+
+
+def test_overwrite_and_delete_release_references(storage_db, database_dsn):
+    old, new = b'old' * 100, b'new' * 100
+    storage_db.put_file('/a', 'f', old, 1)
+    storage_db.put_file('/a', 'g', old, 1)
+    storage_db.put_file('/a', 'f', new, 1)
+    old_hash, new_hash = hashlib.sha256(old).hexdigest(), hashlib.sha256(new).hexdigest()
+    assert blobs(database_dsn) == {old_hash: 1, new_hash: 1}
+    assert storage_db.delete_files([('/a', 'g'), ('/a', 'missing')]) == {('/a', 'g')}
+    assert blobs(database_dsn)[old_hash] == 0
+    assert storage_db.collect_garbage(grace_seconds=-1) == 1
+    assert blobs(database_dsn) == {new_hash: 1}
+    assert read(storage_db, '/a', 'f') == new
+
+
+def test_rewriting_the_same_content_keeps_one_reference(storage_db, database_dsn):
+    content = b'same'
+    storage_db.put_file('/a', 'f', content, 1)
+    storage_db.put_file('/a', 'f', content, 1)
+    assert blobs(database_dsn) == {hashlib.sha256(content).hexdigest(): 1}
+
+
+def test_batch_put_counts_duplicates_within_the_batch(storage_db, database_dsn):
+    content = b'batch' * 10
+    items = []
+    for name in ('x', 'y', 'z'):
+        spool, blob_hash, size = storage_db.spool(io.BytesIO(content))
+        items.append(('/batch', name, spool, blob_hash, size))
+    assert storage_db.put_files(items, 1)
+    assert blobs(database_dsn) == {hashlib.sha256(content).hexdigest(): 3}
+
+
+def test_multipart_upload_links_a_blob(storage_db, database_dsn):
+    upload_id = storage_db.create_upload('/up', 'big.bin', 1)
+    storage_db.put_upload_part(upload_id, 2, io.BytesIO(b'world'))
+    storage_db.put_upload_part(upload_id, 1, io.BytesIO(b'hello '))
+    assert storage_db.complete_upload(upload_id) == 11
+    assert read(storage_db, '/up', 'big.bin') == b'hello world'
+    assert blobs(database_dsn) == {hashlib.sha256(b'hello world').hexdigest(): 1}
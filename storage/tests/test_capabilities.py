@@ -0,0 +1,53 @@
+import random
+
+from capabilities import candidate_paths, evaluate_grants, has_grants
+
+
+def test_has_grants():
+    assert has_grants({'grants': []})
+    assert not has_grants({'user_id': 1})
+    assert not has_grants({'grants': 'everything'})
+
+
+def test_most_specific_grant_decides():
+    grants = [['/', True, False], ['/a/b', False, True]]
+    assert evaluate_grants(grants, '/a/b/c', 'write') is True
+    assert evaluate_grants(grants, '/a/b/c', 'read') is False
+    assert evaluate_grants(grants, '/a/bc', 'read') is True
+    assert evaluate_grants(grants, '/a/bc', 'write') is False
+
+
+def test_first_grant_for_a_path_wins():
+    grants = [['/a', True, False], ['/a', False, True]]
+    assert evaluate_grants(grants, '/a', 'read') is True
+    assert evaluate_grants(grants, '/a', 'write') is False
+
+
+def test_no_grant_or_unknown_operation_denies():
+    assert evaluate_grants([], '/a', 'read') is False
+    assert evaluate_grants([['/', True, True]], '/a', 'delete') is False
+
+
+def test_non_canonical_grants_only_match_exactly():
+    grants = [['/a/', True, True]]
+    assert evaluate_grants(grants, '/a/', 'read') is True
+    assert evaluate_grants(grants, '/a', 'read') is False
+    assert evaluate_grants(grants, '/a/x', 'read') is False
+
+
+def test_matches_first_row_in_candidate_order():
+    """Same rule as the auth service's check_sql: candidate order, then row order"""
+    rng = random.Random(7)
+    segments = ['a', 'b', 'c']
+    spellings = lambda parts: ['/' + '/'.join(parts), '/' + '/'.join(parts) + '/', '/'.join(parts)]
+    for _ in range(2000):
+        grants = []
+        for _ in range(rng.randint(0, 6)):
+            path = rng.choice(spellings([rng.choice(segments) for _ in range(rng.randint(0, 3))]))
+            grants.append([path, rng.random() < 0.5, rng.random() < 0.5])
+        path = rng.choice(spellings([rng.choice(segments) for _ in range(rng.randint(0, 3))]))
+        candidates = candidate_paths(path)
+        matching = sorted((candidates.index(g[0]), i) for i, g in enumerate(grants) if g[0] in candidates)
+        for operation, index in (('read', 1), ('write', 2)):
+            expected = bool(grants[matching[0][1]][index]) if matching else False
+            assert evaluate_grants(grants, path, operation) is expected, (grants, path)
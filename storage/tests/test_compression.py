@@ -0,0 +1,78 @@
+import io
+import os
+import gzip
+
+import pytest
+
+import compression
+from compression import Compressor, StreamDecoder, accepts_encoding, decode_chunks, sample_entropy, slice_chunks
+
+
+@pytest.mark.parametrize('header, codec, expected', [
+    ('gzip', 'gzip', True),
+    ('deflate, GZIP', 'gzip', True),
+    ('x-gzip', 'gzip', True),
+    ('gzip;q=0', 'gzip', False),
+    ('gzip; q=0.0, *', 'gzip', False),
+    ('gzip;q=0.5', 'gzip', True),
+    ('gzip;q=bogus', 'gzip', False),
+    ('br, *', 'gzip', True),
+    ('br, *;q=0', 'gzip', False),
+    ('br', 'gzip', False),
+    ('', 'gzip', False),
+    (None, 'gzip', False),
+    ('gzip', None, False),
+    ('zstd;q=1', 'zstd', True),
+    ('x-gzip', 'zstd', False),
+])
+def test_accepts_encoding(header, codec, expected):
+    assert accepts_encoding(header, codec) is expected
+
+
+def test_sample_entropy():
+    assert sample_entropy(b'') == 0.0
+    assert sample_entropy(b'aaaa') == 0.0
+    assert sample_entropy(bytes(range(256))) == pytest.approx(8.0)
+
+
+def test_slice_chunks():
+    chunks = [b'abc', b'defg', b'hi']
+    assert b''.join(slice_chunks(chunks, 0, 9)) == b'abcdefghi'
+    assert b''.join(slice_chunks(chunks, 2, 8)) == b'cdefgh'
+    assert b''.join(slice_chunks(chunks, 3, 7)) == b'defg'
+    assert list(slice_chunks(chunks, 4, 4)) == []
+
+
+def test_chunked_members_decode_as_one_stream():
+    compressor = Compressor('gzip')
+    stored = b''.join(compressor.encode('gzip', part) for part in (b'hello ', b'chunked ', b'world'))
+    # A stored blob is one valid gzip stream for clients...
+    assert gzip.decompress(stored) == b'hello chunked world'
+    # ...and decodes incrementally however it is split on the way back
+    pieces = [stored[i:i + 7] for i in range(0, len(stored), 7)]
+    assert b''.join(decode_chunks('gzip', pieces)) == b'hello chunked world'
+
+
+def test_decoder_rejects_unknown_codecs():
+    with pytest.raises(ValueError):
+        StreamDecoder('brotli')
+
+
+def test_choose_skips_small_and_incompressible_content():
+    compressor = Compressor('gzip', min_size=16)
+    text = b'abcd' * 1000
+    assert compressor.choose(io.BytesIO(text), len(text)) == 'gzip'
+    assert compressor.choose(io.BytesIO(b'abcd'), 4) is None
+    noise = os.urandom(64 * 1024)
+    spool = io.BytesIO(noise)
+    assert compressor.choose(spool, len(noise)) is None
+    assert spool.tell() == 0
+
+
+def test_disabled_and_unavailable_codecs(monkeypatch):
+    assert not Compressor('none').enabled
+    with pytest.raises(ValueError):
+        Compressor('lz4')
+    monkeypatch.setattr(compression, 'zstandard', None)
+    assert Compressor('zstd').codec == 'gzip'
+    assert compression.available_codecs() == ('gzip',)
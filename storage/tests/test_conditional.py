@@ -0,0 +1,84 @@
+import io
+
+import pytest
+
+from models import PreconditionFailed
+
+HEADERS = {'Authorization': 'Bearer t'}
+
+
+@pytest.fixture
+def info(memory_files):
+    return memory_files.add('/docs', 'a.txt', b'hello')
+
+
+def get(client, **headers):
+    return client.get('/get?path=/docs&filename=a.txt', headers={**HEADERS, **headers})
+
+
+def test_get_sends_validators(client, info):
+    response = get(client)
+    assert response.headers['ETag'] == f'"{info["blob_hash"]}"'
+    assert response.headers['Last-Modified'] == 'Wed, 01 May 2024 12:00:00 GMT'
+
+
+def test_if_none_match(client, info):
+    response = get(client, **{'If-None-Match': f'"other", W/"{info["blob_hash"]}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert get(client, **{'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_if_modified_since(client, info):
+    assert get(client, **{'If-Modified-Since': 'Wed, 01 May 2024 12:00:00 GMT'}).status_code == 304
+    assert get(client, **{'If-Modified-Since': 'Wed, 01 May 2024 11:59:59 GMT'}).status_code == 200
+
+
+def test_if_none_match_takes_precedence(client, info):
+    response = get(client, **{'If-None-Match': '"other"',
+                              'If-Modified-Since': 'Wed, 01 May 2024 12:00:00 GMT'})
+    assert response.status_code == 200
+
+
+class RecordingPut:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def __call__(self, path, filename, stream, user_id, if_match=None, if_none_match=False):
+        self.calls.append((if_match, if_none_match))
+        if self.fail:
+            raise PreconditionFailed('no')
+        return {'size': len(stream.read()), 'hash': 'f' * 64}
+
+
+def put(client, **headers):
+    return client.put('/put?path=/docs&filename=a.txt', data=b'new', headers={**HEADERS, **headers})
+
+
+def test_put_passes_preconditions(client, memory_files):
+    memory_files.put_file_stream = RecordingPut()
+    assert put(client).headers['ETag'] == '"' + 'f' * 64 + '"'
+    put(client, **{'If-Match': '"a", "b"'})
+    put(client, **{'If-Match': '*'})
+    put(client, **{'If-None-Match': '*'})
+    calls = [(sorted(if_match) if if_match else if_match, if_none_match)
+             for if_match, if_none_match in memory_files.put_file_stream.calls]
+    assert calls == [(None, False), (['a', 'b'], False), (['*'], False), (None, True)]
+
+
+def test_failed_precondition_is_412(client, memory_files):
+    memory_files.put_file_stream = RecordingPut(fail=True)
+    assert put(client, **{'If-Match': '"a"'}).status_code == 412
+
+
+def test_preconditions_are_checked_against_the_stored_row(storage_db):
+    stored = storage_db.put_file_stream('/c', 'f', io.BytesIO(b'v1'), 1, if_none_match=True)
+    with pytest.raises(PreconditionFailed):
+        storage_db.put_file_stream('/c', 'f', io.BytesIO(b'v2'), 1, if_none_match=True)
+    with pytest.raises(PreconditionFailed):
+        storage_db.put_file_stream('/c', 'f', io.BytesIO(b'v2'), 1, if_match=['0' * 64])
+    with pytest.raises(PreconditionFailed):
+        storage_db.put_file_stream('/c', 'missing', io.BytesIO(b'v2'), 1, if_match=['*'])
+    assert storage_db.put_file_stream('/c', 'f', io.BytesIO(b'v2'), 1, if_match=[stored['hash']]) is not None
+    assert storage_db.get_file_info('/c', 'missing') is None
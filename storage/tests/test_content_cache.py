@@ -0,0 +1,121 @@
+import datetime
+
+from content_cache import ContentCache
+
+UPDATED = datetime.datetime(2024, 5, 1)
+
+
+def info(size, blob_hash='a' * 64, updated_at=UPDATED):
+    return {'size': size, 'blob_hash': blob_hash, 'updated_at': updated_at}
+
+
+class Listener:
+    def __init__(self, connected):
+        self.connected = connected
+
+
+def test_fill_started_before_an_invalidation_is_rejected():
+    cache = ContentCache()
+    started_at = cache.begin_fill()
+    cache.invalidate('/a', 'f')
+    assert not cache.put('/a', 'f', info(3), b'old', started_at)
+    assert cache.put('/a', 'f', info(3), b'new', cache.begin_fill())
+    assert cache.get('/a', 'f', info(3)).content == b'new'
+
+
+def test_invalidating_other_keys_does_not_reject_a_fill():
+    cache = ContentCache()
+    started_at = cache.begin_fill()
+    cache.invalidate('/a', 'other')
+    assert cache.put('/a', 'f', info(3), b'abc', started_at)
+
+
+def test_forgotten_invalidations_still_reject_older_fills():
+    cache = ContentCache(max_tracked=2)
+    started_at = cache.begin_fill()
+    for name in ('f', 'g', 'h'):
+        cache.invalidate('/a', name)
+    # 'f' fell out of the tracked set; the floor keeps rejecting it
+    assert not cache.put('/a', 'f', info(1), b'x', started_at)
+    assert cache.put('/a', 'f', info(1), b'x', cache.begin_fill())
+
+
+def test_clear_rejects_fills_in_flight():
+    cache = ContentCache()
+    started_at = cache.begin_fill()
+    cache.clear()
+    assert not cache.put('/a', 'f', info(1), b'x', started_at)
+
+
+def test_only_complete_blob_backed_small_files_are_cached():
+    cache = ContentCache(max_bytes=100, max_object=10)
+    assert not cache.put('/a', 'f', info(4), b'abc', cache.begin_fill())
+    assert not cache.put('/a', 'f', info(11), b'x' * 11, cache.begin_fill())
+    assert not cache.put('/a', 'f', info(1, blob_hash=None), b'x', cache.begin_fill())
+
+
+def test_byte_budget_evicts_least_recently_used():
+    cache = ContentCache(max_bytes=10, max_object=10)
+    for name in ('f', 'g'):
+        cache.put('/a', name, info(4), b'xxxx', cache.begin_fill())
+    cache.get('/a', 'f', info(4))
+    cache.put('/a', 'h', info(4), b'yyyy', cache.begin_fill())
+    assert cache.get('/a', 'g', info(4)) is None
+    assert cache.get('/a', 'f', info(4)) is not None
+    assert cache.stats()['bytes_resident'] == 8
+
+
+def test_entries_are_checked_against_current_metadata():
+    cache = ContentCache()
+    cache.put('/a', 'f', info(1), b'x', cache.begin_fill())
+    assert cache.get('/a', 'f', info(1, updated_at=UPDATED + datetime.timedelta(seconds=1))) is None
+    assert cache.get('/a', 'f', info(1)) is None
+
+
+def test_unvalidated_reads_need_every_listener_connected():
+    cache = ContentCache()
+    cache.put('/a', 'f', info(1), b'x', cache.begin_fill())
+    assert cache.get('/a', 'f') is None
+    cache.listeners = [Listener(True), Listener(False)]
+    assert not cache.live
+    cache.listeners[1].connected = True
+    assert cache.get('/a', 'f').content == b'x'
+
+
+def test_tee_caches_only_a_fully_read_file():
+    cache = ContentCache()
+    partial = cache.tee('/a', 'f', info(2), iter([b'a', b'b']), cache.begin_fill())
+    next(partial)
+    partial.close()
+    assert cache.get('/a', 'f', info(2)) is None
+    assert list(cache.tee('/a', 'f', info(2), iter([b'a', b'b']), cache.begin_fill())) == [b'a', b'b']
+    assert cache.get('/a', 'f', info(2)).content == b'ab'
+
+
+def test_tee_rejects_a_fill_invalidated_after_its_metadata_was_read():
+    cache = ContentCache()
+    cache.listeners.append(Listener(True))
+    started_at = cache.begin_fill()  # before the metadata read
+    old = info(3)
+    cache.invalidate('/a', 'f')  # a write commits before the content is read
+    assert list(cache.tee('/a', 'f', old, iter([b'old']), started_at)) == [b'old']
+    assert cache.get('/a', 'f') is None
+
+
+def test_get_does_not_cache_content_invalidated_during_the_request(client, memory_files, monkeypatch):
+    import app as storage_app
+    cache = ContentCache()
+    cache.listeners.append(Listener(True))
+    monkeypatch.setattr(storage_app, 'content_cache', cache)
+    memory_files.add('/p', 'f', b'old')
+    read_info = memory_files.get_file_info
+
+    def get_file_info(path, filename, **kwargs):
+        found = read_info(path, filename, **kwargs)
+        cache.invalidate(path, filename)  # a write's NOTIFY arrives right after
+        return found
+
+    monkeypatch.setattr(memory_files, 'get_file_info', get_file_info)
+    response = client.get('/get?path=/p&filename=f', headers={'Authorization': 'Bearer t'})
+    assert response.data == b'old'
+    assert cache.get('/p', 'f') is None
@@ -0,0 +1,65 @@
+import pytest
+
+import app as storage_app
+from auth_cache import DecisionCache
+
+GRANTS = [['/', True, True]]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = DecisionCache()
+    monkeypatch.setattr(storage_app, 'auth_cache', cache)
+    return cache
+
+
+def decide(claims, path='/a', operation='read'):
+    with storage_app.app.test_request_context():
+        decision = storage_app.local_decision(claims, path, operation)
+        return decision, storage_app.g.get('token_refresh_required', False)
+
+
+def test_grants_are_not_trusted_before_the_first_sync(cache):
+    assert decide({'user_id': 1, 'pv': 5, 'grants': GRANTS}) == (None, False)
+
+
+def test_current_grants_are_evaluated_locally(cache):
+    cache.observe_versions(5, {1: 5}, cursor=100)
+    assert decide({'user_id': 1, 'pv': 5, 'grants': GRANTS}) == (True, False)
+    assert decide({'user_id': 1, 'pv': 5, 'grants': []}) == (False, False)
+
+
+def test_outdated_grants_ask_auth_and_request_a_refresh(cache):
+    cache.observe_versions(6, {1: 6}, cursor=100)
+    assert decide({'user_id': 1, 'pv': 5, 'grants': GRANTS}) == (None, True)
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeAuth:
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append((url.rsplit('/', 2)[-2:], dict(params)))
+        if url.endswith('/permissions/version'):
+            return FakeResponse({'version': 9, 'cursor': 700, 'users': {'1': 9}})
+        return FakeResponse({'cursor': 700, 'revoked': []})
+
+
+def test_sync_polls_every_user_first_then_from_the_cursor(cache, monkeypatch):
+    auth = FakeAuth()
+    monkeypatch.setattr(storage_app, 'auth_http', auth)
+    storage_app.sync_with_auth()
+    assert auth.calls[0] == (['permissions', 'version'], {'since': 0})
+    assert cache.known_version(1) == 9
+    storage_app.sync_with_auth()
+    assert auth.calls[2] == (['permissions', 'version'], {'since': 700})
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import app as storage_app
+from app import decode_list_cursor, encode_list_cursor
+
+HEADERS = {'Authorization': 'Bearer t'}
+
+
+@pytest.mark.parametrize('key', [('/a', 'f.txt'), ('/ü/dir with space', 'name"quoted".bin'), ('/', '')])
+def test_cursor_round_trip(key):
+    cursor = encode_list_cursor(*key)
+    assert '=' not in cursor and '/' not in cursor and '+' not in cursor
+    assert decode_list_cursor(cursor) == key
+
+
+@pytest.mark.parametrize('cursor', ['!!!', 'e30', encode_list_cursor('/a', 'f')[:-3], 'WzEsMl0'])
+def test_malformed_cursors_are_rejected(cursor):
+    # 'e30' is {} and 'WzEsMl0' is [1,2]
+    assert decode_list_cursor(cursor) is None
+
+
+def rows_from(keys):
+    def iter_listing(path, after=None, limit=1000, recursive=False, user_id=None):
+        for row_path, filename in sorted(keys):
+            if after is None or (row_path, filename) > after:
+                if limit == 0:
+                    return
+                limit -= 1
+                yield {'path': row_path, 'filename': filename, 'user_id': 1, 'size': 1,
+                       'blob_hash': 'h', 'updated_at': None}
+    return iter_listing
+
+
+def list_page(client, **params):
+    query = '&'.join(f'{key}={value}' for key, value in params.items())
+    response = client.get(f'/list?{query}', headers=HEADERS)
+    return response.status_code, json.loads(response.data)
+
+
+def test_pages_follow_next_cursor(client, memory_files):
+    memory_files.iter_listing = rows_from([('/d', name) for name in 'abcde'])
+    seen = []
+    cursor = None
+    while True:
+        params = {'path': '/d', 'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        status, page = list_page(client, **params)
+        assert status == 200
+        seen.extend(page['files'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == list('abcde')
+
+
+def test_exact_last_page_has_no_cursor(client, memory_files):
+    memory_files.iter_listing = rows_from([('/d', 'a'), ('/d', 'b')])
+    assert list_page(client, path='/d', limit=2)[1]['next_cursor'] is None
+
+
+def test_bad_parameters(client, memory_files):
+    assert list_page(client, path='/d', limit=0)[0] == 400
+    assert list_page(client, path='/d', cursor='!!!')[0] == 400
+    assert list_page(client, path='/d', fields='size,colour')[0] == 400
+
+
+def test_recursive_listing_checks_each_directory(client, memory_files, monkeypatch):
+    memory_files.iter_listing = rows_from([('/d', 'a'), ('/d/private', 'b'), ('/d/sub', 'c')])
+    monkeypatch.setattr(storage_app, 'check_auth',
+                        lambda token, path, operation, claims=None: path != '/d/private')
+    status, page = list_page(client, path='/d', recursive='true', fields='size')
+    assert status == 200
+    assert page['files'] == [{'path': '/d', 'filename': 'a', 'size': 1},
+                             {'path': '/d/sub', 'filename': 'c', 'size': 1}]
+
+
+def test_keyset_pagination_in_the_database(storage_db):
+    for path, filename in [('/p', 'b'), ('/p', 'a'), ('/p/q', 'c'), ('/p/q/r', 'd'), ('/pq', 'x'), ('/p-', 'y')]:
+        storage_db.put_file(path, filename, b'.', 1)
+    names = lambda rows: [(row['path'], row['filename']) for row in rows]
+    assert names(storage_db.iter_listing('/p')) == [('/p', 'a'), ('/p', 'b')]
+    assert names(storage_db.iter_listing('/p', after=('/p', 'a'))) == [('/p', 'b')]
+    everything = names(storage_db.iter_listing('/p', recursive=True))
+    assert everything == [('/p', 'a'), ('/p', 'b'), ('/p/q', 'c'), ('/p/q/r', 'd')]
+    page = names(storage_db.iter_listing('/p', after=('/p', 'b'), limit=1, recursive=True))
+    assert page == [('/p/q', 'c')]
+    assert names(storage_db.iter_listing('/p', after=page[-1], recursive=True)) == [('/p/q/r', 'd')]
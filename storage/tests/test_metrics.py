@@ -0,0 +1,74 @@
+import json
+import os
+
+import pytest
+
+import metrics
+from metrics import Registry, render, request_id_from, timed
+
+
+def test_request_ids_are_kept_only_if_sane():
+    assert request_id_from('abc-123') == 'abc-123'
+    assert request_id_from('bad id\n') != 'bad id\n'
+    assert len(request_id_from(None)) == 32
+
+
+def test_render_counters_and_histograms():
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests', ('route',))
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    requests.labels('/a"b').inc(2)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+    text = registry.render()
+    assert 'requests_total{route="/a\\"b"} 2\n' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{le="1"} 2\n' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3\n' in text
+    assert 'latency_seconds_count 3\n' in text
+    assert 'latency_seconds_sum 5.55\n' in text
+
+
+def test_labels_must_match():
+    registry = Registry()
+    with pytest.raises(ValueError):
+        registry.counter('c', 'C', ('a', 'b')).labels('x')
+    assert registry.counter('c', 'C', ('a', 'b')) is registry.counter('c', 'C', ('a', 'b'))
+
+
+def test_snapshots_of_other_processes_are_merged(tmp_path, monkeypatch):
+    registry = Registry(directory=str(tmp_path))
+    registry.counter('hits_total', 'Hits').inc(1)
+    registry.gauge('in_flight', 'In flight').set(1)
+    live, dead = 4242, 4343
+    other = Registry()
+    other.counter('hits_total', 'Hits').inc(10)
+    other.gauge('in_flight', 'In flight').set(2)
+    for pid in (live, dead):
+        with open(tmp_path / f"{pid}.json", 'w') as f:
+            json.dump(other.snapshot(), f)
+    monkeypatch.setattr(metrics, '_alive', lambda pid: pid != dead)
+
+    merged = registry.collect()
+    assert merged['hits_total']['samples'] == [[[], 21]]
+    # Gauges of the exited process are dropped; its counters are archived
+    assert merged['in_flight']['samples'] == [[[], 3]]
+    assert not os.path.exists(tmp_path / f"{dead}.json")
+    assert registry.collect()['hits_total']['samples'] == [[[], 21]]
+
+
+def test_timed_generators_observe_once_when_closed():
+    registry = Registry()
+    series = registry.histogram('gen_seconds', 'Gen').labels()
+
+    def numbers():
+        yield 1
+        yield 2
+
+    assert list(timed(numbers, series)()) == [1, 2]
+    assert sum(series.snapshot()[:-1]) == 1
+    generator = timed(numbers, series)()
+    next(generator)
+    generator.close()
+    assert sum(series.snapshot()[:-1]) == 2
@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+from models import ContentChanged, StorageDB, read_chunks
+
+
+class TrickleStream(io.RawIOBase):
+    """Returns at most `step` bytes per read, like a socket"""
+
+    def __init__(self, data, step):
+        self.data = data
+        self.step = step
+
+    def read(self, size=-1):
+        chunk, self.data = self.data[:min(size, self.step)], self.data[min(size, self.step):]
+        return chunk
+
+
+def test_read_chunks_fills_every_chunk_but_the_last():
+    chunks = list(read_chunks(TrickleStream(b'x' * 25, 3), 10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+
+
+def test_read_chunks_of_exact_multiple_and_empty_stream():
+    assert list(read_chunks(io.BytesIO(b'ab' * 5), 5)) == [b'ababa', b'babab']
+    assert list(read_chunks(io.BytesIO(b''), 5)) == []
+
+
+class InlineContentConnection:
+    """Serves substring() queries on a files.content value that can change"""
+
+    def __init__(self, content):
+        self.content = content
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        start, length, _ = params
+        self.row = (self.content[start - 1:start - 1 + length],) if self.content is not None else (None,)
+
+    def fetchone(self):
+        return self.row
+
+
+def inline_db(chunk_size):
+    db = StorageDB.__new__(StorageDB)
+    db.chunk_size = chunk_size
+    return db
+
+
+def test_inline_content_is_sliced():
+    conn = InlineContentConnection(bytes(range(100)))
+    info = {'id': 1, 'chunk_size': None}
+    parts = list(inline_db(30)._iter_row_content(conn, info, 10, 95))
+    assert [len(part) for part in parts] == [30, 30, 25]
+    assert b''.join(parts) == bytes(range(10, 95))
+
+
+def test_content_removed_mid_stream_raises():
+    conn = InlineContentConnection(bytes(100))
+    stream = inline_db(30)._iter_row_content(conn, {'id': 1, 'chunk_size': None}, 0, 100)
+    next(stream)
+    conn.content = None  # migrated to a blob, or overwritten
+    with pytest.raises(ContentChanged):
+        list(stream)
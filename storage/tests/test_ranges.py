@@ -0,0 +1,60 @@
+import pytest
+
+CONTENT = bytes(range(256)) * 4
+HEADERS = {'Authorization': 'Bearer t'}
+
+
+@pytest.fixture
+def info(memory_files):
+    return memory_files.add('/docs', 'data.bin', CONTENT)
+
+
+def get(client, **headers):
+    return client.get('/get?path=/docs&filename=data.bin', headers={**HEADERS, **headers})
+
+
+def test_single_range(client, info):
+    response = get(client, Range='bytes=10-19')
+    assert response.status_code == 206
+    assert response.data == CONTENT[10:20]
+    assert response.headers['Content-Range'] == f"bytes 10-19/{len(CONTENT)}"
+    assert response.headers['Content-Length'] == '10'
+
+
+def test_suffix_and_open_ranges(client, info):
+    assert get(client, Range='bytes=-5').data == CONTENT[-5:]
+    assert get(client, Range='bytes=1000-').data == CONTENT[1000:]
+    assert get(client, Range='bytes=1000-99999').data == CONTENT[1000:]
+
+
+def test_suffix_longer_than_the_file(client, info):
+    response = get(client, Range='bytes=-5000')
+    assert response.status_code == 206
+    assert response.data == CONTENT
+    assert response.headers['Content-Range'] == f"bytes 0-{len(CONTENT) - 1}/{len(CONTENT)}"
+
+
+def test_unsatisfiable_range(client, info):
+    response = get(client, Range=f"bytes={len(CONTENT)}-")
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f"bytes */{len(CONTENT)}"
+
+
+def test_multiple_ranges_get_the_whole_file(client, info):
+    response = get(client, Range='bytes=0-1,5-6')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_range_must_match_the_current_version(client, info):
+    assert get(client, Range='bytes=0-3', **{'If-Range': f'"{info["blob_hash"]}"'}).status_code == 206
+    response = get(client, Range='bytes=0-3', **{'If-Range': '"something-else"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_full_download_advertises_ranges(client, info):
+    response = get(client)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.data == CONTENT
@@ -0,0 +1,128 @@
+import os
+import fcntl
+import multiprocessing
+from collections import Counter
+
+import pytest
+
+import routing
+from routing import RoutingStorageDB, WritePositions, parse_lsn, shard_of, split_dsns
+
+
+def test_parse_lsn_orders_numerically():
+    assert parse_lsn('0/0') == 0
+    assert parse_lsn('16/B374D848') == (0x16 << 32) + 0xB374D848
+    assert parse_lsn('1/0') > parse_lsn('0/FFFFFFFF')
+
+
+def test_split_dsns():
+    assert split_dsns(' a , b,, ') == ['a', 'b']
+    assert split_dsns(None) == []
+
+
+def test_shard_of_is_stable_and_spread():
+    assert shard_of('/anything', 1) == 0
+    # Hash based, so the same on every process and every run
+    assert [shard_of(f"/dir{i}", 4) for i in range(8)] == [shard_of(f"/dir{i}", 4) for i in range(8)]
+    counts = Counter(shard_of(f"/users/{i}", 4) for i in range(4000))
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 800
+
+
+def test_write_positions_only_move_forward():
+    positions = WritePositions(shards=2, slots=16)
+    assert positions.get(0, 1) == 0
+    positions.record(0, 1, 100)
+    positions.record(0, 1, 50)
+    assert positions.get(0, 1) == 100
+    assert positions.get(1, 1) == 0
+
+
+def _record_many(positions, start, worker, rounds, workers):
+    start.wait(10)
+    for i in range(rounds):
+        positions.record(0, 'user', i * workers + worker)
+        # Another worker may have moved it further, never back
+        assert positions.get(0, 'user') >= i * workers + worker
+
+
+def test_write_positions_are_shared_and_atomic_across_forks():
+    context = multiprocessing.get_context('fork')
+    positions = WritePositions(shards=1, slots=4)
+    start = context.Event()
+    workers, rounds = 4, 20000
+    processes = [context.Process(target=_record_many, args=(positions, start, worker, rounds, workers))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    # Every worker wrote increasing positions to the same slot: a lost
+    # read-compare-write would leave a lower one behind
+    assert positions.get(0, 'user') == rounds * workers - 1
+
+
+def _die_holding_lock(positions):
+    fcntl.lockf(positions._file, fcntl.LOCK_EX)
+    os._exit(0)
+
+
+def test_write_positions_survive_a_worker_killed_mid_update():
+    context = multiprocessing.get_context('fork')
+    positions = WritePositions(shards=1, slots=4)
+    process = context.Process(target=_die_holding_lock, args=(positions,))
+    process.start()
+    process.join(30)
+    positions.record(0, 1, 7)
+    assert positions.get(0, 1) == 7
+
+
+class StubReplica:
+    def __init__(self, replayed):
+        self.replayed = replayed
+        self.db = object()
+
+    def usable(self, required):
+        return self.replayed >= required
+
+
+def test_users_read_their_writes():
+    db = RoutingStorageDB(['dbname=a'], [['dbname=a_replica']])
+    shard = db.shards[0]
+    replica = StubReplica(replayed=100)
+    shard.replicas = [replica]
+    assert db._reader(shard, 1) == (replica.db, 'replica')
+    db.positions.record(0, 1, 150)
+    assert db._reader(shard, 1) == (shard.primary, 'primary_ryw')
+    assert db._reader(shard, 2) == (replica.db, 'replica')
+    replica.replayed = 150
+    assert db._reader(shard, 1) == (replica.db, 'replica')
+    assert db._reader(shard, 1, primary=True) == (shard.primary, 'primary')
+
+
+def test_upload_ids_name_their_shard():
+    db = RoutingStorageDB(['dbname=a', 'dbname=b', 'dbname=c'])
+    assert db.positions is None
+    assert db._upload_shard('2-abc') == (db.shards[2], 'abc')
+    assert db._upload_shard('3-abc') == (None, None)
+    assert db._upload_shard('abc') == (None, None)
+    single = RoutingStorageDB(['dbname=a'])
+    assert single._upload_shard('abc') == (single.shards[0], 'abc')
+
+
+def test_replica_groups_must_match_shards():
+    with pytest.raises(ValueError):
+        RoutingStorageDB([])
+    with pytest.raises(ValueError):
+        RoutingStorageDB(['dbname=a'], [['dbname=r1'], ['dbname=r2']])
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setattr(routing, 'filesystem_root', lambda: None)
+    monkeypatch.setenv('DATABASE_SHARD_DSNS', 'dbname=a, dbname=b')
+    monkeypatch.setenv('DATABASE_REPLICA_DSNS', ';dbname=b1,dbname=b2;')
+    db = RoutingStorageDB.from_env('dbname=default')
+    assert db.primary_dsns == ['dbname=a', 'dbname=b']
+    assert [len(shard.replicas) for shard in db.shards] == [0, 2]